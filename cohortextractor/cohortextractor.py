@@ -5,6 +5,7 @@ start a notebook, open a web browser on the correct port, and handle
 shutdowns gracefully
 """
 import base64
+import concurrent.futures
 import csv
 import datetime
 import glob
@@ -13,6 +14,7 @@ import logging
 import os
 import re
 import sys
+import tempfile
 from argparse import ArgumentParser
 from collections import defaultdict
 from io import BytesIO
@@ -34,6 +36,9 @@ from prettytable import PrettyTable
 
 import cohortextractor
 from cohortextractor.localrun import localrun
+from cohortextractor.measure import MeasureAggregator
+from cohortextractor.parquet_utils import csv_to_parquet, import_pyarrow
+from cohortextractor.streaming_stats import QuantileSketch, RunningMoments, TopKCounter
 
 logger = structlog.get_logger()
 
@@ -60,61 +65,414 @@ def relative_dir():
     return os.getcwd()
 
 
-def make_chart(name, series, dtype):
-    FLOOR_DATE = datetime.datetime(1960, 1, 1)
-    CEILING_DATE = datetime.datetime.today()
-    img = BytesIO()
+# Quantiles in the cohort report are estimated from a sample of at most this
+# many values from each column
+DESCRIBE_SAMPLE_SIZE = 1000000
+
+# When the cohort report is built from chunks of the input, at most this many
+# distinct values of each categorical column are counted
+MAX_TRACKED_CATEGORIES = 1000
+
+
+def get_chart_data(name, series, dtype):
+    """
+    Summarise `series` as the pre-binned counts needed to draw its chart
+
+    All the work over the full data is done here with NumPy, so that drawing
+    the chart with `render_chart` (possibly in another process) only needs
+    the counts.
+    """
     # Setting figure sizes in seaborn is a bit weird:
     # https://stackoverflow.com/a/23973562/559140
     if is_categorical_dtype(dtype):
-        sns.set_style("ticks")
-        sns.catplot(
-            x=name, data=series.to_frame(), kind="count", height=3, aspect=3 / 2
-        )
-        plt.xticks(rotation=45)
+        counts = series.value_counts(sort=False)
+        return {
+            "kind": "count",
+            "name": name,
+            "labels": [str(label) for label in counts.index],
+            "counts": counts.to_numpy(),
+            "figsize": (4.5, 3),
+        }
     elif is_bool_dtype(dtype):
-        sns.set_style("ticks")
-        sns.catplot(x=name, data=series.to_frame(), kind="count", height=2, aspect=1)
-        plt.xticks(rotation=45)
+        counts = np.bincount(series.dropna().to_numpy(dtype=bool), minlength=2)
+        return _get_bool_chart_data(name, counts)
     elif is_datetime64_dtype(dtype):
-        # Early dates are dummy values; I don't know what late dates
-        # are but presumably just dud data
-        series = series[(series > FLOOR_DATE) & (series <= CEILING_DATE)]
-        # Set bin numbers appropriate to the time window
-        delta = series.max() - series.min()
-        if delta.days <= 31:
-            bins = delta.days
-        elif delta.days <= 365 * 10:
-            bins = delta.days / 31
+        floor_date, ceiling_date = _get_date_limits()
+        values = series.to_numpy()
+        values = values[(values > floor_date) & (values <= ceiling_date)]
+        if len(values):
+            bins = _get_date_bins(values.min(), values.max())
+            counts, edges = np.histogram(values.view("int64"), bins=bins)
+            edges = edges.astype("int64").view("datetime64[ns]")
         else:
-            bins = delta.days / 365
-        if bins < 1:
-            bins = 1
-        fig = plt.figure(figsize=(5, 2))
-        ax = fig.add_subplot(111)
-        series.hist(bins=int(bins), ax=ax)
-        plt.xticks(rotation=45, ha="right")
+            counts, edges = np.array([]), np.array([], dtype="datetime64[ns]")
+        return {
+            "kind": "histogram",
+            "name": name,
+            "counts": counts,
+            "edges": edges,
+            "figsize": (5, 2),
+        }
     elif is_numeric_dtype(dtype):
         # Trim percentiles and negatives which are usually bad data
-        series = series.fillna(0)
-        series = series[
-            (series < np.percentile(series, 95))
-            & (series > np.percentile(series, 5))
-            & (series > 0)
-        ]
-        fig = plt.figure(figsize=(5, 2))
-        ax = fig.add_subplot(111)
-        sns.distplot(series, kde=False, ax=ax)
-        plt.xticks(rotation=45)
+        values = series.to_numpy(dtype="float64", na_value=0)
+        low, high = np.percentile(values, [5, 95])
+        values = values[(values < high) & (values > low) & (values > 0)]
+        # Use the same number of bins as seaborn's `distplot`
+        bins = min(_freedman_diaconis_bins(values), 50)
+        counts, edges = np.histogram(values, bins=bins)
+        return {
+            "kind": "histogram",
+            "name": name,
+            "counts": counts,
+            "edges": edges,
+            "figsize": (5, 2),
+        }
     else:
         raise ValueError()
 
+
+def _get_bool_chart_data(name, counts):
+    # As with a seaborn count plot, only values which occur are shown
+    return {
+        "kind": "count",
+        "name": name,
+        "labels": [label for label, n in zip(["False", "True"], counts) if n],
+        "counts": counts[counts > 0],
+        "figsize": (2, 2),
+    }
+
+
+def _get_date_limits():
+    # Early dates are dummy values; I don't know what late dates
+    # are but presumably just dud data
+    floor_date = np.datetime64(datetime.datetime(1960, 1, 1), "ns")
+    ceiling_date = np.datetime64(datetime.datetime.today(), "ns")
+    return floor_date, ceiling_date
+
+
+def _get_date_bins(first, last):
+    # Set bin numbers appropriate to the time window
+    days = (last - first) // np.timedelta64(1, "D")
+    if days <= 31:
+        bins = days
+    elif days <= 365 * 10:
+        bins = days / 31
+    else:
+        bins = days / 365
+    return max(int(bins), 1)
+
+
+def _freedman_diaconis_bins(values):
+    if len(values) < 2:
+        return 1
+    iqr = np.subtract(*np.percentile(values, [75, 25]))
+    return _get_freedman_diaconis_bin_count(
+        len(values), iqr, values.max() - values.min()
+    )
+
+
+def _get_freedman_diaconis_bin_count(count, iqr, value_range):
+    width = 2 * iqr / (count ** (1 / 3))
+    # Fall back to sqrt(n) bins if the IQR is 0
+    if width == 0:
+        return int(np.sqrt(count))
+    return int(np.ceil(value_range / width))
+
+
+def render_chart(chart):
+    """
+    Draw a chart from the output of `get_chart_data`, returning it as a
+    base64-encoded PNG
+    """
+    img = BytesIO()
+    sns.set_style("ticks")
+    fig = plt.figure(figsize=chart["figsize"])
+    ax = fig.add_subplot(111)
+    if chart["kind"] == "count":
+        sns.barplot(x=chart["labels"], y=chart["counts"], ax=ax)
+        ax.set_ylabel("count")
+        plt.xticks(rotation=45)
+    else:
+        edges = chart["edges"]
+        ax.bar(
+            edges[:-1], chart["counts"], width=np.diff(edges), align="edge", alpha=0.6
+        )
+        if np.issubdtype(edges.dtype, np.datetime64):
+            plt.xticks(rotation=45, ha="right")
+        else:
+            plt.xticks(rotation=45)
+    ax.set_xlabel(chart["name"])
     plt.savefig(img, transparent=True, bbox_inches="tight")
     img.seek(0)
     plt.close()
     return base64.b64encode(img.read()).decode("UTF-8")
 
 
+def _get_column_charts(name, series):
+    charts = {"values": get_chart_data(name, series, series.dtype)}
+    if is_datetime64_dtype(series.dtype):
+        # also do a null / not null plot
+        charts["nulls"] = get_chart_data(name, series.isnull(), bool)
+    elif is_numeric_dtype(series.dtype):
+        # also do a null / not null plot
+        charts["nulls"] = get_chart_data(name, series > 0, bool)
+    return charts
+
+
+def _render_charts(charts, processes):
+    """
+    Render each of the supplied charts (a dict of outputs of
+    `get_chart_data`), returning a dict with the same keys
+    """
+    if processes <= 1:
+        return {key: render_chart(chart) for key, chart in charts.items()}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+        return dict(zip(charts.keys(), executor.map(render_chart, charts.values())))
+
+
+def _describe(df):
+    """
+    Equivalent to `df.describe(include="all")`, except that quantiles of
+    numeric columns are estimated from a sample of DESCRIBE_SAMPLE_SIZE values
+    rather than requiring each column to be sorted
+    """
+    # A fixed seed keeps reports reproducible
+    rng = np.random.default_rng(0)
+    column_descriptives = []
+    for name, series in df.items():
+        if is_numeric_dtype(series.dtype) and not is_bool_dtype(series.dtype):
+            column_descriptives.append(_describe_numeric(series, rng))
+        else:
+            column_descriptives.append(series.describe())
+    return _combine_descriptives(column_descriptives, df.columns)
+
+
+def _combine_descriptives(column_descriptives, columns):
+    # Order rows just as pandas does
+    row_names = []
+    for index in sorted((x.index for x in column_descriptives), key=len):
+        for row_name in index:
+            if row_name not in row_names:
+                row_names.append(row_name)
+    descriptives = pandas.concat(
+        [x.reindex(row_names) for x in column_descriptives], axis=1, sort=False
+    )
+    descriptives.columns = columns.copy()
+    return descriptives
+
+
+def _describe_numeric(series, rng):
+    values = series.to_numpy(dtype="float64", na_value=np.nan)
+    values = values[~np.isnan(values)]
+    stats = [len(values)] + [np.nan] * 7
+    if len(values):
+        sample = values
+        if len(values) > DESCRIBE_SAMPLE_SIZE:
+            sample = values[rng.integers(len(values), size=DESCRIBE_SAMPLE_SIZE)]
+        stats[1:] = [
+            values.mean(),
+            values.std(ddof=1) if len(values) > 1 else np.nan,
+            values.min(),
+            *np.percentile(sample, [25, 50, 75]),
+            values.max(),
+        ]
+    return pandas.Series(
+        stats,
+        index=["count", "mean", "std", "min", "25%", "50%", "75%", "max"],
+        name=series.name,
+    )
+
+
+class ColumnSummary:
+    """
+    A summary of one column of a cohort, updated a chunk at a time in fixed
+    memory, from which its descriptives and charts can be produced as
+    `_describe` and `_get_column_charts` would produce them from the whole
+    column
+
+    Quantiles, histograms and counts of distinct values are exact for columns
+    with few distinct values and approximate otherwise (see `QuantileSketch`
+    and `TopKCounter`).
+    """
+
+    def __init__(self, name, dtype):
+        self.name = name
+        if is_categorical_dtype(dtype):
+            self.kind = "category"
+            self.categories = TopKCounter(MAX_TRACKED_CATEGORIES)
+        elif is_bool_dtype(dtype):
+            self.kind = "bool"
+            self.bool_counts = np.zeros(2, dtype="int64")
+        elif is_datetime64_dtype(dtype):
+            self.kind = "date"
+            self.sketch = QuantileSketch()
+            self.null_counts = np.zeros(2, dtype="int64")
+        elif is_numeric_dtype(dtype):
+            self.kind = "numeric"
+            self.sketch = QuantileSketch()
+            self.moments = RunningMoments()
+            self.null_count = 0
+            self.positive_counts = np.zeros(2, dtype="int64")
+        else:
+            raise ValueError(f"Unable to summarise {name} of type {dtype}")
+
+    def update(self, series):
+        if self.kind == "category":
+            self.categories.update(series.value_counts(sort=False))
+        elif self.kind == "bool":
+            self.bool_counts += np.bincount(series.to_numpy(dtype=bool), minlength=2)
+        elif self.kind == "date":
+            values = series.to_numpy()
+            nulls = np.isnat(values)
+            self.sketch.update(values[~nulls].view("int64"))
+            self.null_counts += np.bincount(nulls, minlength=2)
+        else:
+            values = series.to_numpy(dtype="float64", na_value=np.nan)
+            self.sketch.update(values)
+            self.moments.update(values)
+            self.null_count += int(np.isnan(values).sum())
+            positive = (series > 0).dropna().to_numpy(dtype=bool)
+            self.positive_counts += np.bincount(positive, minlength=2)
+
+    def describe(self):
+        if self.kind == "numeric":
+            return self._describe_numeric()
+        if self.kind == "category":
+            count = self.categories.total
+            unique = len(self.categories.counts) if self.categories.exact else np.nan
+            most_common = self.categories.most_common(1)
+        elif self.kind == "bool":
+            count = self.bool_counts.sum()
+            unique = np.count_nonzero(self.bool_counts)
+            counts = {False: self.bool_counts[0], True: self.bool_counts[1]}
+            most_common = sorted(counts.items(), key=lambda item: -item[1])[:unique]
+        else:
+            count = self.sketch.count
+            unique = len(self.sketch.means) if self.sketch.exact else np.nan
+            most_common = []
+            if self.sketch.exact and count:
+                top = np.argmax(self.sketch.weights)
+                value = int(self.sketch.means[top])
+                most_common = [(pandas.Timestamp(value), self.sketch.weights[top])]
+        stats = {
+            "count": count,
+            "unique": unique,
+            "top": most_common[0][0] if most_common else np.nan,
+            "freq": most_common[0][1] if most_common else np.nan,
+        }
+        if self.kind == "date" and self.sketch.count:
+            stats["first"] = pandas.Timestamp(int(self.sketch.min))
+            stats["last"] = pandas.Timestamp(int(self.sketch.max))
+        return pandas.Series(stats, name=self.name)
+
+    def _describe_numeric(self):
+        return pandas.Series(
+            [
+                self.moments.count,
+                self.moments.mean if self.moments.count else np.nan,
+                self.moments.std,
+                self.sketch.min,
+                *self.sketch.quantile([0.25, 0.5, 0.75]),
+                self.sketch.max,
+            ],
+            index=["count", "mean", "std", "min", "25%", "50%", "75%", "max"],
+            name=self.name,
+        )
+
+    def get_charts(self):
+        if self.kind == "category":
+            labels = sorted(self.categories.counts)
+            return {
+                "values": {
+                    "kind": "count",
+                    "name": self.name,
+                    "labels": [str(label) for label in labels],
+                    "counts": np.array([self.categories.counts[x] for x in labels]),
+                    "figsize": (4.5, 3),
+                }
+            }
+        elif self.kind == "bool":
+            chart = _get_bool_chart_data(self.name, self.bool_counts)
+            return {"values": chart, "nulls": chart}
+        elif self.kind == "date":
+            return {
+                "values": self._get_date_chart_data(),
+                "nulls": _get_bool_chart_data(self.name, self.null_counts),
+            }
+        else:
+            return {
+                "values": self._get_numeric_chart_data(),
+                "nulls": _get_bool_chart_data(self.name, self.positive_counts),
+            }
+
+    def _get_date_chart_data(self):
+        floor_date, ceiling_date = _get_date_limits()
+        means = self.sketch.means
+        sketch = self.sketch.where(
+            (means > floor_date.astype("int64"))
+            & (means <= ceiling_date.astype("int64"))
+        )
+        if sketch.count:
+            first, last = np.array([sketch.min, sketch.max]).astype("int64")
+            bins = _get_date_bins(
+                first.view("datetime64[ns]"), last.view("datetime64[ns]")
+            )
+            edges = np.histogram_bin_edges([first, last], bins=bins)
+            counts = sketch.histogram(edges)
+            edges = edges.astype("int64").view("datetime64[ns]")
+        else:
+            counts, edges = np.array([]), np.array([], dtype="datetime64[ns]")
+        return {
+            "kind": "histogram",
+            "name": self.name,
+            "counts": counts,
+            "edges": edges,
+            "figsize": (5, 2),
+        }
+
+    def _get_numeric_chart_data(self):
+        # As in `get_chart_data`, nulls are treated as zeros and then trimmed
+        # along with percentiles and negatives
+        sketch = self.sketch.copy()
+        sketch.update([0], weights=[self.null_count])
+        low, high = sketch.quantile([0.05, 0.95])
+        means = sketch.means
+        sketch = sketch.where((means < high) & (means > low) & (means > 0))
+        if sketch.count >= 2:
+            iqr = np.subtract(*sketch.quantile([0.75, 0.25]))
+            bins = _get_freedman_diaconis_bin_count(
+                sketch.count, iqr, sketch.max - sketch.min
+            )
+        else:
+            bins = 1
+        bins = min(bins, 50)
+        edges = np.histogram_bin_edges(
+            [sketch.min, sketch.max] if sketch.count else [], bins=bins
+        )
+        return {
+            "kind": "histogram",
+            "name": self.name,
+            "counts": sketch.histogram(edges),
+            "edges": edges,
+            "figsize": (5, 2),
+        }
+
+
+def _summarise_chunks(chunks):
+    """
+    Summarise a cohort supplied as an iterator of dataframes, returning a
+    dict mapping each column name to its `ColumnSummary`
+    """
+    summaries = {}
+    for df in chunks:
+        for name, series in df.items():
+            if name not in summaries:
+                summaries[name] = ColumnSummary(name, series.dtype)
+            summaries[name].update(series)
+    return summaries
+
+
 def preflight_generation_check():
     """Raise an informative error if things are not as they should be"""
     missing_paths = []
@@ -133,6 +491,10 @@ def generate_cohort(
     selected_study_name=None,
     index_date_range=None,
     skip_existing=False,
+    expectations_seed=None,
+    measures_only=False,
+    with_measures=False,
+    output_format="csv",
 ):
     preflight_generation_check()
     study_definitions = list_study_definitions()
@@ -149,6 +511,10 @@ def generate_cohort(
             expectations_population,
             index_date_range=index_date_range,
             skip_existing=skip_existing,
+            expectations_seed=expectations_seed,
+            measures_only=measures_only,
+            with_measures=with_measures,
+            output_format=output_format,
         )
 
 
@@ -159,6 +525,10 @@ def _generate_cohort(
     expectations_population,
     index_date_range=None,
     skip_existing=False,
+    expectations_seed=None,
+    measures_only=False,
+    with_measures=False,
+    output_format="csv",
 ):
     logger.info(
         f"Generating cohort for {study_name} in {output_dir}",
@@ -169,29 +539,157 @@ def _generate_cohort(
         expectations_population=expectations_population,
         index_date_range=index_date_range,
         skip_existing=skip_existing,
+        expectations_seed=expectations_seed,
+        measures_only=measures_only,
+        with_measures=with_measures,
+        output_format=output_format,
     )
 
     study = load_study_definition(study_name)
+    if measures_only or with_measures:
+        measures = _load_measures(study_name)
+        measure_outputs = defaultdict(list)
 
     os.makedirs(output_dir, exist_ok=True)
-    for index_date in _generate_date_range(index_date_range):
+    index_dates = _generate_date_range(index_date_range)
+    for index_date in index_dates:
         if index_date is not None:
             logger.info(f"Setting index_date to {index_date}")
             study.set_index_date(index_date)
             date_suffix = f"_{index_date}"
         else:
             date_suffix = ""
-        # If this is changed then the glob pattern in `_generate_measures()`
+        if measures_only or with_measures:
+            measure_files = {
+                measure.id: f"{output_dir}/measure_{measure.id}{date_suffix}.csv"
+                for measure in measures
+            }
+            for measure_id, measure_file in measure_files.items():
+                measure_outputs[measure_id].append(measure_file)
+        if measures_only:
+            _generate_measures_only(
+                study,
+                measures,
+                measure_files,
+                expectations_population,
+                skip_existing=skip_existing,
+                expectations_seed=expectations_seed,
+            )
+            continue
+        # If this is changed then the glob patterns in `_generate_measures()`
         # must be updated
-        output_file = f"{output_dir}/input{suffix}{date_suffix}.csv"
+        if output_format == "parquet":
+            # A single dataset partitioned by index date
+            output_file = (
+                f"{output_dir}/input{suffix}.parquet/"
+                f"index_date={index_date}/data.parquet"
+            )
+            # The intermediate CSV lives outside the dataset directory so that
+            # readers of the dataset never see it, even if we crash mid-write
+            csv_file = f"{output_dir}/.input{suffix}_{index_date}.csv"
+            os.makedirs(os.path.dirname(output_file), exist_ok=True)
+        else:
+            output_file = csv_file = f"{output_dir}/input{suffix}{date_suffix}.csv"
         if skip_existing and os.path.exists(output_file):
             logger.info(f"Not regenerating pre-existing file at {output_file}")
-        else:
+            if with_measures:
+                _write_measures_from_file(
+                    output_file, measures, measure_files, skip_existing=True
+                )
+            continue
+        try:
+            if with_measures and not expectations_population:
+                # Calculate the measures from the rows as they're downloaded
+                # rather than re-reading the file afterwards
+                aggregators = [MeasureAggregator(measure) for measure in measures]
+                study.to_csv(csv_file, sinks=aggregators)
+                for aggregator in aggregators:
+                    measure_file = measure_files[aggregator.measure.id]
+                    aggregator.to_csv(measure_file)
+                    logger.info(f"Created measure output at {measure_file}")
+            else:
+                study.to_csv(
+                    csv_file,
+                    expectations_population=expectations_population,
+                    expectations_seed=expectations_seed,
+                )
+                if with_measures:
+                    _write_measures_from_file(csv_file, measures, measure_files)
+            if csv_file != output_file:
+                csv_to_parquet(csv_file, output_file)
+        finally:
+            if csv_file != output_file and os.path.exists(csv_file):
+                os.unlink(csv_file)
+        logger.info(f"Successfully created cohort and covariates at {output_file}")
+    if (measures_only or with_measures) and index_dates != [None]:
+        for measure in measures:
+            output_file = f"{output_dir}/measure_{measure.id}.csv"
+            _combine_csv_files_with_dates(output_file, measure_outputs[measure.id])
+            logger.info(f"Combined measure output for all dates in {output_file}")
+
+
+def _generate_measures_only(
+    study,
+    measures,
+    output_files,
+    expectations_population,
+    skip_existing=False,
+    expectations_seed=None,
+):
+    """
+    Write each measure's results to the file given for its ID in
+    `output_files`, without writing the patient-level data
+
+    Against a real database the aggregation is done by the database itself, so
+    only the aggregated rows are downloaded. For dummy data there's no
+    database, so we aggregate the generated rows locally in exactly the way
+    `generate_measures` would.
+    """
+    if skip_existing:
+        measures = [
+            measure
+            for measure in measures
+            if not os.path.exists(output_files[measure.id])
+        ]
+        if not measures:
+            logger.info("Not regenerating pre-existing measure files")
+            return
+    output_files = {measure.id: output_files[measure.id] for measure in measures}
+    if expectations_population:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            patient_file = os.path.join(tmpdir, "input.csv")
             study.to_csv(
-                output_file,
+                patient_file,
                 expectations_population=expectations_population,
+                expectations_seed=expectations_seed,
             )
-            logger.info(f"Successfully created cohort and covariates at {output_file}")
+            _write_measures_from_file(patient_file, measures, output_files)
+    else:
+        study.to_measure_csvs(measures, output_files)
+        for output_file in output_files.values():
+            logger.info(f"Created measure output at {output_file}")
+
+
+def _write_measures_from_file(
+    patient_file, measures, output_files, skip_existing=False
+):
+    """
+    Calculate each measure from the patient-level data in `patient_file`,
+    writing its results to the file given for its ID in `output_files`
+    """
+    if skip_existing:
+        measures = [
+            measure
+            for measure in measures
+            if not os.path.exists(output_files[measure.id])
+        ]
+        if not measures:
+            return
+    patient_df = _load_input_for_measures(patient_file, measures)
+    measure_dfs = _calculate_measure_dfs(patient_df, measures)
+    for measure in measures:
+        measure_dfs[measure.id].to_csv(output_files[measure.id], index=False)
+        logger.info(f"Created measure output at {output_files[measure.id]}")
 
 
 def _generate_date_range(date_range_str):
@@ -255,7 +753,13 @@ def _increment_date(date, period):
         raise ValueError(f"Unknown time period '{period}'")
 
 
-def generate_measures(output_dir, selected_study_name=None, skip_existing=False):
+def generate_measures(
+    output_dir,
+    selected_study_name=None,
+    skip_existing=False,
+    processes=1,
+    max_memory_bytes=None,
+):
     preflight_generation_check()
     study_definitions = list_study_definitions()
     if selected_study_name and selected_study_name != "all":
@@ -264,34 +768,49 @@ def generate_measures(output_dir, selected_study_name=None, skip_existing=False)
                 study_definitions = [(study_name, suffix)]
                 break
     for study_name, suffix in study_definitions:
-        _generate_measures(output_dir, study_name, suffix, skip_existing=skip_existing)
+        _generate_measures(
+            output_dir,
+            study_name,
+            suffix,
+            skip_existing=skip_existing,
+            processes=processes,
+            max_memory_bytes=max_memory_bytes,
+        )
 
 
-def _generate_measures(output_dir, study_name, suffix, skip_existing=False):
+def _generate_measures(
+    output_dir,
+    study_name,
+    suffix,
+    skip_existing=False,
+    processes=1,
+    max_memory_bytes=None,
+):
     logger.info(
         "Generating measure for {study_name} in {output_dir}",
     )
-    logger.debug("args", suffix=suffix, skip_existing=skip_existing)
-    measures = load_study_definition(study_name, value="measures")
-    measure_outputs = defaultdict(list)
-    for file in glob.glob(f"{output_dir}/input{suffix}*.csv"):
+    logger.debug(
+        "args",
+        suffix=suffix,
+        skip_existing=skip_existing,
+        processes=processes,
+        max_memory_bytes=max_memory_bytes,
+    )
+    measures = _load_measures(study_name)
+    files = {}
+    for file in sorted(
+        glob.glob(f"{output_dir}/input{suffix}*.csv")
+        + glob.glob(f"{output_dir}/input{suffix}.parquet/index_date=*/data.parquet")
+    ):
         date = _get_date_from_filename(file)
-        if date is None:
-            continue
-        patient_df = None
-        for measure in measures:
-            output_file = f"{output_dir}/measure_{measure.id}_{date}.csv"
-            measure_outputs[measure.id].append(output_file)
-            if skip_existing and os.path.exists(output_file):
-                logger.info(f"Not generating pre-existing file {output_file}")
-                continue
-            # We do this lazily so that if all corresponding output files
-            # already exist we can avoid loading the patient data entirely
-            if patient_df is None:
-                patient_df = _load_csv_for_measures(file, measures)
-            measure_df = _calculate_measure_df(patient_df, measure)
-            measure_df.to_csv(output_file, index=False)
-            logger.info(f"Created measure output at {output_file}")
+        if date is not None:
+            files[file] = date
+    measure_outputs = defaultdict(list)
+    for outputs in _calculate_measures_for_files(
+        files, measures, output_dir, skip_existing, processes, max_memory_bytes
+    ):
+        for measure_id, output_file in outputs:
+            measure_outputs[measure_id].append(output_file)
     if not measure_outputs:
         logger.warn(
             "No matching output files found. You may need to first run:\n"
@@ -304,30 +823,263 @@ def _generate_measures(output_dir, study_name, suffix, skip_existing=False):
         logger.info(f"Combined measure output for all dates in {output_file}")
 
 
-def _calculate_measure_df(patient_df, measure):
-    if measure.group_by:
-        measure_df = patient_df[
-            [measure.numerator, measure.denominator, *measure.group_by]
-        ]
-        measure_df = measure_df.groupby(measure.group_by).sum()
-        measure_df = measure_df.reset_index()
-    else:
-        measure_df = patient_df[[measure.numerator, measure.denominator]]
-    measure_df["value"] = (
-        measure_df[measure.numerator] / measure_df[measure.denominator]
+def _calculate_measures_for_files(
+    files, measures, output_dir, skip_existing, processes, max_memory_bytes
+):
+    """
+    Calculate measures for each of the supplied input files (a dict mapping
+    filenames to dates), yielding the outputs for each file as returned by
+    `_calculate_measures_for_file`
+
+    With more than one process, files are handled concurrently by a pool of
+    worker processes. If `max_memory_bytes` is set we limit the total size of
+    the files being processed at any one time. The size of a CSV file is only
+    a rough proxy for the memory needed to load it, but it's one which we can
+    know in advance. A single file is always allowed to run, however large.
+    """
+    if processes <= 1:
+        for file, date in files.items():
+            yield _calculate_measures_for_file(
+                file, date, measures, output_dir, skip_existing
+            )
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+        running = {}
+        for file, date in files.items():
+            size = os.path.getsize(file)
+            while running and (
+                len(running) >= processes
+                or (
+                    max_memory_bytes is not None
+                    and sum(running.values()) + size > max_memory_bytes
+                )
+            ):
+                done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    del running[future]
+                    yield future.result()
+            future = executor.submit(
+                _calculate_measures_for_file,
+                file,
+                date,
+                measures,
+                output_dir,
+                skip_existing,
+            )
+            running[future] = size
+        for future in concurrent.futures.as_completed(running):
+            yield future.result()
+
+
+def _calculate_measures_for_file(file, date, measures, output_dir, skip_existing):
+    """
+    Calculate each measure for a single input file, returning a list of
+    (measure ID, output filename) pairs
+    """
+    outputs = []
+    measures_to_calculate = []
+    for measure in measures:
+        output_file = f"{output_dir}/measure_{measure.id}_{date}.csv"
+        outputs.append((measure.id, output_file))
+        if skip_existing and os.path.exists(output_file):
+            logger.info(f"Not generating pre-existing file {output_file}")
+            continue
+        measures_to_calculate.append((measure, output_file))
+    # If all corresponding output files already exist we can avoid loading the
+    # patient data entirely
+    if not measures_to_calculate:
+        return outputs
+    patient_df = _load_input_for_measures(file, measures)
+    measure_dfs = _calculate_measure_dfs(
+        patient_df, [measure for (measure, _) in measures_to_calculate]
+    )
+    for measure, output_file in measures_to_calculate:
+        measure_dfs[measure.id].to_csv(output_file, index=False)
+        logger.info(f"Created measure output at {output_file}")
+    return outputs
+
+
+def _calculate_measure_dfs(patient_df, measures):
+    """
+    Calculate each of the supplied measures, returning a dict mapping measure
+    IDs to dataframes
+
+    Measures which share a grouping are calculated together: we compute the
+    group of each patient just once and then sum all the numerators and
+    denominators needed in a single pass per column.
+
+    Where one grouping's columns are a subset of another's (as with the
+    grouping sets of a single measure) we calculate the finer grouping first
+    and then roll its (much smaller) results up into the coarser one, rather
+    than aggregating the patient data again.
+    """
+    measures_by_group = defaultdict(list)
+    for measure in measures:
+        measures_by_group[tuple(measure.group_by)].append(measure)
+    # The special "population" column is 1 for every patient, but not in the
+    # aggregated results, so those groupings must come from the patient data
+    rollup_groups = [
+        group_by
+        for group_by in measures_by_group
+        if group_by and "population" not in group_by
+    ]
+    # Each grouping must sum the columns needed by any grouping rolled up
+    # from it
+    columns_by_group = {}
+    for group_by, group_measures in measures_by_group.items():
+        if group_by in rollup_groups:
+            group_measures = [
+                measure
+                for other_group_by in rollup_groups
+                if set(other_group_by) <= set(group_by)
+                for measure in measures_by_group[other_group_by]
+            ]
+        columns = []
+        for measure in group_measures:
+            for column in [measure.numerator, measure.denominator]:
+                if column not in columns:
+                    columns.append(column)
+        columns_by_group[group_by] = columns
+    grouped_dfs = {}
+    measure_dfs = {}
+    # Finer groupings first, so that coarser ones can be rolled up from them
+    for group_by in sorted(measures_by_group, key=len, reverse=True):
+        group_measures = measures_by_group[group_by]
+        if group_by:
+            source_df = patient_df
+            if group_by in rollup_groups:
+                for finer_group_by in rollup_groups:
+                    finer_df = grouped_dfs.get(finer_group_by)
+                    if finer_df is not None and _can_roll_up(
+                        patient_df, group_by, finer_group_by
+                    ):
+                        source_df = finer_df
+                        break
+            grouped_df = _sum_by_group(
+                source_df, list(group_by), columns_by_group[group_by]
+            )
+            grouped_dfs[group_by] = grouped_df
+        for measure in group_measures:
+            if group_by:
+                measure_df = grouped_df[
+                    [*group_by, measure.numerator, measure.denominator]
+                ].copy()
+            else:
+                measure_df = patient_df[[measure.numerator, measure.denominator]]
+            measure_df["value"] = (
+                measure_df[measure.numerator] / measure_df[measure.denominator]
+            )
+            measure_dfs[measure.id] = measure_df
+    return measure_dfs
+
+
+def _can_roll_up(patient_df, group_by, finer_group_by):
+    """
+    Return whether grouping the results for `finer_group_by` by `group_by`
+    gives exactly the same results as grouping the patient data by `group_by`
+    """
+    if not set(group_by) < set(finer_group_by):
+        return False
+    # Rows with missing values in the columns we'd be rolling up over will
+    # have been excluded from the finer grouping
+    for column in set(finer_group_by) - set(group_by):
+        if patient_df[column].isnull().any():
+            return False
+    # If any of the finer grouping's columns are categorical its results
+    # include every combination of values. That's fine if the coarser
+    # grouping will also include every combination (because it has a
+    # categorical column) or has only one column, but otherwise it would gain
+    # combinations which never occur
+    is_categorical = {
+        column: is_categorical_dtype(patient_df[column].dtype)
+        for column in finer_group_by
+    }
+    return (
+        not any(is_categorical.values())
+        or any(is_categorical[column] for column in group_by)
+        or len(group_by) == 1
     )
-    return measure_df
+
+
+def _sum_by_group(df, group_by, columns):
+    """
+    Equivalent to `df[group_by + columns].groupby(group_by).sum().reset_index()`
+    but much faster when summing many columns over a large number of groups
+
+    We turn each combination of values in the `group_by` columns into a single
+    integer code and then sum each of the `columns` with `np.bincount`. As with
+    pandas, if any grouping column is categorical the result includes every
+    combination of values (with each categorical column contributing all its
+    categories), otherwise just those combinations which occur.
+    """
+    codes = []
+    levels = []
+    any_categorical = False
+    for column in group_by:
+        series = df[column]
+        if is_categorical_dtype(series.dtype):
+            any_categorical = True
+            codes.append(series.cat.codes.to_numpy())
+            # Keeping the column categorical means a result grouped by it can
+            # itself be grouped again (see `_calculate_measure_dfs`)
+            levels.append(
+                pandas.CategoricalIndex(series.cat.categories, dtype=series.dtype)
+            )
+        else:
+            column_codes, uniques = pandas.factorize(series, sort=True)
+            codes.append(column_codes)
+            levels.append(uniques)
+    # Rows with a missing value in any grouping column are excluded
+    has_group = np.logical_and.reduce([column_codes >= 0 for column_codes in codes])
+    all_grouped = has_group.all()
+    shape = tuple(len(level) for level in levels)
+    if not all_grouped:
+        codes = [column_codes[has_group] for column_codes in codes]
+    group_codes = np.ravel_multi_index(codes, shape)
+    if any_categorical:
+        groups = np.arange(np.prod(shape, dtype="int64"))
+    else:
+        groups, group_codes = np.unique(group_codes, return_inverse=True)
+    result = {
+        column: level.take(level_codes)
+        for column, level, level_codes in zip(
+            group_by, levels, np.unravel_index(groups, shape)
+        )
+    }
+    for column in columns:
+        values = df[column].to_numpy()
+        if not all_grouped:
+            values = values[has_group]
+        # Like pandas, we treat missing values as zero
+        if np.issubdtype(values.dtype, np.floating):
+            missing = np.isnan(values)
+            if missing.any():
+                values = np.where(missing, 0, values)
+        sums = np.bincount(group_codes, weights=values, minlength=len(groups))
+        # `bincount` always sums as floats but integer columns (such as the
+        # special "population" column) should keep their type
+        if np.issubdtype(values.dtype, np.integer):
+            sums = sums.astype(values.dtype)
+        result[column] = sums
+    return pandas.DataFrame(result)
 
 
 def _get_date_from_filename(filename):
-    match = re.search(r"_(\d\d\d\d\-\d\d\-\d\d)\.csv$", filename)
+    # Dates appear either in the filename itself or, for partitioned Parquet
+    # datasets, in the name of the partition's directory
+    match = re.search(r"_(\d\d\d\d\-\d\d\-\d\d)\.csv$", filename) or re.search(
+        r"index_date=(\d\d\d\d\-\d\d\-\d\d)/[^/]+\.parquet$", filename
+    )
     return datetime.date.fromisoformat(match.group(1)) if match else None
 
 
-def _load_csv_for_measures(file, measures):
+def _load_input_for_measures(file, measures):
     """
-    Given a CSV file name and a list of measures, load the file into a Pandas
-    dataframe with types as appropriate for the supplied measures
+    Given the name of a CSV file (or a Parquet file from a partitioned dataset)
+    and a list of measures, load the file into a Pandas dataframe with types
+    as appropriate for the supplied measures
     """
     numeric_columns = set()
     group_by_columns = set()
@@ -340,9 +1092,14 @@ def _load_csv_for_measures(file, measures):
     dtype = {col: "category" for col in group_by_columns}
     for col in numeric_columns:
         dtype[col] = "float64"
-    df = pandas.read_csv(
-        file, dtype=dtype, usecols=list(dtype.keys()), keep_default_na=False
-    )
+    if str(file).endswith(".parquet"):
+        # Values are stored as strings, just as they are in the CSV (see
+        # `csv_to_parquet`), and we only need to read the columns we use
+        df = pandas.read_parquet(file, columns=list(dtype.keys())).astype(dtype)
+    else:
+        df = pandas.read_csv(
+            file, dtype=dtype, usecols=list(dtype.keys()), keep_default_na=False
+        )
     df["population"] = 1
     return df
 
@@ -372,40 +1129,60 @@ def _combine_csv_files_with_dates(filename, input_files):
                     writer.writerow(row + [date])
 
 
-def make_cohort_report(input_dir, output_dir):
+def make_cohort_report(input_dir, output_dir, processes=1, chunk_size=None):
     for study_name, suffix in list_study_definitions():
-        _make_cohort_report(input_dir, output_dir, study_name, suffix)
+        _make_cohort_report(
+            input_dir,
+            output_dir,
+            study_name,
+            suffix,
+            processes=processes,
+            chunk_size=chunk_size,
+        )
 
 
-def _make_cohort_report(input_dir, output_dir, study_name, suffix):
+def _make_cohort_report(
+    input_dir, output_dir, study_name, suffix, processes=1, chunk_size=None
+):
     study = load_study_definition(study_name)
 
-    df = study.csv_to_df(f"{input_dir}/input{suffix}.csv")
-    descriptives = df.describe(include="all")
-
-    for name, dtype in zip(df.columns, df.dtypes):
+    input_file = f"{input_dir}/input{suffix}.csv"
+    if chunk_size:
+        summaries = _summarise_chunks(study.csv_to_df(input_file, chunksize=chunk_size))
+        descriptives = _combine_descriptives(
+            [summary.describe() for summary in summaries.values()],
+            pandas.Index(summaries.keys()),
+        )
+        column_charts = {
+            name: summary.get_charts()
+            for name, summary in summaries.items()
+            if name != "patient_id"
+        }
+    else:
+        df = study.csv_to_df(input_file)
+        descriptives = _describe(df)
+        column_charts = {
+            name: _get_column_charts(name, series)
+            for name, series in df.items()
+            if name != "patient_id"
+        }
+
+    charts = {}
+    for name, rows in column_charts.items():
+        for row, chart in rows.items():
+            charts[name, row] = chart
+    images = _render_charts(charts, processes)
+
+    for name in descriptives.columns:
         if name == "patient_id":
             continue
-        main_chart = '<div><img src="data:image/png;base64,{}"/></div>'.format(
-            make_chart(name, df[name], dtype)
-        )
-        empty_values_chart = ""
-        if is_datetime64_dtype(dtype):
-            # also do a null / not null plot
-            empty_values_chart = (
-                '<div><img src="data:image/png;base64,{}"/></div>'.format(
-                    make_chart(name, df[name].isnull(), bool)
-                )
-            )
-        elif is_numeric_dtype(dtype):
-            # also do a null / not null plot
-            empty_values_chart = (
-                '<div><img src="data:image/png;base64,{}"/></div>'.format(
-                    make_chart(name, df[name] > 0, bool)
-                )
+        for row in ["values", "nulls"]:
+            image = images.get((name, row))
+            descriptives.loc[row, name] = (
+                f'<div><img src="data:image/png;base64,{image}"/></div>'
+                if image is not None
+                else ""
             )
-        descriptives.loc["values", name] = main_chart
-        descriptives.loc["nulls", name] = empty_values_chart
 
     with open(f"{output_dir}/descriptives{suffix}.html", "w") as f:
 
@@ -472,6 +1249,25 @@ def update_codelists():
                 f.write(rsp.content)
 
 
+def profile_cohort(output_dir, selected_study_name=None):
+    """Compare aggregate statistics of each study's columns, calculated in the
+    database, with their expectations
+    """
+    preflight_generation_check()
+    study_definitions = list_study_definitions()
+    if selected_study_name and selected_study_name != "all":
+        for study_name, suffix in study_definitions:
+            if study_name == selected_study_name:
+                study_definitions = [(study_name, suffix)]
+                break
+    os.makedirs(output_dir, exist_ok=True)
+    for study_name, suffix in study_definitions:
+        study = load_study_definition(study_name)
+        filename = os.path.join(output_dir, f"profile{suffix}.csv")
+        study.to_profile_csv(filename)
+        logger.info(f"Created profile at {filename}")
+
+
 def dump_cohort_sql(study_definition):
     study = load_study_definition(study_definition)
     print(study.to_sql())
@@ -489,6 +1285,15 @@ def load_study_definition(name, value="study"):
     return getattr(importlib.import_module(name), value)
 
 
+def _load_measures(study_name):
+    """
+    Load the measures defined alongside the named study, with any which have
+    grouping sets expanded into one measure per grouping
+    """
+    measures = load_study_definition(study_name, value="measures")
+    return [expanded for measure in measures for expanded in measure.expand()]
+
+
 def list_study_definitions(ignore_errors=False):
     pattern = re.compile(r"^(study_definition(_\w+)?)\.py$")
     matches = []
@@ -586,6 +1391,21 @@ def main():
         type=str,
         default="output",
     )
+    cohort_report_parser.add_argument(
+        "--processes",
+        help="Number of processes to use for rendering charts",
+        type=int,
+        default=1,
+    )
+    cohort_report_parser.add_argument(
+        "--chunk-size",
+        help=(
+            "Read the input this many rows at a time, so that memory use doesn't "
+            "depend on its size (quantiles, histograms and counts of distinct "
+            "values are then approximate for columns with many distinct values)"
+        ),
+        type=int,
+    )
 
     update_codelists_parser = subparsers.add_parser(
         "update_codelists",
@@ -606,6 +1426,60 @@ def main():
     dump_study_yaml_parser.add_argument(
         "--study-definition", help="Study definition name", type=str, required=True
     )
+    profile_parser = subparsers.add_parser(
+        "profile",
+        help="Compare aggregate statistics of each column in the database with its expectations",
+    )
+    profile_parser.set_defaults(which="profile")
+    profile_parser.add_argument(
+        "--output-dir",
+        help="Location to store output CSVs",
+        type=str,
+        default="output",
+    )
+    profile_parser.add_argument(
+        "--study-definition",
+        help="Study definition to use",
+        type=str,
+        choices=["all"] + [x[0] for x in list_study_definitions(ignore_errors=True)],
+        default="all",
+    )
+    profile_parser.add_argument(
+        "--database-url",
+        help="Database URL to query (can be supplied as DATABASE_URL environment variable)",
+        type=str,
+        default=os.environ.get("DATABASE_URL"),
+    )
+    cleanup_temp_tables_parser = subparsers.add_parser(
+        "cleanup_temp_tables",
+        help="Drop old temporary and output tables created in the EMIS backend",
+    )
+    cleanup_temp_tables_parser.set_defaults(which="cleanup_temp_tables")
+    cleanup_temp_tables_parser.add_argument(
+        "--database-url",
+        help="Database URL to clean up (can be supplied as DATABASE_URL environment variable)",
+        type=str,
+        default=os.environ.get("DATABASE_URL"),
+    )
+    cleanup_temp_tables_parser.add_argument(
+        "--temporary-database",
+        help=(
+            "Database holding the output tables to clean up (can be supplied as "
+            "TEMP_DATABASE_NAME environment variable)"
+        ),
+        type=str,
+        default=os.environ.get("TEMP_DATABASE_NAME"),
+    )
+    cleanup_temp_tables_parser.add_argument(
+        "--max-age-days",
+        help="Drop tables created against data more than this many days old",
+        type=int,
+    )
+    cleanup_temp_tables_parser.add_argument(
+        "--max-size-gb",
+        help="Drop the oldest tables until the rest take up less than this",
+        type=float,
+    )
 
     # Cohort parser options
     generate_cohort_parser.add_argument(
@@ -638,6 +1512,37 @@ def main():
         help="Do not regenerate data if output file already exists",
         action="store_true",
     )
+    generate_cohort_parser.add_argument(
+        "--expectations-seed",
+        help="Seed for the random number generator used with --expectations-population",
+        type=int,
+        default=None,
+    )
+    generate_cohort_parser.add_argument(
+        "--measures-only",
+        help=(
+            "Calculate the study's measures directly, writing only the "
+            "aggregated measure files rather than the patient-level data"
+        ),
+        action="store_true",
+    )
+    generate_cohort_parser.add_argument(
+        "--output-format",
+        help=(
+            "Format of the patient-level output. With 'parquet' all index dates "
+            "are written to a single dataset, partitioned by index date"
+        ),
+        choices=["csv", "parquet"],
+        default="csv",
+    )
+    generate_cohort_parser.add_argument(
+        "--with-measures",
+        help=(
+            "Also calculate the study's measures, from the same pass over the "
+            "data that writes the patient-level files"
+        ),
+        action="store_true",
+    )
     cohort_method_group = generate_cohort_parser.add_mutually_exclusive_group()
     cohort_method_group.add_argument(
         "--expectations-population",
@@ -670,6 +1575,20 @@ def main():
         help="Do not regenerate measure if output file already exists",
         action="store_true",
     )
+    generate_measures_parser.add_argument(
+        "--processes",
+        help="Number of input files to process concurrently",
+        type=int,
+        default=1,
+    )
+    generate_measures_parser.add_argument(
+        "--max-memory-gb",
+        help=(
+            "Limit the total size of the input files being processed at once "
+            "(only applies with --processes)"
+        ),
+        type=float,
+    )
 
     options = parser.parse_args()
     if getattr(options, "force_run_dependencies", False) and not getattr(
@@ -690,18 +1609,35 @@ def main():
                 "generate_cohort: error: one of the arguments "
                 "--expectations-population --database-url is required"
             )
+        if options.output_format == "parquet":
+            if not options.index_date_range:
+                parser.error(
+                    "generate_cohort: error: --output-format parquet requires "
+                    "--index-date-range"
+                )
+            # Fail now rather than after the first extraction has finished
+            import_pyarrow()
         generate_cohort(
             options.output_dir,
             options.expectations_population,
             selected_study_name=options.study_definition,
             index_date_range=options.index_date_range,
             skip_existing=options.skip_existing,
+            expectations_seed=options.expectations_seed,
+            measures_only=options.measures_only,
+            with_measures=options.with_measures,
+            output_format=options.output_format,
         )
     elif options.which == "generate_measures":
+        max_memory_bytes = None
+        if options.max_memory_gb is not None:
+            max_memory_bytes = int(options.max_memory_gb * 1024 ** 3)
         generate_measures(
             options.output_dir,
             selected_study_name=options.study_definition,
             skip_existing=options.skip_existing,
+            processes=options.processes,
+            max_memory_bytes=max_memory_bytes,
         )
     elif options.which == "run":
         log_level = options.verbose and logging.DEBUG or logging.ERROR
@@ -730,7 +1666,12 @@ def main():
             print("Nothing to do")
 
     elif options.which == "cohort_report":
-        make_cohort_report(options.input_dir, options.output_dir)
+        make_cohort_report(
+            options.input_dir,
+            options.output_dir,
+            processes=options.processes,
+            chunk_size=options.chunk_size,
+        )
     elif options.which == "update_codelists":
         update_codelists()
         print("Codelists updated. Don't forget to commit them to the repo")
@@ -738,6 +1679,30 @@ def main():
         dump_cohort_sql(options.study_definition)
     elif options.which == "dump_study_yaml":
         dump_study_yaml(options.study_definition)
+    elif options.which == "profile":
+        if not options.database_url:
+            parser.error("profile: error: the argument --database-url is required")
+        os.environ["DATABASE_URL"] = options.database_url
+        profile_cohort(options.output_dir, selected_study_name=options.study_definition)
+    elif options.which == "cleanup_temp_tables":
+        if not options.database_url:
+            parser.error(
+                "cleanup_temp_tables: error: the argument --database-url is required"
+            )
+        # Imported here as the EMIS backend's dependencies aren't available
+        # everywhere (e.g. `readline` on Windows)
+        from cohortextractor.emis_backend import cleanup_temp_tables
+
+        max_size_bytes = None
+        if options.max_size_gb is not None:
+            max_size_bytes = int(options.max_size_gb * 1024 ** 3)
+        dropped = cleanup_temp_tables(
+            options.database_url,
+            temporary_database=options.temporary_database,
+            max_age_days=options.max_age_days,
+            max_size_bytes=max_size_bytes,
+        )
+        print(f"Dropped {len(dropped)} tables")
 
 
 if __name__ == "__main__":
@@ -2,6 +2,8 @@ import datetime
 import itertools
 from collections import defaultdict
 
+from cohortextractor.join_utils import LeftJoinSortedRows
+
 
 def add_patient_vaccination_dates(patients, vaccination_events, washout_period=0):
     patients_vaccinations = get_patient_vaccination_dates(
@@ -83,42 +85,3 @@ def group_vaccination_events_by_patient(vaccination_events):
             date_given = datetime.date.fromisoformat(row["date_given"])
             vaccine_dates[vaccine_name].append(date_given)
         yield patient_id, vaccine_dates.items()
-
-
-class LeftJoinSortedRows:
-    """
-    Left join two iterators of dictionaries on the supplied key field
-
-    Assumes that both iterators are already sorted by key
-    """
-
-    def __init__(self, left_rows, right_rows, on="id"):
-        self.left_iter = iter(left_rows)
-        self.right_iter = iter(right_rows)
-        self.get_key = lambda item: int(item[on])
-        self.right_item = next(self.right_iter, None)
-
-    def __iter__(self):
-        return self
-
-    def __next__(self):
-        left_item = next(self.left_iter)
-        left_key = self.get_key(left_item)
-        right_item = self.next_right_item(left_key)
-        return left_item, right_item
-
-    def next_right_item(self, left_key):
-        while True:
-            # No more right items remaining: return None
-            if self.right_item is None:
-                return
-            right_key = self.get_key(self.right_item)
-            # Keys match: this is the item we want
-            if right_key == left_key:
-                return self.right_item
-            # Right key is greater: return None until left catches up
-            elif right_key > left_key:
-                return
-            # Right key is lesser: grab the next right item and try again
-            else:
-                self.right_item = next(self.right_iter, None)
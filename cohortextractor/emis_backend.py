@@ -1,14 +1,20 @@
+import concurrent.futures
 import csv
 import datetime
+import hashlib
 import os
 import re
-import uuid
+import threading
 
 import structlog
 
 from .codelistlib import codelist
 from .expressions import format_expression
-from .presto_utils import presto_connection_from_url
+from .presto_utils import (
+    QUERY_STATS_FIELDS,
+    presto_connection_from_url,
+    presto_table_to_csv,
+)
 
 logger = structlog.get_logger()
 
@@ -25,6 +31,15 @@ ICNARC_TABLE = "icnarc_view"
 ONS_TABLE = "ons_view"
 CPNS_TABLE = "cpns_view"
 
+# Codelists longer than this are uploaded in chunks (see `create_codelist_table`)
+CODELIST_CHUNK_SIZE = 5000
+
+CREATE_TABLE_RE = re.compile(r"CREATE TABLE IF NOT EXISTS (\S+)")
+# Matches the names of the temporary and output tables we create, capturing the
+# date they were created (see `get_data_version`). This also matches tables
+# created with the older timestamp-based names.
+TEMP_TABLE_DATE_RE = re.compile(r"^(?:_|output_)(\d{8})_", re.IGNORECASE)
+
 
 class EMISBackend:
     _db_connection = None
@@ -35,6 +50,16 @@ class EMISBackend:
         self.covariate_definitions = covariate_definitions
         self.postprocess_covariate_definitions()
         self.codelist_tables = []
+        self.temp_table_names = {}
+        self.max_concurrent_queries = int(
+            os.environ.get("PRESTO_CONCURRENT_QUERIES", 4)
+        )
+        self.download_shards = int(os.environ.get("PRESTO_DOWNLOAD_SHARDS", 1))
+        # Maps each query name to the statistics Presto reported for it
+        self.query_stats = {}
+        # Fixed for the lifetime of the backend so that a run which crosses
+        # midnight labels its temporary and output tables consistently
+        self.data_version = get_data_version()
         self.temp_table_prefix = self.get_temp_table_prefix()
         self.queries = self.get_queries(self.covariate_definitions)
         logger.info(
@@ -50,15 +75,31 @@ class EMISBackend:
             if query_args.get("returning") == "pseudo_id":
                 query_args["column_type"] = "str"
 
-    def to_csv(self, filename):
-        result = self.execute_query()
+    def to_csv(self, filename, sinks=()):
+        """
+        Write the study's output to `filename`, passing each row to any
+        `sinks` as it's written (see `presto_table_to_csv`)
+        """
+        output_table = self.create_output_table()
+        if output_table:
+            self.download_output_table(output_table, filename, sinks)
+            self.report_query_stats()
+            return
+        result = self.execute_final_query()
         unique_check = UniqueCheck()
         with open(filename, "w", newline="") as csvfile:
             writer = csv.writer(csvfile)
-            writer.writerow([x[0] for x in result.description])
+            headers = [x[0] for x in result.description]
+            writer.writerow(headers)
+            for sink in sinks:
+                sink.start(headers)
             for row in result:
                 unique_check.add(row[0])
                 writer.writerow(row)
+                for sink in sinks:
+                    sink.add_row(row)
+        self.query_stats["final_output"] = result.query_stats
+        self.report_query_stats()
         unique_check.assert_unique_ids()
 
     def to_dicts(self):
@@ -66,12 +107,38 @@ class EMISBackend:
         keys = [x[0] for x in result.description]
         # Convert all values to str as that's what will end in the CSV
         output = [dict(zip(keys, map(str, row))) for row in result]
+        if "final_output" not in self.query_stats:
+            self.query_stats["final_output"] = result.query_stats
+        self.report_query_stats()
         unique_check = UniqueCheck()
         for item in output:
             unique_check.add(item["patient_id"])
         unique_check.assert_unique_ids()
         return output
 
+    def report_query_stats(self):
+        """
+        Log the cost of each query, most memory-hungry first, and write them to
+        the CSV file named by QUERY_STATS_REPORT (if set)
+        """
+        # Some drivers (and queries) don't supply all stats
+        def peak_memory(item):
+            return item[1].get("peak_memory_bytes") or 0
+
+        stats = sorted(self.query_stats.items(), key=peak_memory, reverse=True)
+        for name, query_stats in stats:
+            logger.info(f"Query stats for {name}", **query_stats)
+        report_file = os.environ.get("QUERY_STATS_REPORT")
+        if not report_file:
+            return
+        with open(report_file, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["column", *QUERY_STATS_FIELDS])
+            for name, query_stats in stats:
+                writer.writerow(
+                    [name, *(query_stats.get(field) for field in QUERY_STATS_FIELDS)]
+                )
+
     def to_sql(self):
         """
         Generate a single SQL string.
@@ -124,7 +191,7 @@ class EMISBackend:
             else:
                 date_format_args = pop_keys_from_dict(query_args, ["date_format"])
                 cols, sql = self.get_query(name, query_type, query_args)
-                table_name = self.make_temp_table_name(name)
+                table_name = self.make_temp_table_name(name, sql)
                 table_queries[
                     name
                 ] = f"CREATE TABLE IF NOT EXISTS {table_name} AS {sql}"
@@ -151,10 +218,13 @@ class EMISBackend:
         )
         output_columns_str += f",\n          {primary_table}.hashed_organisation"
         joins = []
+        joined_tables = {primary_table}
         for name in table_queries:
-            if name == "population":
-                continue
             table_name = self.make_temp_table_name(name)
+            # Columns with identical queries share a table
+            if table_name in joined_tables:
+                continue
+            joined_tables.add(table_name)
             joins.append(
                 f"LEFT JOIN {table_name} ON {table_name}.patient_id = {patient_id_expr}"
             )
@@ -192,48 +262,211 @@ class EMISBackend:
             raise ValueError(f"Unhandled column type: {column_type}")
 
     def execute_query(self):
+        output_table = self.create_output_table()
+        if not output_table:
+            return self.execute_final_query()
+        logger.info(f"Downloading data from '{output_table}'")
         cursor = self.get_db_connection().cursor()
-        logger.info("Uploading codelists into temporary tables")
-        for sql in self.codelist_tables:
-            cursor.execute(sql)
+        cursor.execute(f"SELECT * FROM {output_table}")
+        return cursor
+
+    def execute_final_query(self):
+        logger.info(
+            "No TEMP_DATABASE_NAME defined in environment, downloading results "
+            "directly without writing to output table"
+        )
+        cursor = self.get_db_connection().cursor()
+        cursor.execute(self.queries[-1][1])
+        return cursor
+
+    def create_output_table(self):
+        """
+        Run the queries for each column and then, if we have a temporary
+        database, the final query, writing its results into a table there.
+        Returns the name of this table (or None if there's no temporary
+        database).
+        """
         queries = list(self.queries)
         final_query = queries.pop()[1]
+        codelist_queries = [
+            (f"codelist {n}", sql)
+            for (n, sql) in enumerate(self.codelist_tables, start=1)
+        ]
+        # Columns with identical queries share a table so we only need to run
+        # each distinct query once
+        unique_queries = []
         for name, sql in queries:
-            logger.info(f"Running query: {name}")
-            cursor.execute(sql)
+            if sql not in {other_sql for (_, other_sql) in unique_queries}:
+                unique_queries.append((name, sql))
+        self.execute_queries_concurrently(codelist_queries + unique_queries)
         output_table = self.get_output_table_name(os.environ.get("TEMP_DATABASE_NAME"))
         if output_table:
             logger.info(f"Running final query and writing output to '{output_table}'")
             sql = f"CREATE TABLE IF NOT EXISTS {output_table} AS {final_query}"
+            cursor = self.get_db_connection().cursor()
             cursor.execute(sql)
-            logger.info(f"Downloading data from '{output_table}'")
-            cursor.execute(f"SELECT * FROM {output_table}")
+            self.query_stats["final_output"] = cursor.query_stats
+        return output_table
+
+    def download_output_table(self, output_table, filename, sinks=()):
+        """
+        Download the output table to `filename` in pages ordered by
+        patient_id. If the download is interrupted then re-running the study
+        resumes it from the last complete page (see `presto_table_to_csv`).
+
+        With PRESTO_DOWNLOAD_SHARDS greater than 1 we split the patient_id
+        range into shards which are downloaded in parallel over separate
+        connections and then concatenated.
+        """
+        root, extension = os.path.splitext(filename)
+        if self.download_shards > 1:
+            key_ranges = self.get_patient_id_ranges(output_table, self.download_shards)
         else:
-            logger.info(
-                "No TEMP_DATABASE_NAME defined in environment, downloading results "
-                "directly without writing to output table"
-            )
-            cursor.execute(final_query)
-        return cursor
+            key_ranges = [(None, None)]
+        partial_files = [
+            f"{root}.partial.{n}{extension}" for n in range(len(key_ranges))
+        ]
+        unique_check = UniqueCheck()
+        lock = threading.Lock()
+
+        def record_patient_id(row):
+            with lock:
+                unique_check.add(row[0])
+
+        def download(partial_file, min_key, max_key):
+            connection = presto_connection_from_url(self.database_url)
+            try:
+                presto_table_to_csv(
+                    partial_file,
+                    connection=connection,
+                    table=output_table,
+                    key_column="patient_id",
+                    min_key=min_key,
+                    max_key=max_key,
+                    row_callback=record_patient_id,
+                    sinks=sinks,
+                )
+            finally:
+                connection.close()
+
+        logger.info(f"Downloading data from '{output_table}'")
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(key_ranges)
+        ) as executor:
+            futures = [
+                executor.submit(download, partial_file, min_key, max_key)
+                for (partial_file, (min_key, max_key)) in zip(partial_files, key_ranges)
+            ]
+            for future in concurrent.futures.as_completed(futures):
+                # Raise any errors from the download threads
+                future.result()
+        logger.info(f"Downloaded {unique_check.count} results")
+        unique_check.assert_unique_ids()
+        if len(partial_files) == 1:
+            os.replace(partial_files[0], filename)
+            return
+        # Shards cover consecutive ranges of patient_id so we can just append
+        # their contents in order
+        with open(filename, "w", newline="") as output_file:
+            for n, partial_file in enumerate(partial_files):
+                with open(partial_file, newline="") as f:
+                    headers = f.readline()
+                    if n == 0:
+                        output_file.write(headers)
+                    for line in f:
+                        output_file.write(line)
+        for partial_file in partial_files:
+            os.unlink(partial_file)
+
+    def get_patient_id_ranges(self, table, count):
+        """
+        Split the range of patient_ids in `table` into (at most) `count`
+        ranges, returning a list of (exclusive min, inclusive max) pairs
+        """
+        cursor = self.get_db_connection().cursor()
+        cursor.execute(f"SELECT MIN(patient_id), MAX(patient_id) FROM {table}")
+        min_id, max_id = list(cursor)[0]
+        if min_id is None:
+            return [(None, None)]
+        width = -(-(max_id - min_id + 1) // count)
+        return [
+            (start - 1, min(start + width - 1, max_id))
+            for start in range(min_id, max_id + 1, width)
+        ]
+
+    def execute_queries_concurrently(self, queries):
+        """
+        Run the supplied list of (name, sql) pairs, each of which creates a
+        table, with up to `max_concurrent_queries` running at once. Each query
+        starts as soon as all the queries creating tables it uses have
+        finished. Each thread gets its own connection.
+        """
+        dependencies = get_query_dependencies(queries)
+        pending = dict(queries)
+        finished = set()
+        running = {}
+        connections = []
+        thread_data = threading.local()
+
+        def execute(name, sql):
+            if not hasattr(thread_data, "cursor"):
+                connection = presto_connection_from_url(self.database_url)
+                connections.append(connection)
+                thread_data.cursor = connection.cursor()
+            logger.info(f"Running query: {name}")
+            thread_data.cursor.execute(sql)
+            self.query_stats[name] = thread_data.cursor.query_stats
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.max_concurrent_queries
+            ) as executor:
+                while pending or running:
+                    for name in list(pending):
+                        if dependencies[name] <= finished:
+                            future = executor.submit(execute, name, pending.pop(name))
+                            running[future] = name
+                    if not running:
+                        raise RuntimeError(
+                            f"Circular dependency between queries: {', '.join(pending)}"
+                        )
+                    done, _ = concurrent.futures.wait(
+                        running, return_when=concurrent.futures.FIRST_COMPLETED
+                    )
+                    for future in done:
+                        # Raise any errors from the query threads
+                        future.result()
+                        finished.add(running.pop(future))
+        finally:
+            for connection in connections:
+                connection.close()
 
     def get_output_table_name(self, temporary_database):
         if not temporary_database:
             return
-        timestamp = datetime.datetime.now(datetime.timezone.utc).strftime(
-            "%Y%m%d_%H%M%S"
+        final_query = self.queries[-1][1]
+        return (
+            f"{temporary_database}..Output_{self.data_version}_{sql_hash(final_query)}"
         )
-        return f"{temporary_database}..Output_{timestamp}"
 
     def get_temp_table_prefix(self):
         if "TEMP_TABLE_PREFIX" in os.environ:
             return os.environ["TEMP_TABLE_PREFIX"]
-        timestamp = datetime.datetime.now(datetime.timezone.utc).strftime(
-            "%Y%m%d_%H%M%S"
-        )
-        return f"_{timestamp}_{uuid.uuid4().hex[:4]}"
+        return f"_{self.data_version}"
 
-    def make_temp_table_name(self, name):
-        return f"{self.temp_table_prefix}_{name}"
+    def make_temp_table_name(self, name, sql=None):
+        """
+        Return the name of the table which holds the results for `name`
+
+        Unless TEMP_TABLE_PREFIX is set, tables are named after a hash of the
+        SQL which creates them (supplied as `sql` when the table is first
+        named) so that `CREATE TABLE IF NOT EXISTS` reuses the results of
+        unchanged queries from previous runs against the same version of the
+        data.
+        """
+        if sql is not None and "TEMP_TABLE_PREFIX" not in os.environ:
+            self.temp_table_names[name] = f"{self.temp_table_prefix}_{sql_hash(sql)}"
+        return self.temp_table_names.get(name, f"{self.temp_table_prefix}_{name}")
 
     def get_query(self, column_name, query_type, query_args):
         method_name = f"patients_{query_type}"
@@ -248,38 +481,74 @@ class EMISBackend:
         return cols, sql
 
     def create_codelist_table(self, codelist):
+        """
+        Upload the codelist into a table, returning the table name
+
+        Codes (and categories) are passed as typed arrays which are unnested,
+        as these are much cheaper for Presto to parse and plan than a row
+        constructor per code. Long codelists are uploaded in chunks, each into
+        its own table, and the codelist table is then the union of these. This
+        keeps every statement small while still creating each table in a
+        single statement, so that results can be reused between runs.
+        """
         table_number = len(self.codelist_tables) + 1
         # We include the current column name for ease of debugging
         column_name = self._current_column_name or "unknown"
+        codes = list(codelist)
+        if len(codes) <= CODELIST_CHUNK_SIZE:
+            sql = self.get_codelist_chunk_sql(codelist, codes)
+        else:
+            chunk_tables = []
+            for i in range(0, len(codes), CODELIST_CHUNK_SIZE):
+                chunk_sql = self.get_codelist_chunk_sql(
+                    codelist, codes[i : i + CODELIST_CHUNK_SIZE]
+                )
+                chunk_table = self.make_temp_table_name(
+                    f"{table_number}_{column_name}_{i}", chunk_sql
+                )
+                self.add_codelist_table_query(chunk_table, chunk_sql)
+                chunk_tables.append(chunk_table)
+            sql = "\n                    UNION ALL ".join(
+                f"SELECT * FROM {chunk_table}" for chunk_table in chunk_tables
+            )
+            sql = f"\n                    {sql}\n                    "
         # The underscore prefix is our convention to indicate a temporary table
         # but has no significance for the database
-        table_name = self.make_temp_table_name(f"{table_number}_{column_name}")
-        cast = int if codelist.system in ("snomed", "snomedct") else str
+        table_name = self.make_temp_table_name(f"{table_number}_{column_name}", sql)
+        self.add_codelist_table_query(table_name, sql)
+        return table_name
+
+    def get_codelist_chunk_sql(self, codelist, codes):
+        if codelist.system in ("snomed", "snomedct"):
+            cast, array_type = int, "BIGINT"
+        else:
+            cast, array_type = str, "VARCHAR"
         organisation_hash = quote(get_organisation_hash())
         if codelist.has_categories:
-            values = ", ".join(
-                f"({quote(cast(code))}, {quote(category)})"
-                for code, category in codelist
-            )
-            self.codelist_tables.append(
-                f"""
-                    CREATE TABLE IF NOT EXISTS {table_name} AS
-                    SELECT code, category, {organisation_hash} AS hashed_organisation FROM (
-                      VALUES {values}
+            code_array = ", ".join(quote(cast(code)) for (code, category) in codes)
+            category_array = ", ".join(quote(category) for (code, category) in codes)
+            return f"""
+                    SELECT code, category, {organisation_hash} AS hashed_organisation
+                    FROM UNNEST(
+                      CAST(ARRAY[{code_array}] AS ARRAY({array_type})),
+                      CAST(ARRAY[{category_array}] AS ARRAY(VARCHAR))
                     ) AS t (code, category)
                     """
-            )
         else:
-            values = ", ".join(f"({quote(cast(code))})" for code in codelist)
-            self.codelist_tables.append(
-                f"""
-                    CREATE TABLE IF NOT EXISTS {table_name} AS
-                    SELECT code, {organisation_hash} AS hashed_organisation FROM (
-                      VALUES {values}
+            code_array = ", ".join(quote(cast(code)) for code in codes)
+            return f"""
+                    SELECT code, {organisation_hash} AS hashed_organisation
+                    FROM UNNEST(
+                      CAST(ARRAY[{code_array}] AS ARRAY({array_type}))
                     ) AS t (code)
                     """
-            )
-        return table_name
+
+    def add_codelist_table_query(self, table_name, sql):
+        create_sql = f"""
+                    CREATE TABLE IF NOT EXISTS {table_name} AS{sql}"""
+        # Identical codelists share a single table
+        if create_sql not in self.codelist_tables:
+            self.codelist_tables.append(create_sql)
 
     def patients_age_as_of(self, reference_date):
         quoted_date = quote(reference_date)
@@ -389,19 +658,20 @@ class EMISBackend:
            SELECT registration_id, hashed_organisation, date_of_birth
            FROM {PATIENT_TABLE}
         """
-        weight_codes_sql = codelist_to_sql(weight_codes)
+        weight_codes_table = self.create_codelist_table(weight_codes)
         weights_cte = f"""
           SELECT t.registration_id, t.weight, t.effective_date
           FROM (
             SELECT registration_id, "value_pq_1" AS weight, effective_date,
             ROW_NUMBER() OVER (PARTITION BY registration_id ORDER BY effective_date DESC) AS rownum
             FROM {OBSERVATION_TABLE}
-            WHERE snomed_concept_id IN ({weight_codes_sql}) AND {date_condition}
+            WHERE snomed_concept_id IN (SELECT code FROM {weight_codes_table})
+            AND {date_condition}
           ) t
           WHERE t.rownum = 1
         """
 
-        height_codes_sql = codelist_to_sql(height_codes)
+        height_codes_table = self.create_codelist_table(height_codes)
         # The height date restriction is different from the others. We don't
         # mind using old values as long as the patient was old enough when they
         # were taken.
@@ -416,7 +686,8 @@ class EMISBackend:
             SELECT registration_id, "value_pq_1" AS height, effective_date,
             ROW_NUMBER() OVER (PARTITION BY registration_id ORDER BY effective_date DESC) AS rownum
             FROM {OBSERVATION_TABLE}
-            WHERE snomed_concept_id IN ({height_codes_sql}) AND {height_date_condition}
+            WHERE snomed_concept_id IN (SELECT code FROM {height_codes_table})
+            AND {height_date_condition}
           ) t
           WHERE t.rownum = 1
         """
@@ -461,33 +732,43 @@ class EMISBackend:
     ):
         # We only support this option for now
         assert on_most_recent_day_of_measurement
-        date_condition = make_date_filter("effective_date", between)
-        codelist_sql = codelist_to_sql(codelist)
+        date_condition = make_date_filter("o.effective_date", between)
+        codelist_table = self.create_codelist_table(codelist)
         # The subquery finds, for each patient, the most recent day on which
         # they've had a measurement. The outer query selects, for each patient,
         # the mean value on that day.
-        # Note, there's a CAST in the JOIN condition but apparently SQL Server can still
-        # use an index for this. See: https://stackoverflow.com/a/25564539
+        # Presto doesn't support subqueries in an outer join's condition, so
+        # rather than filtering on `code IN (SELECT ...)` we inner join the
+        # observations to the codelist table before the outer join.
         sql = f"""
         SELECT
           days.registration_id AS patient_id,
           days.hashed_organisation,
-          AVG({OBSERVATION_TABLE}."value_pq_1") AS mean_value,
+          AVG(measurements."value_pq_1") AS mean_value,
           days.date_measured AS date
         FROM (
             SELECT
-                registration_id,
-                hashed_organisation,
-                CAST(MAX(effective_date) AS date) AS date_measured
-            FROM {OBSERVATION_TABLE}
-            WHERE snomed_concept_id IN ({codelist_sql}) AND {date_condition}
-            GROUP BY registration_id, hashed_organisation
+                o.registration_id,
+                o.hashed_organisation,
+                CAST(MAX(o.effective_date) AS date) AS date_measured
+            FROM {OBSERVATION_TABLE} o
+            INNER JOIN {codelist_table} c
+            ON o.snomed_concept_id = c.code
+            WHERE {date_condition}
+            GROUP BY o.registration_id, o.hashed_organisation
         ) AS days
-        LEFT JOIN {OBSERVATION_TABLE}
+        LEFT JOIN (
+            SELECT
+                o.registration_id,
+                o."value_pq_1",
+                CAST(o.effective_date AS date) AS date_measured
+            FROM {OBSERVATION_TABLE} o
+            INNER JOIN {codelist_table} c
+            ON o.snomed_concept_id = c.code
+        ) AS measurements
         ON (
-          {OBSERVATION_TABLE}.registration_id = days.registration_id
-          AND {OBSERVATION_TABLE}.snomed_concept_id IN ({codelist_sql})
-          AND CAST({OBSERVATION_TABLE}.effective_date AS date) = days.date_measured
+          measurements.registration_id = days.registration_id
+          AND measurements.date_measured = days.date_measured
         )
         GROUP BY days.registration_id, days.hashed_organisation, days.date_measured
         """
@@ -961,12 +1242,13 @@ class EMISBackend:
         )
         if codelist is not None:
             assert codelist.system == "icd10"
-            codelist_sql = codelist_to_sql(codelist)
+            codelist_table = self.create_codelist_table(codelist)
             code_columns = ["icd10u"]
             if not match_only_underlying_cause:
                 code_columns.extend([f"icd10{i:03d}" for i in range(1, 16)])
             code_conditions = " OR ".join(
-                f"{column} IN ({codelist_sql})" for column in code_columns
+                f"{column} IN (SELECT code FROM {codelist_table})"
+                for column in code_columns
             )
         else:
             code_conditions = "1 = 1"
@@ -1151,15 +1433,6 @@ class EMISBackend:
         ELSE {function}({components}) END"""
 
 
-def codelist_to_sql(codelist):
-    cast = int if codelist.system in ("snomed", "snomedct") else str
-    if getattr(codelist, "has_categories", False):
-        values = [quote(cast(code)) for (code, category) in codelist]
-    else:
-        values = [quote(cast(code)) for code in codelist]
-    return ",".join(values)
-
-
 def quote(value):
     if isinstance(value, (int, float)):
         return str(value)
@@ -1204,6 +1477,105 @@ def truncate_date(column, date_format):
     return f"date_format({column}, '{date_format}')"
 
 
+def get_data_version():
+    """
+    Return the version of the data we're querying as a YYYYMMDD date, which
+    is included in the names of the tables we create so that results are only
+    reused against the same data. Unless EMIS_DATA_VERSION is set this is
+    today's date, meaning results are reused between runs (or retries) on the
+    same day.
+    """
+    version = os.environ.get("EMIS_DATA_VERSION")
+    if version is None:
+        return datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%d")
+    if not re.match(r"^\d{8}$", version):
+        raise ValueError("EMIS_DATA_VERSION must be a date of the form YYYYMMDD")
+    return version
+
+
+def sql_hash(sql):
+    return hashlib.sha1(sql.encode("utf8")).hexdigest()[:16]
+
+
+def cleanup_temp_tables(
+    database_url, temporary_database=None, max_age_days=None, max_size_bytes=None
+):
+    """
+    Drop temporary and output tables whose data version is more than
+    `max_age_days` old and then, if the remaining tables take up more than
+    `max_size_bytes`, drop the oldest of them until they fit. Sizes come from
+    the table statistics and so are approximate.
+
+    Temporary tables are created in the connection's default schema, and
+    output tables in `temporary_database` (see `get_output_table_name`), so
+    output tables are only found if `temporary_database` is supplied.
+
+    Returns the names of the dropped tables.
+    """
+    cursor = presto_connection_from_url(database_url).cursor()
+    queries = [("SHOW TABLES", "{}")]
+    if temporary_database:
+        queries.append(
+            (f"SHOW TABLES FROM {temporary_database}", f"{temporary_database}.{{}}")
+        )
+    tables = []
+    for query, name_format in queries:
+        cursor.execute(query)
+        for (table,) in cursor:
+            match = TEMP_TABLE_DATE_RE.match(table)
+            if match:
+                date = datetime.datetime.strptime(match.group(1), "%Y%m%d").date()
+                tables.append((date, name_format.format(table)))
+    # Newest first
+    tables.sort(reverse=True)
+    to_drop = []
+    if max_age_days is not None:
+        today = datetime.datetime.now(datetime.timezone.utc).date()
+        oldest_allowed = today - datetime.timedelta(days=max_age_days)
+        to_drop.extend(table for (date, table) in tables if date < oldest_allowed)
+    if max_size_bytes is not None:
+        total_size = 0
+        for date, table in tables:
+            if table in to_drop:
+                continue
+            total_size += get_table_size(cursor, table)
+            if total_size > max_size_bytes:
+                to_drop.append(table)
+    for table in to_drop:
+        logger.info(f"Dropping table '{table}'")
+        cursor.execute(f"DROP TABLE IF EXISTS {table}")
+    return to_drop
+
+
+def get_table_size(cursor, table):
+    cursor.execute(f"SHOW STATS FOR {table}")
+    headers = [x[0] for x in cursor.description]
+    column_index = headers.index("column_name")
+    size_index = headers.index("data_size")
+    return sum(row[size_index] or 0 for row in cursor if row[column_index] is not None)
+
+
+def get_query_dependencies(queries):
+    """
+    Given a list of (name, sql) pairs, each of which creates a table, return a
+    dict mapping each name to the set of names of the queries whose tables it
+    uses
+    """
+    created_tables = {}
+    for name, sql in queries:
+        match = CREATE_TABLE_RE.search(sql)
+        if match:
+            created_tables[match.group(1)] = name
+    dependencies = {}
+    for name, sql in queries:
+        dependencies[name] = {
+            other_name
+            for (table, other_name) in created_tables.items()
+            if other_name != name and re.search(rf"\b{re.escape(table)}\b", sql)
+        }
+    return dependencies
+
+
 class UniqueCheck:
     def __init__(self):
         self.count = 0
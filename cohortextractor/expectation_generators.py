@@ -1,47 +1,75 @@
+import functools
 import os
 from datetime import datetime
 
 import numpy as np
 import pandas as pd
-from scipy.stats import expon, norm, rv_discrete, uniform
 
 
-def generate_ages(population, max_age=110):
-    """Generate a population whose ages approximate UK population shape"""
+def get_rng(rng=None):
+    """Return a numpy random Generator
+
+    `rng` can be an existing Generator (returned unchanged, so that a single
+    stream of random numbers can be shared across many calls) or an integer
+    seed. If it's None we seed from numpy's global random state so that
+    `numpy.random.seed()` still makes the output reproducible.
+    """
+    if rng is None:
+        rng = np.random.randint(2 ** 32, dtype=np.uint64)
+    return np.random.default_rng(rng)
+
 
+@functools.lru_cache()
+def get_age_probabilities(max_age=110):
+    """Return an array giving the probability of each age from 0 to
+    `max_age` - 1, approximating the shape of the UK population
+
+    """
     df = pd.read_csv(
         os.path.join(os.path.dirname(__file__), "uk_population_bands_2018.csv")
     )
     # Reshape the dataframe (from
     # https://www.ons.gov.uk/peoplepopulationandcommunity/populationandmigration/populationprojections/datasets/tablea21principalprojectionukpopulationinagegroups)
-    bands = df["band"].str.split("-").apply(pd.Series)
-    df = df.join(bands)[[0, 1, "range"]]
-    df.columns = ["start", "end", "count"]
-    df["count"] = df["count"].str.replace(",", "").astype("int")
-    ages = pd.DataFrame(np.arange(max_age), columns=["age"])
-    total = df["count"].sum()
-
-    def lookup_age(age):
-        for index, row in df.iterrows():
-            if age <= int(row["end"]):
-                return row["count"]
-
-    # compute a probability for each age
-    ages["p"] = ages.age.apply(lookup_age) / total / 5
+    band_ends = df["band"].str.split("-", expand=True)[1].astype("int").to_numpy()
+    counts = df["range"].str.replace(",", "").astype("int").to_numpy()
+    # Each age falls in the first band which ends at or after it, and each
+    # band is (mostly) five years wide
+    ages = np.arange(max_age)
+    p = counts[np.searchsorted(band_ends, ages)] / counts.sum() / 5
     # Ensure p adds up to 1 by trimming a large value
-    excess = ages.p.sum() - 1
-    biggest = ages[ages.p == ages.p.max()]
-    ages.loc[biggest.index[0], "p"] -= excess
-    # Generate ages
-    distribution = rv_discrete(name="uk_population", values=(ages.age, ages.p))
-    return distribution.rvs(size=population)
+    p[np.argmax(p)] -= p.sum() - 1
+    # The result is cached so make sure no caller can modify it
+    p.flags.writeable = False
+    return p
+
+
+def normalise_probabilities(p):
+    """Return the probabilities `p` as an array scaled to sum to exactly 1
+
+    numpy's `Generator.choice` only allows for tiny rounding errors in its
+    probabilities, whereas we accept the same tolerance as scipy's
+    `rv_discrete` did (so that, e.g., ratios rounded to a few decimal places
+    still work).
+    """
+    p = np.asarray(p, dtype="float64")
+    if not np.isclose(p.sum(), 1):
+        raise ValueError("The sum of provided probabilities is not 1.")
+    return p / p.sum()
+
+
+def generate_ages(population, max_age=110, rng=None):
+    """Generate a population whose ages approximate UK population shape"""
+    rng = get_rng(rng)
+    p = normalise_probabilities(get_age_probabilities(max_age))
+    return rng.choice(max_age, size=population, p=p)
 
 
-def generate_dates(population, earliest_date, latest_date, rate):
+def generate_dates(population, earliest_date, latest_date, rate, rng=None):
     """Produce a sample of events whose frequency is geometric
     (increasingly common)
 
     """
+    rng = get_rng(rng)
     low = datetime.strptime(earliest_date, "%Y-%m-%d").date()
     high = datetime.strptime(latest_date, "%Y-%m-%d").date()
     elapsed_days = (high - low).days
@@ -51,31 +79,59 @@ def generate_dates(population, earliest_date, latest_date, rate):
         # exponential function
         oversample_ratio = 1.5
         distribution = (
-            expon.rvs(loc=0, scale=0.1, size=int(population * oversample_ratio))
+            rng.exponential(scale=0.1, size=int(population * oversample_ratio))
             * elapsed_days
         ).astype("int")
         distribution = distribution[distribution <= elapsed_days]
     elif rate == "uniform":
-        distribution = uniform.rvs(size=int(population)) * elapsed_days
-        distribution = distribution.astype("int")
+        distribution = (rng.random(size=population) * elapsed_days).astype("int")
     else:
         raise ValueError(
             "Only exponential_increase and uniform distributions currently supported"
         )
 
-    # And then sample it back down to the requested population size
-    distribution = np.random.choice(distribution, population, replace=False)
+    # And then trim it back down to the requested population size. The values
+    # are independent draws so taking the first N is as good as sampling N.
+    days = distribution[:population].astype("timedelta64[D]")
+    dates = (np.datetime64(high, "D") - days).astype("datetime64[ns]")
+    return pd.DataFrame({"date": dates})
 
-    df = pd.DataFrame(distribution, columns=["days"])
-    shifts = pd.TimedeltaIndex(df["days"], unit="D")
-    df["d"] = high
-    df["d"] = pd.to_datetime(df["d"])
-    df["date"] = df["d"] - shifts
-    return df[["date"]]
 
+def get_date_probability(earliest_date, latest_date, rate, start_date, end_date):
+    """Return the probability that `generate_dates` produces a date on or
+    after `start_date` and before `end_date`, or None for unsupported rates
 
-def generate(population, **kwargs):
+    """
+    low = datetime.strptime(earliest_date, "%Y-%m-%d").date()
+    high = datetime.strptime(latest_date, "%Y-%m-%d").date()
+    elapsed_days = (high - low).days
+    if elapsed_days <= 0:
+        return float(start_date <= latest_date < end_date)
+    # Dates are generated as a whole number of days before `high`, so a date
+    # in [start_date, end_date) is one whose (continuous) number of days before
+    # `high` is in this range
+    days = np.array(
+        [
+            (high - datetime.strptime(end_date, "%Y-%m-%d").date()).days + 1,
+            (high - datetime.strptime(start_date, "%Y-%m-%d").date()).days + 1,
+        ]
+    )
+    if rate == "exponential_increase":
+        # See `generate_dates`: days are exponentially distributed, with a
+        # scale of a tenth of the period, and trimmed to the period
+        days = np.clip(days, 0, elapsed_days + 1)
+        cumulative = 1 - np.exp(-days / (0.1 * elapsed_days))
+        cumulative /= 1 - np.exp(-(elapsed_days + 1) / (0.1 * elapsed_days))
+    elif rate == "uniform":
+        cumulative = np.clip(days, 0, elapsed_days) / elapsed_days
+    else:
+        return None
+    return float(cumulative[1] - cumulative[0])
+
+
+def generate(population, rng=None, **kwargs):
     """Returns a date column and zero or more value column."""
+    rng = get_rng(rng)
     rate = kwargs.pop("rate", "exponential_increase")
     incidence = kwargs.pop("incidence", None)
     assert (
@@ -92,30 +148,32 @@ def generate(population, **kwargs):
     elif universal:
         df = pd.DataFrame(data=np.arange(population), columns=["date"])
     else:
-        df = generate_dates(population, date["earliest"], date["latest"], rate)
+        df = generate_dates(population, date["earliest"], date["latest"], rate, rng)
 
     category = kwargs.pop("category", None)
     if category:
         ratios = category["ratios"]
-        category_ids = np.arange(len(ratios))
-        custm = rv_discrete(values=(category_ids, list(ratios.values())))
-        df["category"] = custm.rvs(size=population)
-        category_labels = dict(zip(category_ids, ratios.keys()))
-        df = df.replace({"category": category_labels})
-        df["category"] = df["category"].astype("category")
+        labels = list(ratios.keys())
         # Add empty string as a category to support missing values
-        if "" not in df["category"].cat.categories:
-            df["category"].cat.add_categories(new_categories=[""], inplace=True)
+        if "" not in labels:
+            labels.append("")
+        # Draw the category codes directly rather than drawing ids and then
+        # relabelling them
+        p = normalise_probabilities(list(ratios.values()))
+        codes = rng.choice(len(ratios), size=population, p=p)
+        df["category"] = pd.Categorical.from_codes(codes, categories=labels)
 
     int_ = kwargs.pop("int", None)
     if int_:
         if int_["distribution"] == "normal":
             mean = int_["mean"]
             stddev = int_["stddev"]
-            df["int"] = norm.rvs(loc=mean, scale=stddev, size=population).astype("int")
+            df["int"] = rng.normal(loc=mean, scale=stddev, size=population).astype(
+                "int"
+            )
         elif int_["distribution"] == "population_ages":
             # A distribution that is something like a real UK population
-            df["int"] = generate_ages(population)
+            df["int"] = generate_ages(population, rng=rng)
         else:
             raise ValueError(
                 "Only `normal` and `population_ages` distributions currently supported"
@@ -125,7 +183,7 @@ def generate(population, **kwargs):
         if float_["distribution"] == "normal":
             mean = float_["mean"]
             stddev = float_["stddev"]
-            df["float"] = norm.rvs(loc=mean, scale=stddev, size=population)
+            df["float"] = rng.normal(loc=mean, scale=stddev, size=population)
         else:
             raise ValueError(
                 "Only `normal` and `population_ages` distributions currently supported"
@@ -139,16 +197,23 @@ def generate(population, **kwargs):
 
     if match_incidence is not None:
         # Remove rows to match the incidence of the passed-in series
-        set_empty_values(df, pd.isnull(match_incidence))
+        set_empty_values(df, pd.isnull(match_incidence).to_numpy())
     elif not universal:
         # Randomly remove rows to match incidence
-        set_empty_values(df, df.sample(n=int((1 - incidence) * population)).index)
+        empty_rows = np.zeros(population, dtype=bool)
+        empty_count = int((1 - incidence) * population)
+        empty_rows[rng.choice(population, size=empty_count, replace=False)] = True
+        set_empty_values(df, empty_rows)
     if date is None:
         df = df.drop("date", axis=1)
     return df
 
 
-def set_empty_values(df, row_selection):
+def set_empty_values(df, mask):
+    """Replace the values in every row selected by the boolean array `mask`
+    with the empty value for its column
+
+    """
     empty_values = {
         "bool": 0,
         "int": 0,
@@ -162,4 +227,4 @@ def set_empty_values(df, row_selection):
         "category": "",
     }
     for column in df.columns:
-        df.loc[row_selection, column] = empty_values.get(column, "")
+        df[column] = df[column].mask(mask, empty_values.get(column, ""))
@@ -1,6 +1,8 @@
+import operator
 import re
 import sqlite3
 
+import numpy as np
 import sqlparse
 from sqlparse import tokens as ttypes
 
@@ -40,6 +42,42 @@ def format_expression(expression, name_map, empty_value_map):
     expression under the natural (Pythonic) conception of falsity for those
     types.
     """
+    tokens = parse_and_validate_expression(expression, empty_value_map)
+    names_referenced = set()
+    tokens = remap_names(tokens, name_map, names_referenced)
+    new_expression = " ".join(token.value for token in tokens)
+    return new_expression, names_referenced
+
+
+def compile_expression(expression, empty_value_map):
+    """
+    Take an SQL expression (in the same limited dialect as `format_expression`)
+    and return a function which evaluates it over arrays of column values,
+    along with a set of all the names used within the expression.
+
+    The returned function takes a dict mapping each column name to a numpy
+    array (or anything else which supports vectorised operators) and returns
+    an array of results. Columns must use their "empty" values (as given in
+    `empty_value_map`) rather than nulls, so the semantics match those of the
+    SQL generated by `format_expression`.
+
+    For example
+
+        evaluate, names = compile_expression("age > 50 AND sex = 'F'", ...)
+        evaluate({"age": np.array([30, 60]), "sex": np.array(["F", "F"])})
+
+    returns `array([False, True])`
+    """
+    tokens = parse_and_validate_expression(expression, empty_value_map)
+    compiler = ExpressionCompiler(tokens)
+    return compiler.compile(), compiler.names_referenced
+
+
+def parse_and_validate_expression(expression, empty_value_map):
+    """
+    Return the list of tokens for the supplied expression, with implicit
+    comparisons made explicit, raising an error if it isn't valid
+    """
     tree = sqlparse.parse(expression)
     tokens = tree[0].flatten()
     tokens = filter_and_validate_tokens(tokens)
@@ -51,10 +89,7 @@ def format_expression(expression, name_map, empty_value_map):
         raise InvalidExpressionError(
             f"Invalid SQL expression: {expression}\nError: {e}"
         )
-    names_referenced = set()
-    tokens = remap_names(tokens, name_map, names_referenced)
-    new_expression = " ".join(token.value for token in tokens)
-    return new_expression, names_referenced
+    return tokens
 
 
 def remap_names(tokens, name_map, names_referenced):
@@ -203,3 +238,137 @@ def replace_names_with_empty_values(token, empty_value_map):
             raise UnknownColumnError(f"Unknown column: {token.value}")
         token = token_for_value(empty_value)
     return token.value
+
+
+class ExpressionCompiler:
+    """
+    Recursive descent parser which turns a validated token stream into a
+    function of column values, following SQL's operator precedence (lowest
+    first): OR, AND, NOT, comparisons, addition and subtraction,
+    multiplication and division.
+
+    Each `parse_` method consumes tokens for one level of precedence and
+    returns a function which takes the dict of column values and returns the
+    value of that sub-expression. The returned functions apply numpy
+    operations to whole columns at once, so evaluating the expression costs
+    one array operation per operator no matter how many rows there are.
+    """
+
+    logical_operators = {"AND": np.logical_and, "OR": np.logical_or}
+    comparison_operators = {
+        "=": operator.eq,
+        "!=": operator.ne,
+        ">": operator.gt,
+        "<": operator.lt,
+        ">=": operator.ge,
+        "<=": operator.le,
+    }
+    arithmetic_operators = {
+        "+": operator.add,
+        "-": operator.sub,
+        "*": operator.mul,
+        "/": operator.truediv,
+    }
+
+    def __init__(self, tokens):
+        self.tokens = list(tokens)
+        self.position = 0
+        self.names_referenced = set()
+
+    def compile(self):
+        evaluate = self.parse_or()
+        if self.peek() is not None:
+            raise InvalidExpressionError(f"Unexpected token: {self.peek().value}")
+        return evaluate
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+
+    def next_token(self):
+        token = self.peek()
+        if token is None:
+            raise InvalidExpressionError("Unexpected end of expression")
+        self.position += 1
+        return token
+
+    def match(self, ttype, values):
+        """
+        Consume and return the value of the next token if it is of the given
+        type and one of the given values, otherwise return None
+        """
+        token = self.peek()
+        if token is not None and token.ttype in ttype and token.value in values:
+            self.position += 1
+            return token.value
+
+    def parse_or(self):
+        return self.parse_binary(self.parse_and, ttypes.Keyword, ["OR"])
+
+    def parse_and(self):
+        return self.parse_binary(self.parse_not, ttypes.Keyword, ["AND"])
+
+    def parse_not(self):
+        if self.match(ttypes.Keyword, ["NOT"]):
+            operand = self.parse_not()
+            return lambda columns: np.logical_not(operand(columns))
+        return self.parse_comparison()
+
+    def parse_comparison(self):
+        left = self.parse_sum()
+        value = self.match(ttypes.Comparison, self.comparison_operators)
+        if value is None:
+            return left
+        right = self.parse_sum()
+        return self.apply(self.comparison_operators[value], left, right)
+
+    def parse_sum(self):
+        return self.parse_binary(self.parse_product, ttypes.Operator, ["+", "-"])
+
+    def parse_product(self):
+        return self.parse_binary(self.parse_unary, ttypes.Operator, ["*", "/"])
+
+    def parse_unary(self):
+        if self.match(ttypes.Operator, ["-"]):
+            operand = self.parse_unary()
+            return lambda columns: operator.neg(operand(columns))
+        return self.parse_primary()
+
+    def parse_primary(self):
+        token = self.next_token()
+        if token.ttype is ttypes.Punctuation and token.value == "(":
+            inner = self.parse_or()
+            if not self.match(ttypes.Punctuation, [")"]):
+                raise InvalidExpressionError("Missing closing bracket")
+            return inner
+        elif token.ttype is ttypes.Name:
+            name = token.value
+            self.names_referenced.add(name)
+            return lambda columns: columns[name]
+        elif token.ttype in ttypes.Literal.String:
+            value = token.value[1:-1]
+            return lambda columns: value
+        elif token.ttype in ttypes.Number.Integer:
+            value = int(token.value)
+            return lambda columns: value
+        elif token.ttype in ttypes.Number.Float:
+            value = float(token.value)
+            return lambda columns: value
+        else:
+            raise InvalidExpressionError(f"Unexpected token: {token.value}")
+
+    def parse_binary(self, parse_operand, ttype, values):
+        evaluate = parse_operand()
+        while True:
+            value = self.match(ttype, values)
+            if value is None:
+                return evaluate
+            right = parse_operand()
+            function = self.logical_operators.get(value) or (
+                self.arithmetic_operators[value]
+            )
+            evaluate = self.apply(function, evaluate, right)
+
+    @staticmethod
+    def apply(function, left, right):
+        return lambda columns: function(left(columns), right(columns))
@@ -0,0 +1,52 @@
+class LeftJoinSortedRows:
+    """
+    Left join an iterator of rows against one or more other iterators of rows
+    on the supplied key field, yielding tuples of the form:
+
+        (left_item, right_item_1, right_item_2, ...)
+
+    where each right item is either the row with the matching key from the
+    corresponding iterator, or None if there is no such row.
+
+    Rows can be anything which supports indexing by `on` (e.g. dicts keyed by
+    field name, or tuples indexed by position). Keys are compared as integers.
+
+    Assumes that all iterators are already sorted by key and that keys are
+    unique within each of the right iterators. This means we only ever need
+    to hold one row from each iterator in memory at a time.
+    """
+
+    def __init__(self, left_rows, *right_rows, on="id"):
+        self.left_iter = iter(left_rows)
+        self.right_iters = [iter(rows) for rows in right_rows]
+        self.get_key = lambda item: int(item[on])
+        self.right_items = [next(right_iter, None) for right_iter in self.right_iters]
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        left_item = next(self.left_iter)
+        left_key = self.get_key(left_item)
+        right_items = [
+            self.next_right_item(index, left_key)
+            for index in range(len(self.right_iters))
+        ]
+        return (left_item, *right_items)
+
+    def next_right_item(self, index, left_key):
+        while True:
+            right_item = self.right_items[index]
+            # No more right items remaining: return None
+            if right_item is None:
+                return
+            right_key = self.get_key(right_item)
+            # Keys match: this is the item we want
+            if right_key == left_key:
+                return right_item
+            # Right key is greater: return None until left catches up
+            elif right_key > left_key:
+                return
+            # Right key is lesser: grab the next right item and try again
+            else:
+                self.right_items[index] = next(self.right_iters[index], None)
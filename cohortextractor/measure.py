@@ -1,5 +1,11 @@
+import itertools
+import threading
+
+import pandas as pd
+
+
 class Measure:
-    def __init__(self, id, denominator, numerator, group_by=None):
+    def __init__(self, id, denominator, numerator, group_by=None, grouping_sets=None):
         """
         Creates a "measure" using data extracted by the StudyDefinition defined
         in the same file.
@@ -22,6 +28,12 @@ class Measure:
                 "population" to treat the entire population as a single group.
                 Set group_by to None (or omit it entirely) to perform no
                 grouping and leave the data at individual patient level.
+            grouping_sets: A list of groupings, each of which is given in the
+                same form as `group_by`. This is equivalent to defining a
+                separate measure for each grouping (with the id
+                `<id>_by_<column>_and_<column>...`), but all the groupings are
+                calculated together so that the patient data is only
+                aggregated once. Cannot be combined with `group_by`.
 
         Returns:
             Measure instance
@@ -29,9 +41,175 @@ class Measure:
         self.id = id
         self.denominator = denominator
         self.numerator = numerator
+        self.group_by = self.get_columns(group_by)
+        if grouping_sets is not None:
+            if self.group_by:
+                raise ValueError(
+                    f"Measure '{id}' cannot have both group_by and grouping_sets"
+                )
+            grouping_sets = [self.get_columns(columns) for columns in grouping_sets]
+            if not all(grouping_sets):
+                raise ValueError(
+                    f"Measure '{id}' has an empty grouping: use the special "
+                    f"column 'population' to group the entire population"
+                )
+        self.grouping_sets = grouping_sets
+
+    @staticmethod
+    def get_columns(group_by):
         if group_by is None:
-            self.group_by = []
+            return []
         elif not isinstance(group_by, (list, tuple)):
-            self.group_by = [group_by]
+            return [group_by]
         else:
-            self.group_by = group_by
+            return group_by
+
+    def expand(self):
+        """
+        Return the list of measures to calculate for this measure: one for
+        each grouping if it has `grouping_sets`, otherwise just itself
+        """
+        if self.grouping_sets is None:
+            return [self]
+        return [
+            Measure(
+                id=f"{self.id}_by_{'_and_'.join(group_by)}",
+                denominator=self.denominator,
+                numerator=self.numerator,
+                group_by=group_by,
+            )
+            for group_by in self.grouping_sets
+        ]
+
+
+class MeasureAggregator:
+    """
+    Calculates a measure from patient rows as they are downloaded, so that
+    its results can be written without re-reading the patient-level file
+
+    This is a "sink" for the backends' download loops: `start()` is called
+    with the column headers and then `add_row()` with each row. Values may be
+    as returned by the database or as read back from CSV, so they're
+    compared using the same string representation the CSV writer uses. The
+    results match those which `generate_measures` produces from the CSV file.
+
+    Rows may be added from several download threads at once, and so in any
+    order.
+    """
+
+    def __init__(self, measure):
+        self.measure = measure
+        self.headers = None
+        self.totals = {}
+        self.patient_rows = []
+        self.lock = threading.Lock()
+
+    def start(self, headers):
+        with self.lock:
+            if self.headers is not None:
+                if list(headers) != self.headers:
+                    raise RuntimeError(
+                        f"Headers {list(headers)} do not match {self.headers}"
+                    )
+                return
+            self.headers = list(headers)
+            self.group_by_indices = [
+                self.get_index(column) for column in self.measure.group_by
+            ]
+            self.patient_id_index = self.get_index("patient_id")
+            self.value_indices = [
+                self.get_index(self.measure.numerator),
+                self.get_index(self.measure.denominator),
+            ]
+
+    def get_index(self, column):
+        # The special "population" column has the value 1 for every patient
+        if column == "population":
+            return None
+        try:
+            return self.headers.index(column)
+        except ValueError:
+            raise ValueError(
+                f"Measure '{self.measure.id}' uses column '{column}' which is "
+                f"not in the output"
+            )
+
+    def add_row(self, row):
+        values = [self.get_number(row, index) for index in self.value_indices]
+        with self.lock:
+            if not self.measure.group_by:
+                patient_id = int(row[self.patient_id_index])
+                self.patient_rows.append((patient_id, *values))
+                return
+            key = tuple(self.get_string(row, index) for index in self.group_by_indices)
+            self._add_to_totals(key, values)
+
+    def add_totals(self, group_values, numerator, denominator):
+        """
+        Add a numerator and denominator which have already been summed (e.g.
+        by the database) for the group with the given `group_values`, which
+        are in the order of the measure's `group_by` columns
+        """
+        key = tuple("" if value is None else str(value) for value in group_values)
+        values = [
+            0.0 if value is None else float(value) for value in [numerator, denominator]
+        ]
+        with self.lock:
+            self._add_to_totals(key, values)
+
+    def _add_to_totals(self, key, values):
+        totals = self.totals.get(key)
+        if totals is None:
+            self.totals[key] = values
+        else:
+            totals[0] += values[0]
+            totals[1] += values[1]
+
+    @staticmethod
+    def get_number(row, index):
+        if index is None:
+            return 1
+        value = row[index]
+        if value is None or value == "":
+            return 0.0
+        return float(value)
+
+    @staticmethod
+    def get_string(row, index):
+        if index is None:
+            return "1"
+        value = row[index]
+        return "" if value is None else str(value)
+
+    def get_df(self):
+        """
+        Return the results as a dataframe in the same form as `generate_measures`
+        produces, i.e. with a row for every combination of the values observed
+        in each grouping column
+        """
+        numerator = self.measure.numerator
+        denominator = self.measure.denominator
+        if not self.measure.group_by:
+            patient_rows = sorted(self.patient_rows)
+            df = pd.DataFrame(
+                [row[1:] for row in patient_rows], columns=["numerator", "denominator"]
+            )
+        else:
+            group_values = [
+                sorted(set(key[n] for key in self.totals))
+                for n in range(len(self.measure.group_by))
+            ]
+            keys = list(itertools.product(*group_values))
+            df = pd.DataFrame(keys, columns=self.measure.group_by)
+            df["numerator"] = [self.totals.get(key, (0, 0))[0] for key in keys]
+            df["denominator"] = [self.totals.get(key, (0, 0))[1] for key in keys]
+        for name, column in [("numerator", numerator), ("denominator", denominator)]:
+            dtype = "int64" if column == "population" else "float64"
+            df[name] = df[name].astype(dtype)
+        df = df.rename(columns={"numerator": numerator, "denominator": denominator})
+        df = df[[*self.measure.group_by, numerator, denominator]]
+        df["value"] = df[numerator] / df[denominator]
+        return df
+
+    def to_csv(self, filename):
+        self.get_df().to_csv(filename, index=False)
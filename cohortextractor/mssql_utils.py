@@ -100,11 +100,16 @@ def mssql_table_to_csv(
     retries=2,
     sleep=0.5,
     row_callback=None,
+    sinks=(),
 ):
     """
     Download the contents of a table to a CSV file, calling `row_callback` (if
     defined) on each row as it does so.
 
+    Each of `sinks` (e.g. a `MeasureAggregator`) is passed the headers via its
+    `start()` method and then each row via its `add_row()` method, so that
+    other outputs can be produced in the same pass as the CSV.
+
     The table must have a unique integer `key_column` which can be used for
     paging the results. For performance reasons this column should be indexed.
 
@@ -124,16 +129,22 @@ def mssql_table_to_csv(
         result_batch = fetch_batch()
         headers = [x[0] for x in cursor.description]
         writer.writerow(headers)
+        for sink in sinks:
+            sink.start(headers)
         key_column_index = headers.index(key_column)
         for row in result_batch:
             writer.writerow(row)
             row_callback(row)
+            for sink in sinks:
+                sink.add_row(row)
         while len(result_batch) == batch_size:
             min_key = result_batch[-1][key_column_index]
             result_batch = fetch_batch(min_key)
             for row in result_batch:
                 writer.writerow(row)
                 row_callback(row)
+                for sink in sinks:
+                    sink.add_row(row)
 
 
 def _fetch_batch_with_retries(
@@ -0,0 +1,44 @@
+import csv
+import os
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        raise RuntimeError("Parquet output requires the pyarrow package")
+    return pyarrow
+
+
+def csv_to_parquet(csv_filename, parquet_filename):
+    """
+    Convert a CSV file written by a backend into a Parquet file, reading and
+    writing it in batches so that memory use doesn't depend on the size of the
+    file
+
+    Apart from `patient_id` every column is stored as a (dictionary-encoded)
+    string exactly as it appears in the CSV, with empty values as empty
+    strings. This means that readers interpret values in just the same way
+    whichever format they were written in.
+    """
+    pyarrow = import_pyarrow()
+    from pyarrow import csv as pyarrow_csv
+    from pyarrow import parquet
+
+    with open(csv_filename, newline="") as f:
+        headers = next(csv.reader(f))
+    column_types = {name: pyarrow.string() for name in headers}
+    column_types["patient_id"] = pyarrow.int64()
+    reader = pyarrow_csv.open_csv(
+        csv_filename,
+        convert_options=pyarrow_csv.ConvertOptions(
+            column_types=column_types, strings_can_be_null=False
+        ),
+    )
+    # Write to a temporary file first so that an interrupted conversion
+    # doesn't leave behind something which looks complete
+    temp_filename = f"{parquet_filename}.tmp"
+    with parquet.ParquetWriter(temp_filename, reader.schema) as writer:
+        for batch in reader:
+            writer.write_batch(batch)
+    os.replace(temp_filename, parquet_filename)
@@ -1,5 +1,9 @@
+import csv
+import json
 import os
+import queue
 import readline  # noqa -- importing this adds readline behaviour to input()
+import threading
 import time
 from urllib.parse import unquote, urlparse
 
@@ -17,6 +21,15 @@ urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 sql_logger = structlog.get_logger("cohortextractor.sql")
 
+# Maps the fields we report for each query to the names Presto uses for them
+QUERY_STATS_FIELDS = {
+    "wall_time_ms": "wallTimeMillis",
+    "cpu_time_ms": "cpuTimeMillis",
+    "processed_rows": "processedRows",
+    "processed_bytes": "processedBytes",
+    "peak_memory_bytes": "peakMemoryBytes",
+}
+
 
 def presto_connection_from_url(url):
     """Return a connection to Presto instance at given URL."""
@@ -130,7 +143,10 @@ class ConnectionProxy:
     def cursor(self):
         """Return a proxied cursor."""
 
-        return CursorProxy(self.connection.cursor())
+        return CursorProxy(
+            self.connection.cursor(),
+            prefetch_batches=int(os.environ.get("PRESTO_PREFETCH_BATCHES", 1)),
+        )
 
 
 class CursorProxy:
@@ -142,22 +158,34 @@ class CursorProxy:
       not later when you fetch the results)
     * the .description attribute is set immediately after calling .execute()
     * you can iterate over it to yield rows
+    * while you're iterating, subsequent batches of rows are fetched in a
+      background thread so that fetching and processing overlap; any exceptions
+      raised when fetching these are re-raised by the iterator
     * .fetchone()/.fetchmany()/.fetchall() are disabled (they are not currently
       used by EMISBackend, although they could be implemented if required)
+    * .query_stats holds the statistics Presto reports for the last query (see
+      QUERY_STATS_FIELDS), updated as results are fetched
     """
 
     _rows = None
+    _prefetch_thread = None
+    _prefetch_stopped = None
+    query_stats = None
 
-    def __init__(self, cursor, batch_size=10 ** 6):
+    def __init__(self, cursor, batch_size=10 ** 6, prefetch_batches=1):
         """Initialise proxy.
 
         cursor: the presto.dbapi.Cursor to be proxied
         batch_size: the number of records to fetch at a time (this will need to
             be tuned)
+        prefetch_batches: the maximum number of batches to hold, fetched but
+            not yet iterated over, in addition to the one being iterated over
+            and the one being fetched (0 disables background fetching)
         """
 
         self.cursor = cursor
         self.batch_size = batch_size
+        self.prefetch_batches = prefetch_batches
 
     def __getattr__(self, attr):
         """Pass any unhandled attribute lookups to proxied cursor."""
@@ -175,15 +203,83 @@ class CursorProxy:
         """
 
         sql_logger.debug(sql)
+        self._stop_prefetching()
         self.cursor.execute(sql, *args, **kwargs)
         self._rows = self.cursor.fetchmany()
+        self._update_query_stats()
+        sql_logger.debug("Query stats", **self.query_stats)
+
+    def _update_query_stats(self):
+        stats = getattr(self.cursor, "stats", None) or {}
+        self.query_stats = {
+            field: stats.get(presto_field)
+            for (field, presto_field) in QUERY_STATS_FIELDS.items()
+        }
 
     def __iter__(self):
         """Iterate over results."""
 
-        while self._rows:
-            yield from iter(self._rows)
-            self._rows = self.cursor.fetchmany(self.batch_size)
+        if not self.prefetch_batches:
+            while self._rows:
+                yield from iter(self._rows)
+                self._rows = self.cursor.fetchmany(self.batch_size)
+            self._update_query_stats()
+            return
+        if not self._rows:
+            return
+        batches = queue.Queue(maxsize=self.prefetch_batches)
+        stopped = threading.Event()
+        thread = threading.Thread(
+            target=self._fetch_batches, args=(batches, stopped), daemon=True
+        )
+        self._prefetch_thread = thread
+        self._prefetch_stopped = stopped
+        thread.start()
+        try:
+            rows = self._rows
+            while rows:
+                yield from iter(rows)
+                rows = batches.get()
+                if isinstance(rows, Exception):
+                    raise rows
+            self._update_query_stats()
+        finally:
+            self._rows = []
+            stopped.set()
+
+    def _fetch_batches(self, batches, stopped):
+        """Fetch batches into the supplied queue until there are no more rows,
+        an error occurs, or iteration is abandoned (signalled by `stopped`)."""
+
+        while not stopped.is_set():
+            try:
+                rows = self.cursor.fetchmany(self.batch_size)
+            except Exception as e:
+                rows = e
+            # Wait for space in the queue, but give up if iteration stops
+            while not stopped.is_set():
+                try:
+                    batches.put(rows, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if not rows or isinstance(rows, Exception):
+                break
+
+    def _stop_prefetching(self):
+        """Stop any background fetching left running by abandoned iteration
+        and wait for it to finish, so that it can't use the cursor at the same
+        time as we do."""
+
+        if self._prefetch_thread is not None:
+            self._prefetch_stopped.set()
+            self._prefetch_thread.join()
+            self._prefetch_thread = None
+            self._prefetch_stopped = None
+
+    def close(self):
+        self._stop_prefetching()
+        self.cursor.close()
 
     def fetchone(self):
         raise RuntimeError("Iterate over cursor to get results")
@@ -195,6 +291,190 @@ class CursorProxy:
         raise RuntimeError("Iterate over cursor to get results")
 
 
+def presto_table_to_csv(
+    filename,
+    connection,
+    table,
+    key_column,
+    batch_size=2 ** 16,
+    retries=2,
+    sleep=0.5,
+    row_callback=None,
+    min_key=None,
+    max_key=None,
+    sinks=(),
+):
+    """
+    Download the contents of a table to a CSV file, calling `row_callback` (if
+    defined) on each row as it does so.
+
+    Each of `sinks` (e.g. a `MeasureAggregator`) is passed the headers via its
+    `start()` method and then each row via its `add_row()` method, so that
+    other outputs can be produced in the same pass as the CSV.
+
+    The table must have a unique integer `key_column` which can be used for
+    paging the results. Only rows with keys greater than `min_key` and no
+    greater than `max_key` (where supplied) are downloaded.
+
+    We split the keys into consecutive ranges, each holding about `batch_size`
+    rows if the keys are spread evenly (as patient_ids are), and download each
+    range as a page. The boundaries are calculated up front with a single
+    query, so that each page only has to filter on its own range and sort its
+    own rows. (Paging with `ORDER BY key LIMIT n` instead would make Presto
+    sort the remainder of the table for every page.)
+
+    Failed requests are automatically retried after a pause of `sleep`,
+    assuming `retries` is greater than zero.
+
+    After each page we record our progress in a checkpoint file alongside
+    `filename`. If the download is interrupted then calling this function
+    again with the same arguments resumes after the last complete page. The
+    checkpoint file is deleted once the download is complete. The rows
+    downloaded before the interruption are read back from the file and passed
+    to `row_callback` and the sinks, so that they still see every row. These
+    rows hold strings as read from the CSV, except for `key_column` which is
+    converted back to an integer.
+    """
+    if row_callback is None:
+        row_callback = lambda x: None  # noqa
+
+    checkpoint_file = f"{filename}.checkpoint"
+    checkpoint = read_checkpoint(checkpoint_file, table, min_key, max_key)
+
+    def fetch_page(page_min_key, page_max_key):
+        condition = _get_key_range_condition(key_column, page_min_key, page_max_key)
+        query = f"SELECT * FROM {table} {condition} ORDER BY {key_column}"
+        return _execute_with_retries(connection, query, retries, sleep)
+
+    def save_checkpoint(csvfile, last_key):
+        csvfile.flush()
+        os.fsync(csvfile.fileno())
+        checkpoint = dict(
+            table=table,
+            min_key=min_key,
+            max_key=max_key,
+            last_key=last_key,
+            offset=csvfile.tell(),
+        )
+        with open(f"{checkpoint_file}.tmp", "w") as f:
+            json.dump(checkpoint, f)
+        os.replace(f"{checkpoint_file}.tmp", checkpoint_file)
+
+    resuming = checkpoint and os.path.exists(filename)
+    last_key = checkpoint["last_key"] if resuming else min_key
+    pages = _get_page_ranges(
+        connection, table, key_column, batch_size, last_key, max_key, retries, sleep
+    )
+    result_batch, headers = fetch_page(*pages[0])
+    key_column_index = headers.index(key_column)
+    if resuming:
+        sql_logger.info(f"Resuming download of '{table}' after {key_column} {last_key}")
+        csvfile = open(filename, "r+", newline="")
+        # Discard anything written after the last checkpoint
+        csvfile.seek(checkpoint["offset"])
+        csvfile.truncate()
+        csvfile.seek(0)
+        reader = csv.reader(csvfile)
+        existing_headers = next(reader)
+        for sink in sinks:
+            sink.start(existing_headers)
+        for row in reader:
+            row[key_column_index] = int(row[key_column_index])
+            row_callback(row)
+            for sink in sinks:
+                sink.add_row(row)
+        csvfile.seek(0, os.SEEK_END)
+    else:
+        csvfile = open(filename, "w", newline="")
+        csv.writer(csvfile).writerow(headers)
+        for sink in sinks:
+            sink.start(headers)
+    with csvfile:
+        writer = csv.writer(csvfile)
+        for n, (page_min_key, page_max_key) in enumerate(pages):
+            if n > 0:
+                result_batch, _ = fetch_page(page_min_key, page_max_key)
+            for row in result_batch:
+                writer.writerow(row)
+                row_callback(row)
+                for sink in sinks:
+                    sink.add_row(row)
+            if page_max_key is not None:
+                save_checkpoint(csvfile, page_max_key)
+    if os.path.exists(checkpoint_file):
+        os.unlink(checkpoint_file)
+
+
+def read_checkpoint(checkpoint_file, table, min_key, max_key):
+    """
+    Return the checkpoint recorded by an interrupted download of the same rows
+    of `table`, or None if there isn't one
+    """
+    try:
+        with open(checkpoint_file) as f:
+            checkpoint = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return
+    if checkpoint.get("table") != table:
+        return
+    if (checkpoint.get("min_key"), checkpoint.get("max_key")) != (min_key, max_key):
+        return
+    return checkpoint
+
+
+def _get_page_ranges(
+    connection, table, key_column, batch_size, min_key, max_key, retries, sleep
+):
+    """
+    Split the keys greater than `min_key` and no greater than `max_key` into
+    consecutive ranges of equal width, each expected to hold about
+    `batch_size` rows, returning a list of (exclusive min, inclusive max)
+    pairs. There's always at least one range, even if there are no rows.
+    """
+    condition = _get_key_range_condition(key_column, min_key, max_key)
+    query = f"SELECT MIN({key_column}), MAX({key_column}), COUNT(*) FROM {table} {condition}"
+    rows, _ = _execute_with_retries(connection, query, retries, sleep)
+    first_key, last_key, count = rows[0]
+    if not count:
+        return [(min_key, max_key)]
+    page_count = -(-count // batch_size)
+    width = -(-(last_key - first_key + 1) // page_count)
+    return [
+        (start - 1, min(start + width - 1, last_key))
+        for start in range(first_key, last_key + 1, width)
+    ]
+
+
+def _get_key_range_condition(key_column, min_key, max_key):
+    conditions = []
+    if min_key is not None:
+        assert isinstance(min_key, int)
+        conditions.append(f"{key_column} > {min_key}")
+    if max_key is not None:
+        assert isinstance(max_key, int)
+        conditions.append(f"{key_column} <= {max_key}")
+    return f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+
+def _execute_with_retries(connection, query, retries, sleep):
+    while True:
+        try:
+            # A new cursor for each query means we don't depend on the HTTP
+            # session used for any previous page
+            cursor = connection.cursor()
+            cursor.execute(query)
+            headers = [x[0] for x in cursor.description]
+            return list(cursor), headers
+        # We can't be more specific than this because we don't know what class
+        # of cursor object we'll be passed
+        except Exception:
+            if retries <= 0:
+                raise
+            else:
+                retries -= 1
+                time.sleep(sleep)
+
+
 def repl(url):
     """Run a simple REPL against a Presto database at given URL."""
 
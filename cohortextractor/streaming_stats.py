@@ -0,0 +1,253 @@
+import numpy as np
+
+
+class QuantileSketch:
+    """
+    A summary of a stream of numbers, updated a batch at a time, from which
+    quantiles and histograms can be estimated in fixed memory
+
+    Values are held as weighted centroids, each covering a range of values
+    which doesn't overlap any other's. While there are no more than
+    `max_centroids` distinct values each centroid is a single value with an
+    exact count, so results are exact (and match NumPy's) for columns with
+    few distinct values such as ages or dates over a few years. Beyond that,
+    adjacent centroids are merged as in a "merging t-digest"
+    (https://arxiv.org/abs/1902.04023): centroids near the tails are kept
+    small so that extreme quantiles stay accurate, and there are roughly
+    `compression / 2` of them after merging. Values common enough to fill a
+    centroid on their own (e.g. zeros standing in for missing values) keep
+    their exact counts.
+    """
+
+    def __init__(self, compression=5000, max_centroids=20000):
+        self.compression = compression
+        self.max_centroids = max_centroids
+        self.means = np.array([], dtype="float64")
+        self.weights = np.array([], dtype="int64")
+        self.mins = np.array([], dtype="float64")
+        self.maxs = np.array([], dtype="float64")
+
+    @property
+    def count(self):
+        return int(self.weights.sum())
+
+    @property
+    def min(self):
+        return self.mins[0] if len(self.mins) else np.nan
+
+    @property
+    def max(self):
+        return self.maxs[-1] if len(self.maxs) else np.nan
+
+    @property
+    def exact(self):
+        return bool((self.mins == self.maxs).all())
+
+    def copy(self):
+        return self.where(slice(None))
+
+    def update(self, values, weights=None):
+        """Add `values` (ignoring NaNs), each with a count of 1 unless
+        `weights` is supplied
+        """
+        values = np.asarray(values, dtype="float64")
+        if weights is None:
+            weights = np.ones(len(values), dtype="int64")
+        weights = np.asarray(weights, dtype="int64")
+        present = ~np.isnan(values)
+        values, weights = values[present], weights[present]
+        if not len(values):
+            return
+        merged = self.mins < self.maxs
+        if merged.any():
+            # Add values within the range of a merged centroid to it
+            index = np.maximum(np.searchsorted(self.mins, values, side="right") - 1, 0)
+            inside = merged[index] & (values >= self.mins[index])
+            inside &= values <= self.maxs[index]
+            index = index[inside]
+            size = len(self.means)
+            sums = self.means * self.weights + np.bincount(
+                index, weights=values[inside] * weights[inside], minlength=size
+            )
+            self.weights = self.weights + np.bincount(
+                index, weights=weights[inside], minlength=size
+            ).astype("int64")
+            self.means = sums / self.weights
+            values, weights = values[~inside], weights[~inside]
+        # Everything else is either a new value or the value of an existing
+        # singleton centroid
+        means, inverse = np.unique(
+            np.concatenate([self.means, values]), return_inverse=True
+        )
+        self.weights = np.bincount(
+            inverse, weights=np.concatenate([self.weights, weights])
+        ).astype("int64")
+        merged_index = inverse[: len(merged)][merged]
+        mins, maxs = self.mins[merged], self.maxs[merged]
+        self.means, self.mins, self.maxs = means, means.copy(), means.copy()
+        self.mins[merged_index] = mins
+        self.maxs[merged_index] = maxs
+        if len(self.means) > self.max_centroids:
+            self.compress()
+
+    def compress(self):
+        total = self.weights.sum()
+        q_left = (np.cumsum(self.weights) - self.weights) / total
+        # Each group of adjacent centroids spans at most one unit of the
+        # t-digest's arcsine scale function
+        k = self.compression / (2 * np.pi) * np.arcsin(2 * q_left - 1)
+        groups = np.floor(k - k[0]).astype("int64")
+        starts = np.flatnonzero(np.diff(groups, prepend=-1))
+        ends = np.append(starts[1:], len(groups)) - 1
+        weights = np.add.reduceat(self.weights, starts)
+        self.means = np.add.reduceat(self.means * self.weights, starts) / weights
+        self.weights = weights
+        self.mins = self.mins[starts]
+        self.maxs = self.maxs[ends]
+
+    def where(self, mask):
+        """Return a sketch of just the values in the centroids selected by
+        `mask`, a boolean array the same length as `self.means`
+
+        For an exact sketch this selects exactly the values for which `mask`
+        is true.
+        """
+        sketch = QuantileSketch(self.compression, self.max_centroids)
+        sketch.means = self.means[mask]
+        sketch.weights = self.weights[mask]
+        sketch.mins = self.mins[mask]
+        sketch.maxs = self.maxs[mask]
+        return sketch
+
+    def quantile(self, q):
+        """Estimate the `q`th quantile (or an array of quantiles), with
+        `q` between 0 and 1, interpolating linearly as NumPy does by default
+        """
+        q = np.asarray(q, dtype="float64")
+        if not len(self.means):
+            return np.full(q.shape, np.nan)
+        total = self.weights.sum()
+        if self.exact:
+            cumulative = np.cumsum(self.weights)
+            position = q * (total - 1)
+            lower = np.floor(position)
+            upper = np.ceil(position)
+            lower_value = self.means[np.searchsorted(cumulative, lower, side="right")]
+            upper_value = self.means[np.searchsorted(cumulative, upper, side="right")]
+            return lower_value + (upper_value - lower_value) * (position - lower)
+        values, ranks = self._get_cdf_points()
+        return np.interp(q * total, ranks, values)
+
+    def histogram(self, edges):
+        """Estimate the number of values in each bin defined by `edges`,
+        following the same conventions as `numpy.histogram`
+        """
+        if self.exact:
+            counts, _ = np.histogram(self.means, bins=edges, weights=self.weights)
+            return counts.astype("int64")
+        edges = np.asarray(edges, dtype="float64")
+        values, ranks = self._get_cdf_points()
+        # Bins include their lower edge, except that the last bin also
+        # includes its upper edge
+        below = _interpolate_ranks(values, ranks, edges, side="left")
+        below[-1] = _interpolate_ranks(values, ranks, edges[-1:], side="right")[0]
+        return np.round(np.diff(below)).astype("int64")
+
+    def _get_cdf_points(self):
+        """
+        Return arrays of values and their ranks, between which the empirical
+        distribution function can be linearly interpolated
+
+        Half of the values in a merged centroid are assumed to be spread evenly
+        between its minimum and its mean and half between its mean and its
+        maximum, whereas a singleton is a step from the bottom to the top of
+        its range of ranks.
+        """
+        cumulative = np.cumsum(self.weights)
+        values = np.stack([self.mins, self.means, self.maxs], axis=1)
+        ranks = np.stack(
+            [cumulative - self.weights, cumulative - self.weights / 2, cumulative],
+            axis=1,
+        )
+        keep = np.ones(values.shape, dtype=bool)
+        keep[:, 1] = self.mins < self.maxs
+        return values[keep], ranks[keep]
+
+
+def _interpolate_ranks(values, ranks, x, side):
+    """
+    Linearly interpolate the rank of each of `x` from the points (`values`,
+    `ranks`), where `values` may repeat to form steps: with `side="left"` the
+    bottom of a step is used for `x` equal to its value, and with
+    `side="right"` the top
+    """
+    index = np.clip(np.searchsorted(values, x, side=side), 1, len(values) - 1)
+    low, high = values[index - 1], values[index]
+    fraction = np.divide(
+        x - low, high - low, out=np.zeros(len(x)), where=high > low
+    ).clip(0, 1)
+    return ranks[index - 1] + (ranks[index] - ranks[index - 1]) * fraction
+
+
+class RunningMoments:
+    """
+    Count, mean and variance of a stream of numbers, updated a batch at a
+    time using Chan et al's parallel form of Welford's algorithm
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def update(self, values):
+        values = np.asarray(values, dtype="float64")
+        values = values[~np.isnan(values)]
+        count = len(values)
+        if not count:
+            return
+        mean = values.mean()
+        m2 = np.square(values - mean).sum()
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta ** 2 * self.count * count / total
+        self.count = total
+
+    @property
+    def std(self):
+        """Sample standard deviation, as given by pandas"""
+        if self.count < 2:
+            return np.nan
+        return np.sqrt(self.m2 / (self.count - 1))
+
+
+class TopKCounter:
+    """
+    Counts of the distinct values in a stream, keeping at most `max_values`
+    of them
+
+    Counts are exact until more than `max_values` distinct values have been
+    seen. After that only the most frequent are kept, so the counts of
+    values which were dropped and then seen again will be underestimates.
+    """
+
+    def __init__(self, max_values=1000):
+        self.max_values = max_values
+        self.counts = {}
+        self.total = 0
+        self.exact = True
+
+    def update(self, value_counts):
+        """Add the counts in `value_counts`, a dict-like of value -> count"""
+        for value, count in value_counts.items():
+            if count:
+                self.counts[value] = self.counts.get(value, 0) + int(count)
+                self.total += int(count)
+        if len(self.counts) > self.max_values:
+            self.counts = dict(self.most_common(self.max_values))
+            self.exact = False
+
+    def most_common(self, n=None):
+        by_count = sorted(self.counts.items(), key=lambda item: -item[1])
+        return by_count if n is None else by_count[:n]
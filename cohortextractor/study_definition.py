@@ -1,17 +1,25 @@
 import collections
 import copy
+import csv
 import os
 import re
 
+import numpy as np
 import pandas as pd
-from numpy.random import default_rng
+from pandas.api.types import is_categorical_dtype
 
 from .date_expressions import (
     evaluate_date_expressions_in_covariate_definitions,
     evaluate_date_expressions_in_expectations_definition,
     validate_date,
 )
-from .expectation_generators import generate
+from .expectation_generators import (
+    generate,
+    get_age_probabilities,
+    get_date_probability,
+    get_rng,
+)
+from .expressions import InvalidExpressionError, compile_expression
 from .process_covariate_definitions import process_covariate_definitions
 
 
@@ -67,27 +75,145 @@ class StudyDefinition:
                 temporary_database=self.temporary_database,
             )
 
-    def to_csv(self, filename, expectations_population=False, **kwargs):
+    def to_csv(
+        self,
+        filename,
+        expectations_population=False,
+        expectations_seed=None,
+        **kwargs,
+    ):
         if expectations_population:
-            df = self.make_df_from_expectations(expectations_population)
-            # Add a patient ID - a randomly generated integer from an
-            # array 10x larger than the cohort.
-            df["patient_id"] = default_rng().choice(
-                (len(df) * 10), size=len(df), replace=False
+            self.expectations_to_csv(
+                filename, expectations_population, expectations_seed
             )
-            df.to_csv(filename, index=False)
         else:
             self.assert_backend_is_configured()
             self.backend.to_csv(filename, **kwargs)
 
-    def csv_to_df(self, csv_name):
-        return pd.read_csv(
-            csv_name,
-            dtype=self.pandas_csv_args["dtype"],
-            converters=self.pandas_csv_args["converters"],
-            parse_dates=self.pandas_csv_args["parse_dates"],
+    def expectations_to_csv(self, filename, population, seed=None):
+        """
+        Write a dummy cohort of `population` patients to `filename`
+
+        The cohort is generated and written in chunks of
+        EXPECTATIONS_CHUNK_SIZE patients so that memory use depends on the
+        chunk size rather than on the size of the population. Each chunk is
+        generated independently so incidence (and matching incidence between
+        columns) holds within every chunk, just as it does for the whole.
+        """
+        chunk_size = int(os.environ.get("EXPECTATIONS_CHUNK_SIZE", 1000000))
+        rng = get_rng(seed)
+        # We always generate at least one (possibly empty) chunk so that the
+        # file has a header row even when the population is empty
+        offsets = range(0, population, chunk_size) or [0]
+        with open(filename, "w", newline="") as f:
+            for offset in offsets:
+                size = min(chunk_size, population - offset)
+                df = self.make_df_from_expectations(size, seed=rng)
+                # Add a patient ID - a randomly generated integer from an
+                # array 10x larger than the cohort. Each chunk draws from its
+                # own slice of that array so IDs are unique across chunks.
+                df["patient_id"] = offset * 10 + rng.choice(
+                    size * 10, size=size, replace=False
+                )
+                df.to_csv(f, index=False, header=(offset == 0))
+
+    def csv_to_df(self, csv_name, chunksize=None):
+        """
+        Load a CSV file produced by `to_csv` into a dataframe with the
+        appropriate type for each column
+
+        Rather than passing per-cell converters to `read_csv` (which disables
+        the parser's fast paths) we read bool and date columns as categories
+        and convert only their distinct values, using the known date format of
+        each column. Similarly, nullable integers are much slower to parse than
+        floats so we read them as floats and convert afterwards.
+
+        If `chunksize` is given, return an iterator of dataframes of at most
+        that many rows each instead, so that large files can be processed in
+        fixed memory.
+        """
+        dtype = self.pandas_csv_args["dtype"].copy()
+        for name in self.pandas_csv_args["parse_dates"]:
+            dtype[name] = "category"
+        for name, type_ in self.pandas_csv_args["dtype"].items():
+            if type_ == "bool":
+                dtype[name] = "category"
+            elif type_ == "Int64":
+                dtype[name] = "float64"
+        if chunksize is None:
+            return self._convert_csv_df(pd.read_csv(csv_name, dtype=dtype))
+        return (
+            self._convert_csv_df(df)
+            for df in pd.read_csv(csv_name, dtype=dtype, chunksize=chunksize)
         )
 
+    def _convert_csv_df(self, df):
+        dtype = self.pandas_csv_args["dtype"]
+        bool_columns = [name for name, type_ in dtype.items() if type_ == "bool"]
+        int_columns = [name for name, type_ in dtype.items() if type_ == "Int64"]
+        date_columns = self.pandas_csv_args["parse_dates"]
+        for name in int_columns:
+            df[name] = df[name].astype("Int64")
+        for name in df.columns:
+            if is_categorical_dtype(df[name]) and "" in df[name].cat.categories:
+                # Not all parsers treat empty strings as missing values
+                df[name] = df[name].cat.remove_categories([""])
+        for name in bool_columns:
+            df[name] = df[name].notnull() & (df[name] != "0")
+        for name in date_columns:
+            date_format = self.pandas_csv_args["args"][name].get("date_format")
+            categories = df[name].cat.categories
+            dates = pd.to_datetime(categories, format=PYTHON_DATE_FORMATS[date_format])
+            df[name] = df[name].cat.rename_categories(dates).astype("datetime64[ns]")
+        return df
+
+    def to_measure_csvs(self, measures, filenames):
+        """Calculate `measures` in the database, writing each one's results to
+        the file given for its ID in `filenames`, without downloading the
+        patient-level data
+        """
+        self.assert_backend_is_configured()
+        if not hasattr(self.backend, "to_measure_csvs"):
+            raise RuntimeError(
+                f"Calculating measures in the database is not supported by "
+                f"{self.backend.__class__.__name__}"
+            )
+        self.backend.to_measure_csvs(measures, filenames)
+
+    def to_profile_csv(self, filename):
+        """Profile each column in the database and write a comparison of its
+        aggregate statistics with its expectations to `filename`, without
+        downloading the patient-level data
+
+        Each row of the output gives a column, a statistic, the value expected
+        by the column's `return_expectations` (merged with the study's
+        `default_expectations`), where there is one, and the actual value.
+        """
+        self.assert_backend_is_configured()
+        if not hasattr(self.backend, "to_column_profiles"):
+            raise RuntimeError(
+                f"Profiling columns in the database is not supported by "
+                f"{self.backend.__class__.__name__}"
+            )
+        column_kinds = self.get_profile_column_kinds()
+        profiles = self.backend.to_column_profiles(column_kinds)
+        with open(filename, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["column", "statistic", "expected", "actual"])
+            for colname, kind in column_kinds.items():
+                comparison = self.compare_profile_with_expectations(
+                    colname, kind, profiles[colname]
+                )
+                for statistic, expected, actual in comparison:
+                    writer.writerow(
+                        [
+                            colname,
+                            statistic,
+                            "" if expected is None else expected,
+                            "" if actual is None else actual,
+                        ]
+                    )
+
     def to_sql(self):
         self.assert_backend_is_configured()
         return self.backend.to_sql()
@@ -220,7 +346,10 @@ class StudyDefinition:
             "date_col_for": date_col_for,
         }
 
-    def make_df_from_expectations(self, population):
+    def make_df_from_expectations(self, population, seed=None):
+        # `seed` can be an integer, for reproducible output, or a numpy
+        # Generator which is then shared by every column
+        rng = get_rng(seed)
         df = pd.DataFrame()
 
         # Start with dates, so we can use them as inputs for incidence
@@ -241,7 +370,7 @@ class StudyDefinition:
             kwargs = self.default_expectations.copy()
             kwargs = merge(kwargs, return_expectations)
             self.check_date_expectations_defined(colname, kwargs)
-            df[colname] = generate(population, **kwargs)["date"]
+            df[colname] = generate(population, rng=rng, **kwargs)["date"]
 
             # Now apply any date-based filtering specified in the study
             # definition
@@ -272,10 +401,10 @@ class StudyDefinition:
             dependent_date = self.pandas_csv_args["date_col_for"].get(colname)
             if dependent_date:
                 generated_df = generate(
-                    population, match_incidence=df[dependent_date], **kwargs
+                    population, rng=rng, match_incidence=df[dependent_date], **kwargs
                 )
             else:
-                generated_df = generate(population, **kwargs)
+                generated_df = generate(population, rng=rng, **kwargs)
             try:
                 if dtype == "Int64":
                     # When defining expectations, the more
@@ -294,8 +423,171 @@ class StudyDefinition:
             df[colname] = self.apply_date_precision_from_definition(
                 df[colname], **definition_args
             )
+        self.apply_category_definitions(df)
         return df
 
+    def apply_category_definitions(self, df):
+        """
+        Replace the randomly generated values of `categorised_as` (and
+        `satisfying`) columns with values derived from the generated columns
+        they refer to, so that the dummy data is internally consistent
+
+        Hidden columns aren't generated, so columns whose definitions refer to
+        them keep the values drawn from their `return_expectations`.
+        """
+        empty_value_map = {
+            name: 0 if args["column_type"] in ("bool", "int", "float") else ""
+            for name, args in self.pandas_csv_args["args"].items()
+        }
+        for colname, args in self.pandas_csv_args["args"].items():
+            category_definitions = args.get("category_definitions")
+            if not category_definitions:
+                continue
+            category_definitions = category_definitions.copy()
+            default = next(
+                category
+                for category, expression in category_definitions.items()
+                if expression == "DEFAULT"
+            )
+            category_definitions.pop(default)
+            try:
+                conditions = [
+                    (category, compile_expression(expression, empty_value_map))
+                    for category, expression in category_definitions.items()
+                ]
+            except (KeyError, InvalidExpressionError):
+                # Expressions were validated against all the columns when the
+                # study was defined, so this means the expression refers to a
+                # hidden column
+                continue
+            columns = {}
+            for _, (_, names) in conditions:
+                for name in names:
+                    if name not in columns:
+                        columns[name] = self.get_expression_values(
+                            df[name], empty_value_map[name]
+                        )
+            values = np.full(len(df), default, dtype=object)
+            # Assign in reverse so that, as in SQL's CASE, the first matching
+            # category wins
+            for category, (evaluate, _) in reversed(conditions):
+                values[np.asarray(evaluate(columns), dtype=bool)] = category
+            values = pd.Series(values, index=df.index)
+            if self.pandas_csv_args["dtype"].get(colname) == "category":
+                values = values.astype("category")
+                if "" not in values.cat.categories:
+                    values = values.cat.add_categories([""])
+            else:
+                values = values.infer_objects()
+            df[colname] = values
+
+    @staticmethod
+    def get_expression_values(series, empty_value):
+        """
+        Return the values of `series` as an array suitable for evaluating a
+        compiled expression against, with missing values replaced by
+        `empty_value`
+        """
+        if empty_value == "":
+            return series.astype(object).fillna("").to_numpy()
+        return series.fillna(empty_value).to_numpy()
+
+    def get_profile_column_kinds(self):
+        """Return a dict mapping each output column to the kind of profile
+        its values need (see `compare_profile_with_expectations`)
+        """
+        kinds = {"bool": "bool", "Int64": "int", "float": "float"}
+        return {
+            colname: "date"
+            if colname in self.pandas_csv_args["parse_dates"]
+            else kinds.get(self.pandas_csv_args["dtype"][colname], "category")
+            for colname in self.pandas_csv_args["args"]
+        }
+
+    def get_column_expectations(self, colname):
+        definition_args = self.pandas_csv_args["args"][colname]
+        if "source" in definition_args:
+            definition_args = self.pandas_csv_args["args"][definition_args["source"]]
+        return merge(
+            self.default_expectations.copy(),
+            definition_args.get("return_expectations") or {},
+        )
+
+    def compare_profile_with_expectations(self, colname, kind, rows):
+        """
+        Return a list of (statistic, expected, actual) tuples comparing the
+        aggregate `rows` calculated for `colname` by the backend's
+        `to_column_profiles` with its expectations
+
+        Bool and numeric columns have a single row summarising the values
+        which aren't missing; categories and dates have a row per value (or
+        month) giving its count, and the minimum and maximum values within it.
+        """
+        expectations = self.get_column_expectations(colname)
+        if expectations.get("rate") == "universal":
+            expected_incidence = 1.0
+        else:
+            expected_incidence = expectations.get("incidence")
+        if kind in ("bool", "int", "float"):
+            (row,) = rows
+            total, present = row["total"], row["present"]
+            comparison = [("incidence", expected_incidence, _ratio(present, total))]
+            if kind == "bool":
+                return comparison
+            expected_mean, expected_stddev = _get_expected_moments(
+                expectations.get(kind) or {}
+            )
+            return comparison + [
+                ("mean", expected_mean, row["mean"]),
+                ("stddev", expected_stddev, row["stddev"]),
+                ("min", None, row["min_value"]),
+                ("max", None, row["max_value"]),
+            ]
+        # Missing values are output as the default value for the column's
+        # type, which is 0 for numeric columns (e.g. IMD) even when we treat
+        # them as categories
+        column_type = self.pandas_csv_args["args"][colname]["column_type"]
+        empty_value = "0" if column_type in ("int", "float") else ""
+        total = sum(row["total"] for row in rows)
+        rows = [
+            row
+            for row in rows
+            if row["value"] is not None and str(row["value"]) != empty_value
+        ]
+        present = sum(row["total"] for row in rows)
+        comparison = [("incidence", expected_incidence, _ratio(present, total))]
+        if kind == "category":
+            ratios = (expectations.get("category") or {}).get("ratios") or {}
+            expected = {str(value): ratio for value, ratio in ratios.items()}
+            actual = {str(row["value"]): _ratio(row["total"], present) for row in rows}
+            for value in sorted(set(expected) | set(actual)):
+                comparison.append(
+                    (f"ratio[{value}]", expected.get(value), actual.get(value, 0.0))
+                )
+            return comparison
+        date = expectations.get("date") or {}
+        first = min((row["min_value"] for row in rows), default=None)
+        last = max((row["max_value"] for row in rows), default=None)
+        comparison += [
+            ("earliest", date.get("earliest"), first),
+            ("latest", date.get("latest"), last),
+        ]
+        for row in rows:
+            start, end = _get_date_bin(row["value"])
+            expected = None
+            if "earliest" in date and "latest" in date:
+                expected = get_date_probability(
+                    date["earliest"],
+                    date["latest"],
+                    expectations.get("rate", "exponential_increase"),
+                    start,
+                    end,
+                )
+            comparison.append(
+                (f"ratio[{row['value']}]", expected, _ratio(row["total"], present))
+            )
+        return comparison
+
     def validate_category_expectations(
         self,
         codelist=None,
@@ -359,6 +651,46 @@ class StudyDefinition:
                 raise ValueError(f"{colname} must define a date[{k}] expectation")
 
 
+# Maps the `date_format` argument of a column to the format of the values in
+# the CSV (dates without a format are output as years)
+PYTHON_DATE_FORMATS = {
+    None: "%Y",
+    "YYYY": "%Y",
+    "YYYY-MM": "%Y-%m",
+    "YYYY-MM-DD": "%Y-%m-%d",
+}
+
+
+def _ratio(numerator, denominator):
+    return numerator / denominator if denominator else None
+
+
+def _get_expected_moments(distribution):
+    """Return the mean and standard deviation of the values generated for an
+    `int` or `float` expectation, or Nones if we don't know them
+    """
+    if distribution.get("distribution") == "normal":
+        return distribution["mean"], distribution["stddev"]
+    elif distribution.get("distribution") == "population_ages":
+        p = get_age_probabilities()
+        ages = np.arange(len(p))
+        mean = float((ages * p).sum())
+        return mean, float(np.sqrt((p * (ages - mean) ** 2).sum()))
+    return None, None
+
+
+def _get_date_bin(value):
+    """Return the first day of the month or year in `value` (formatted as
+    YYYY-MM or YYYY) and the first day of the next one
+    """
+    if len(value) == 4:
+        year = int(value)
+        return f"{year}-01-01", f"{year + 1}-01-01"
+    year, month = map(int, value.split("-"))
+    next_year, next_month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return f"{year}-{month:02}-01", f"{next_year}-{next_month:02}-01"
+
+
 def merge(dict1, dict2):
     """ Return a new dictionary by merging two dictionaries recursively. """
 
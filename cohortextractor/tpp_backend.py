@@ -1,14 +1,23 @@
+import collections
+import concurrent.futures
+import contextlib
+import copy
+import csv
 import datetime
 import enum
 import hashlib
 import os
 import re
+import tempfile
 import uuid
 
 import structlog
 
+from .codelistlib import codelist as make_codelist
 from .date_expressions import MSSQLDateFormatter
 from .expressions import format_expression
+from .join_utils import LeftJoinSortedRows
+from .measure import MeasureAggregator
 from .mssql_utils import (
     mssql_connection_params_from_url,
     mssql_dbapi_connection_from_url,
@@ -22,19 +31,71 @@ logger = structlog.get_logger()
 safe_punctation = r" _.-+/()"
 SAFE_CHARS_RE = re.compile(f"^[a-zA-Z0-9{re.escape(safe_punctation)}]+$")
 
+# Temporary table names always start with a hash and, because the hash
+# character is never allowed in quoted values, any occurence of one in our
+# queries is a reference to a temporary table
+TEMP_TABLE_RE = re.compile(r"#\w+")
+DROP_TABLE_RE = re.compile(r"DROP TABLE (#\w+)")
+TEMP_TABLE_COLUMN_RE = re.compile(r"(#\w+)\.(\w+)")
+
+# Studies with more than this many column tables have their final output
+# assembled in stages (see `get_staged_join_queries`). This can be overridden
+# with the JOIN_GROUP_SIZE environment variable, where 0 disables staging.
+DEFAULT_JOIN_GROUP_SIZE = 50
+
+# Event tables which can be replaced by a persistent slice containing just the
+# rows matching the study's codelists (see `get_event_slice_queries`). Maps each
+# table to its code column, its (increasing) row ID column and any join needed
+# to look up the code, along with any value columns to copy.
+EVENT_SLICE_SOURCES = {
+    "CodedEvent": ("CTV3Code", "CodedEvent_ID", "", ["NumericValue"]),
+    "CodedEvent_SNOMED": ("ConceptID", "CodedEvent_ID", "", ["NumericValue"]),
+    "MedicationIssue": (
+        "DMD_ID",
+        "MedicationIssue_ID",
+        """
+        INNER JOIN MedicationDictionary
+        ON MedicationIssue.MultilexDrug_ID = MedicationDictionary.MultilexDrug_ID
+        """,
+        [],
+    ),
+}
+
 
 class TPPBackend:
     _db_connection = None
     _current_column_name = None
+    # Set to False if we find we don't have permission to query tempdb usage
+    _tempdb_usage_available = True
 
     def __init__(self, database_url, covariate_definitions, temporary_database=None):
         self.database_url = database_url
         self.covariate_definitions = covariate_definitions
         self.temporary_database = temporary_database
         self.next_temp_table_id = 1
+        self.peak_tempdb_usage = None
+        self.join_group_size = int(
+            os.environ.get("JOIN_GROUP_SIZE", DEFAULT_JOIN_GROUP_SIZE)
+        )
+        self.client_side_join = bool(os.environ.get("CLIENT_SIDE_JOIN"))
+        self.download_threads = int(os.environ.get("DOWNLOAD_THREADS", 4))
+        # Event slices persist between runs so they need a temporary database
+        self.use_event_slices = bool(
+            os.environ.get("EVENT_SLICE") and temporary_database
+        )
+        self.shards = int(os.environ.get("SHARDS", 1))
+        self.shard_threads = int(os.environ.get("SHARD_THREADS", 1))
         self.queries = self.get_queries(self.covariate_definitions)
 
-    def to_csv(self, filename):
+    def to_csv(self, filename, sinks=()):
+        """
+        Write the study's output to `filename`, passing each row to any
+        `sinks` as it's written (see `mssql_table_to_csv`)
+        """
+        if self.shards > 1:
+            return self.to_csv_sharded(filename, sinks)
+        if self.client_side_join:
+            return self.to_csv_with_client_side_join(filename, sinks)
         queries = list(self.queries)
         # If we have a temporary database available we write results to a table
         # there, download them, and then delete the table. This allows us to
@@ -70,6 +131,7 @@ class TPPBackend:
             row_callback=record_patient_id_and_log,
             retries=2,
             sleep=0.5,
+            sinks=sinks,
         )
         logger.info(f"Downloaded {unique_check.count} results")
 
@@ -82,6 +144,538 @@ class TPPBackend:
         # it clear that it's not complete
         os.rename(temp_filename, filename)
 
+    def to_measure_csvs(self, measures, filenames):
+        """
+        Calculate each of the supplied measures in the database and write its
+        results to the corresponding file in `filenames` (a dict mapping
+        measure IDs to filenames)
+
+        Rather than downloading every patient's row and aggregating locally,
+        we write just the columns the measures need into a temporary table and
+        then run a GROUP BY query over it for each measure, so only the
+        aggregated rows leave the database. These are then passed to a
+        `MeasureAggregator` so that the output is exactly what
+        `generate_measures` produces from the patient-level data (including a
+        row for every combination of the observed group values).
+        """
+        columns = []
+        for measure in measures:
+            for column in [measure.numerator, measure.denominator, *measure.group_by]:
+                if column != "population" and column not in columns:
+                    columns.append(column)
+        measure_table = "#measure_input"
+        columns_str = ", ".join(["patient_id"] + columns)
+        queries = list(self.queries)
+        queries[-1] = (
+            f"-- Writing measure inputs into {measure_table}\n"
+            f"SELECT {columns_str} INTO {measure_table} FROM ({queries[-1]}) t"
+        )
+        cursor = self.execute_queries(queries)
+        for measure in measures:
+            logger.info(f"Calculating measure '{measure.id}'")
+            cursor.execute(self.get_measure_query(measure, measure_table))
+            aggregator = MeasureAggregator(measure)
+            if measure.group_by:
+                group_count = len(measure.group_by)
+                for row in cursor:
+                    aggregator.add_totals(row[:group_count], *row[group_count:])
+            else:
+                aggregator.start([x[0] for x in cursor.description])
+                for row in cursor:
+                    aggregator.add_row(row)
+            aggregator.to_csv(filenames[measure.id])
+        cursor.execute(f"DROP TABLE {measure_table}")
+
+    @staticmethod
+    def get_measure_query(measure, table):
+        """
+        Return the query which calculates `measure` from the patient-level
+        values in `table`
+
+        The special "population" column is 1 for every patient, so summing it
+        is just counting rows. Numerators and denominators are summed as
+        floats to match the results of aggregating the patient-level CSV.
+        Measures without a `group_by` are patient-level so we just select
+        their columns, along with `patient_id`.
+        """
+        group_by = [column for column in measure.group_by if column != "population"]
+        aggregate = bool(measure.group_by)
+        select = [
+            "1 AS population" if column == "population" else column
+            for column in measure.group_by
+        ]
+        if not aggregate:
+            select.append("patient_id")
+        for column in [measure.numerator, measure.denominator]:
+            if column == "population":
+                select.append(
+                    "COUNT(*) AS population" if aggregate else "1 AS population"
+                )
+            elif aggregate:
+                select.append(f"SUM(CAST({column} AS FLOAT)) AS {column}")
+            else:
+                select.append(column)
+        sql = f"SELECT {', '.join(select)} FROM {table}"
+        if group_by:
+            group_by_str = ", ".join(group_by)
+            sql += f" GROUP BY {group_by_str} ORDER BY {group_by_str}"
+        elif not aggregate:
+            sql += " ORDER BY patient_id"
+        return sql
+
+    def to_column_profiles(self, column_kinds):
+        """
+        Calculate aggregate statistics for each column in `column_kinds` (a
+        dict mapping column names to one of "bool", "int", "float",
+        "category" or "date"), returning a dict mapping each column name to
+        the rows of its aggregate query as dicts
+
+        As in `to_measure_csvs`, we write the columns into a temporary table
+        and then run one aggregate query per column over it, so only the
+        aggregates leave the database.
+        """
+        profile_table = "#profile_input"
+        columns_str = ", ".join(column_kinds)
+        queries = list(self.queries)
+        queries[-1] = (
+            f"-- Writing profile inputs into {profile_table}\n"
+            f"SELECT {columns_str} INTO {profile_table} FROM ({queries[-1]}) t"
+        )
+        cursor = self.execute_queries(queries)
+        profiles = {}
+        for column, kind in column_kinds.items():
+            logger.info(f"Profiling column '{column}'")
+            cursor.execute(self.get_profile_query(column, kind, profile_table))
+            headers = [x[0] for x in cursor.description]
+            profiles[column] = [dict(zip(headers, row)) for row in cursor]
+        cursor.execute(f"DROP TABLE {profile_table}")
+        return profiles
+
+    @staticmethod
+    def get_profile_query(column, kind, table):
+        """
+        Return the query which aggregates the values of `column` in `table`
+
+        Missing values are output as the default value for the column's type
+        (see `get_default_value_for_type`). For numeric columns we count and
+        summarise the values which aren't missing. Categories and dates are
+        grouped by value (dates by month, or by year if that's all we have),
+        with one row per group, and missing values are grouped like any other.
+        """
+        if kind in ("bool", "int", "float"):
+            present = f"CASE WHEN {column} <> 0 THEN CAST({column} AS FLOAT) END"
+            return f"""
+            SELECT
+              COUNT(*) AS total,
+              COUNT({present}) AS present,
+              AVG({present}) AS mean,
+              STDEV({present}) AS stddev,
+              MIN({present}) AS min_value,
+              MAX({present}) AS max_value
+            FROM {table}
+            """
+        value = f"LEFT({column}, 7)" if kind == "date" else column
+        return f"""
+        SELECT
+          {value} AS value,
+          COUNT(*) AS total,
+          MIN({column}) AS min_value,
+          MAX({column}) AS max_value
+        FROM {table}
+        GROUP BY {value}
+        ORDER BY {value}
+        """
+
+    def to_csv_with_client_side_join(self, filename, sinks=()):
+        """
+        Rather than joining all the column tables together on the server, we
+        write the population and the output values for each column table into
+        separate tables, download each of these sorted by patient_id, and then
+        merge them together as we write the output file. This moves the work of
+        assembling wide rows off the database server and means that each
+        download is retried independently.
+
+        If we have a temporary database available we write the tables there so
+        that they can be downloaded in parallel over separate connections, and
+        so that a failed download can be resumed without re-running the column
+        queries.
+        """
+        (
+            population_table,
+            downloads,
+            setup_queries,
+            table_queries,
+        ) = self.get_client_side_join_plan()
+        tables = [population_table] + [table for (table, _, _) in downloads]
+        if self.temporary_database:
+            missing = [table for table in tables if not self.table_exists(table)]
+        else:
+            missing = tables
+        if missing:
+            if self.temporary_database:
+                self.assert_database_exists_and_is_writable(self.temporary_database)
+            create_queries = [
+                query
+                for (table, queries) in table_queries.items()
+                if table in missing
+                for query in queries
+            ]
+            self.execute_queries(
+                self.column_queries + setup_queries + create_queries,
+                keep_tables=tables,
+            )
+        else:
+            logger.info("Downloading results from previous run")
+        default_values = self.get_client_side_join_default_values(downloads)
+
+        with tempfile.TemporaryDirectory(
+            dir=os.path.dirname(os.path.abspath(filename))
+        ) as tmpdir:
+            files = {
+                table: os.path.join(tmpdir, f"download_{n}.csv")
+                for (n, table) in enumerate(tables)
+            }
+            self.download_tables(files)
+            temp_filename = self._get_temp_filename(filename)
+            unique_check = UniqueCheck()
+            with contextlib.ExitStack() as stack:
+                output_file = stack.enter_context(open(temp_filename, "w", newline=""))
+                readers = [
+                    csv.reader(stack.enter_context(open(files[table], newline="")))
+                    for table in tables
+                ]
+                for reader in readers:
+                    next(reader)
+                # Work out where to find each output value: either in the
+                # downloaded row for its table or, if that table has no row for
+                # the patient, in the default values. We walk the columns in
+                # their original order so that the output matches the
+                # server-side join.
+                locations = {
+                    name: (n, offset)
+                    for n, (table, columns, has_defaults) in enumerate(downloads)
+                    for offset, name in enumerate(columns, start=1)
+                }
+                headers = ["patient_id"]
+                positions = []
+                for name in self.get_output_expressions(self.output_columns):
+                    n, offset = locations[name]
+                    headers.append(name)
+                    positions.append((n, offset, default_values.get(name)))
+                writer = csv.writer(output_file)
+                writer.writerow(headers)
+                for sink in sinks:
+                    sink.start(headers)
+                joined_rows = LeftJoinSortedRows(*readers, on=0)
+                for population_row, *download_rows in joined_rows:
+                    unique_check.add(population_row[0])
+                    output_row = [population_row[0]]
+                    for n, offset, default in positions:
+                        download_row = download_rows[n]
+                        if download_row is None:
+                            output_row.append(default)
+                        else:
+                            output_row.append(download_row[offset])
+                    writer.writerow(output_row)
+                    for sink in sinks:
+                        sink.add_row(output_row)
+                    if unique_check.count % 1000000 == 0:
+                        logger.info(f"Merged {unique_check.count} results")
+            logger.info(f"Merged {unique_check.count} results")
+
+        self.execute_queries(
+            [f"-- Deleting '{table}'\nDROP TABLE {table}" for table in tables]
+        )
+        unique_check.assert_unique_ids()
+        os.rename(temp_filename, filename)
+
+    def get_client_side_join_plan(self):
+        """
+        Return a tuple of the form:
+
+            population_table, downloads, setup_queries, table_queries
+
+        `population_table` is the name of the table which holds the patient_ids
+        in the population, and `downloads` is a list of the tables to merge
+        against it, each given as a tuple of the form:
+
+            table_name, column_names, has_default_values
+
+        Output columns which depend on just one column table are downloaded
+        from a table containing only the patients which have a row in that
+        column table. All other patients get the value the column's expression
+        takes when the column table has no row (which is what `has_defaults`
+        indicates). Any columns which depend on several tables are downloaded
+        together from a single table with a row for every patient.
+
+        `table_queries` maps each table name to the queries which create it;
+        these all depend on `setup_queries` having been run first.
+        """
+        output_exprs = self.get_output_expressions(self.output_columns)
+        columns_by_table = {}
+        combined_columns = []
+        for name, expr in output_exprs.items():
+            tables = set(TEMP_TABLE_RE.findall(expr))
+            if len(tables) == 1:
+                columns_by_table.setdefault(tables.pop(), []).append(name)
+            else:
+                combined_columns.append(name)
+
+        population_query_table, population_queries = self.get_population_table_queries(
+            self.output_columns, self.primary_table, self.patient_id_expr
+        )
+        if self.temporary_database:
+            # As in `save_results_to_temporary_db` we use a hash of the queries
+            # as a short-lived cache key
+            query_hash = self.get_query_hash(
+                self.column_queries + list(output_exprs.values())
+            )
+            table_prefix = f"{self.temporary_database}..DataExtract_{query_hash}"
+            get_download_table_name = lambda n: f"{table_prefix}_{n}"  # noqa
+        else:
+            get_download_table_name = lambda n: self.get_temp_table_name(  # noqa
+                "download"
+            )
+        population_table = get_download_table_name(0)
+        queries = {
+            population_table: [
+                f"""
+                SELECT patient_id INTO {population_table}
+                FROM {population_query_table}
+                """,
+                f"CREATE INDEX ix_patient_id ON {population_table} (patient_id)",
+            ]
+        }
+        downloads = []
+        for table, columns in columns_by_table.items():
+            download_table = get_download_table_name(len(downloads) + 1)
+            columns_str = ",\n                  ".join(
+                f"{output_exprs[name]} AS {name}" for name in columns
+            )
+            queries[download_table] = [
+                f"""
+                -- Writing values from '{table}' into '{download_table}'
+                SELECT
+                  {table}.patient_id,
+                  {columns_str}
+                INTO {download_table}
+                FROM {table}
+                INNER JOIN {population_query_table}
+                ON {population_query_table}.patient_id = {table}.patient_id
+                """,
+                f"CREATE INDEX ix_patient_id ON {download_table} (patient_id)",
+            ]
+            downloads.append((download_table, columns, True))
+        if combined_columns:
+            download_table = get_download_table_name(len(downloads) + 1)
+            columns_str = ",\n                  ".join(
+                f"{output_exprs[name]} AS {name}" for name in combined_columns
+            )
+            tables = sorted(
+                set(
+                    TEMP_TABLE_RE.findall(
+                        " ".join(output_exprs[name] for name in combined_columns)
+                    )
+                )
+                - {population_query_table}
+            )
+            joins_str = "\n                  ".join(
+                f"LEFT JOIN {table} ON {table}.patient_id = {population_query_table}.patient_id"
+                for table in tables
+            )
+            queries[download_table] = [
+                f"""
+                -- Writing combined values into '{download_table}'
+                SELECT
+                  {population_query_table}.patient_id,
+                  {columns_str}
+                INTO {download_table}
+                FROM
+                  {population_query_table}
+                  {joins_str}
+                """,
+                f"CREATE INDEX ix_patient_id ON {download_table} (patient_id)",
+            ]
+            downloads.append((download_table, combined_columns, False))
+        return population_table, downloads, population_queries, queries
+
+    def get_client_side_join_default_values(self, downloads):
+        """
+        Return a dict mapping each output column which is downloaded from a
+        single column table to the value it takes for patients which have no
+        row in that table
+        """
+        output_exprs = self.get_output_expressions(self.output_columns)
+        names = [
+            name
+            for (table, columns, has_defaults) in downloads
+            if has_defaults
+            for name in columns
+        ]
+        if not names:
+            return {}
+        # Evaluating the expressions with every column reference replaced by
+        # NULL gives exactly the value the server-side join would produce
+        columns_str = ", ".join(
+            f"{TEMP_TABLE_COLUMN_RE.sub('NULL', output_exprs[name])} AS {name}"
+            for name in names
+        )
+        cursor = self.get_db_connection().cursor()
+        cursor.execute(f"SELECT {columns_str}")
+        row = cursor.fetchall()[0]
+        return {name: value for (name, value) in zip(names, row)}
+
+    def download_tables(self, files):
+        """
+        Download each table in the supplied dict to the corresponding file,
+        sorted by patient_id. Tables in the temporary database are downloaded
+        in parallel, each over its own connection.
+        """
+
+        def download(table, filename, cursor):
+            logger.info(f"Downloading '{table}'")
+            mssql_table_to_csv(
+                filename,
+                cursor=cursor,
+                table=table,
+                key_column="patient_id",
+                batch_size=32000,
+                retries=2,
+                sleep=0.5,
+            )
+
+        def download_with_new_connection(table, filename):
+            connection = mssql_dbapi_connection_from_url(self.database_url)
+            try:
+                download(table, filename, connection.cursor())
+            finally:
+                connection.close()
+
+        if not self.temporary_database:
+            # Temporary tables are only visible to the connection which created
+            # them so we have to download these one at a time
+            for table, filename in files.items():
+                download(table, filename, self.get_db_connection().cursor())
+            return
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.download_threads
+        ) as executor:
+            futures = [
+                executor.submit(download_with_new_connection, table, filename)
+                for table, filename in files.items()
+            ]
+            for future in concurrent.futures.as_completed(futures):
+                # Raise any errors from the download threads
+                future.result()
+
+    def get_query_hash(self, queries):
+        # We need to include the database name because a single server may
+        # contain multiple databases (e.g full data and sample data) which
+        # share a single temporary database.
+        hash_elements = list(queries) + [
+            mssql_connection_params_from_url(self.database_url)["database"]
+        ]
+        return hashlib.sha1("\n".join(hash_elements).encode("utf8")).hexdigest()
+
+    def to_csv_sharded(self, filename, sinks=()):
+        """
+        Split the patient_id space into `shards` ranges and run the complete
+        extraction separately for each range before concatenating the results.
+        Each shard only needs temporary space for its own patients, and a
+        failed extraction can be restarted without re-running the shards which
+        completed: their output files are kept until all shards are done.
+        Shards can also be run in parallel (over separate connections) by
+        setting SHARD_THREADS.
+
+        Because the results of completed shards may come from a previous run,
+        any `sinks` are fed as the shard files are concatenated rather than as
+        they are downloaded.
+
+        Event slices are shared by all the shards, so we refresh them once up
+        front rather than having each shard insert into them concurrently.
+        """
+        root, extension = os.path.splitext(filename)
+        shard_backends = [
+            self.get_shard_backend(patient_id_range)
+            for patient_id_range in self.get_patient_id_ranges(self.shards)
+        ]
+        shard_files = [
+            f"{root}.shard{n}.{self.get_query_hash(backend.queries)[:12]}{extension}"
+            for (n, backend) in enumerate(shard_backends, start=1)
+        ]
+        if self.event_slice_queries and not all(map(os.path.exists, shard_files)):
+            self.execute_queries(self.event_slice_queries)
+
+        def run_shard(backend, shard_file):
+            if os.path.exists(shard_file):
+                logger.info(f"Using existing results from '{shard_file}'")
+                return
+            try:
+                backend.to_csv(shard_file)
+            finally:
+                backend.close()
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.shard_threads
+        ) as executor:
+            futures = [
+                executor.submit(run_shard, backend, shard_file)
+                for (backend, shard_file) in zip(shard_backends, shard_files)
+            ]
+            for future in concurrent.futures.as_completed(futures):
+                # Raise any errors from the shards
+                future.result()
+
+        # Shards cover consecutive ranges of patient_ids so we can just append
+        # their results in order
+        temp_filename = self._get_temp_filename(filename)
+        with open(temp_filename, "w", newline="") as output_file:
+            for n, shard_file in enumerate(shard_files):
+                with open(shard_file, newline="") as f:
+                    headers = f.readline()
+                    if n == 0:
+                        output_file.write(headers)
+                    if sinks:
+                        # Only parse the rows when something needs them
+                        feed_sinks(sinks, headers, f, output_file)
+                        continue
+                    for line in f:
+                        output_file.write(line)
+        os.rename(temp_filename, filename)
+        for shard_file in shard_files:
+            os.unlink(shard_file)
+
+    def get_patient_id_ranges(self, count):
+        """
+        Split the range of patient_ids into (at most) `count` ranges of equal
+        width, returning a list of (min, max) pairs
+        """
+        cursor = self.get_db_connection().cursor()
+        cursor.execute("SELECT MIN(Patient_ID), MAX(Patient_ID) FROM Patient")
+        min_id, max_id = cursor.fetchone()
+        if min_id is None:
+            return [(0, 0)]
+        width = -(-(max_id - min_id + 1) // count)
+        return [
+            (start, min(start + width - 1, max_id))
+            for start in range(min_id, max_id + 1, width)
+        ]
+
+    def get_shard_backend(self, patient_id_range):
+        """
+        Return a copy of this backend with its own connection which extracts
+        only those patients with IDs in the supplied (inclusive) range
+        """
+        backend = copy.copy(self)
+        backend._db_connection = None
+        backend.shards = 1
+        backend.queries = backend.get_queries(
+            self.covariate_definitions,
+            patient_id_range=patient_id_range,
+            include_event_slice_queries=False,
+        )
+        return backend
+
     def _get_temp_filename(self, filename):
         root, extension = os.path.splitext(filename)
         timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
@@ -120,14 +714,8 @@ class TPPBackend:
         # cache key. Obviously this doesn't take into account the fact that the
         # data itself may change, but for our purposes this doesn't matter:
         # this is designed to be a very short-lived cache which is deleted as
-        # soon as the data is successfully downloaded. We need to include the
-        # database name because a single server may contain multiple databases
-        # (e.g full data and sample data) which share a single temporary
-        # database.
-        hash_elements = queries + [
-            mssql_connection_params_from_url(self.database_url)["database"]
-        ]
-        query_hash = hashlib.sha1("\n".join(hash_elements).encode("utf8")).hexdigest()
+        # soon as the data is successfully downloaded.
+        query_hash = self.get_query_hash(queries)
         output_table = f"{self.temporary_database}..DataExtract_{query_hash}"
         logger.info(f"Checking for existing results in '{output_table}'")
         if not self.table_exists(output_table):
@@ -139,7 +727,11 @@ class TPPBackend:
             self.assert_database_exists_and_is_writable(self.temporary_database)
             queries = list(queries)
             final_query = queries.pop()
-            self.execute_queries(queries)
+            # The final query runs separately below so we need to keep any
+            # temporary tables it uses
+            self.execute_queries(
+                queries, keep_tables=TEMP_TABLE_RE.findall(final_query)
+            )
             # We need to run the final query in a transaction so that we don't end up
             # with an empty output table in the event that the query fails. See:
             # https://docs.microsoft.com/en-us/sql/t-sql/queries/select-into-clause-transact-sql?view=sql-server-ver15#remarks
@@ -200,9 +792,31 @@ class TPPBackend:
             self._db_connection.close()
         self._db_connection = None
 
-    def get_queries(self, covariate_definitions):
+    def get_queries(
+        self,
+        covariate_definitions,
+        patient_id_range=None,
+        include_event_slice_queries=True,
+    ):
         output_columns = {}
         table_queries = {}
+        # Maps (codelist hash, date condition) to the name of a same-day events
+        # table so that columns which share an exclusion codelist and period
+        # can share the table (see `_these_codes_occur_on_same_day`)
+        self.same_day_tables = {}
+        # Maps each same-day events table to the names of the columns which
+        # use it, in the order in which they are queried
+        self.same_day_table_users = {}
+        # Maps event tables to the persistent slices which replace them
+        self.event_slices = {}
+        event_slice_queries = []
+        if self.use_event_slices:
+            event_slice_queries = self.get_event_slice_queries(covariate_definitions)
+        # Shards run these once between them (see `to_csv_sharded`) so we
+        # record them separately
+        self.event_slice_queries = event_slice_queries
+        if not include_event_slice_queries:
+            event_slice_queries = []
         for name, (query_type, query_args) in covariate_definitions.items():
             # So we can safely mutate these below
             query_args = query_args.copy()
@@ -240,6 +854,14 @@ class TPPBackend:
                     f"-- Query for {name}\n"
                     f"SELECT * INTO #{name} FROM ({sql_list[-1]}) t"
                 )
+                # When running a shard we only want the shard's patients.
+                # Filtering here (rather than in each query method) relies on
+                # the query planner to push the condition down into the query.
+                if patient_id_range:
+                    sql_list[-1] += (
+                        f"\nWHERE t.patient_id BETWEEN {int(patient_id_range[0])}"
+                        f" AND {int(patient_id_range[1])}"
+                    )
                 table_queries[name] = sql_list
                 # The first column should always be patient_id so we can join on it
                 output_columns[name] = self.get_column_expression(
@@ -248,6 +870,12 @@ class TPPBackend:
                     **column_args,
                 )
             output_columns[name].is_hidden = is_hidden
+        # Same-day events tables can be shared between several columns so we
+        # drop each one as soon as the last column which uses it has run
+        for same_day_table, users in self.same_day_table_users.items():
+            table_queries[users[-1]].append(
+                f"-- Deleting '{same_day_table}'\nDROP TABLE {same_day_table}"
+            )
         # If the population query defines its own temporary table then we use
         # that as the primary table to query against and left join everything
         # else against that. Otherwise, we use the `Patient` table.
@@ -257,6 +885,163 @@ class TPPBackend:
         else:
             primary_table = "Patient"
             patient_id_expr = ColumnExpression("Patient.Patient_ID")
+        if patient_id_range:
+            population = output_columns["population"]
+            output_columns["population"] = ColumnExpression(
+                f"CASE WHEN {population} = 1 AND {patient_id_expr} BETWEEN"
+                f" {int(patient_id_range[0])} AND {int(patient_id_range[1])}"
+                f" THEN 1 ELSE 0 END",
+                type="bool",
+                default_value=0,
+                source_tables=population.source_tables,
+                is_hidden=population.is_hidden,
+            )
+        joined_tables = [f"#{name}" for name in table_queries if name != "population"]
+        if self.join_group_size and len(joined_tables) > self.join_group_size:
+            join_queries = self.get_staged_join_queries(
+                output_columns, joined_tables, primary_table, patient_id_expr
+            )
+        else:
+            join_queries = [
+                self.get_join_query(
+                    output_columns, joined_tables, primary_table, patient_id_expr
+                )
+            ]
+        all_queries = list(event_slice_queries)
+        for sql_list in table_queries.values():
+            all_queries.extend(sql_list)
+        # Record what we need to assemble the output client-side instead (see
+        # `to_csv_with_client_side_join`)
+        self.column_queries = list(all_queries)
+        self.output_columns = output_columns
+        self.primary_table = primary_table
+        self.patient_id_expr = patient_id_expr
+        all_queries.extend(join_queries)
+        return all_queries
+
+    def get_event_slice_queries(self, covariate_definitions):
+        """
+        Most event queries only ever touch the rows of `CodedEvent` (and
+        friends) which match one of the study's codelists, but each of them
+        has to find those rows in the full history of events. Here we build,
+        in the temporary database, a narrow table for each event table
+        containing just the rows which match the union of all the codelists
+        used against it. Event queries then run against these slices (see
+        `get_event_source`).
+
+        Slices persist between runs and are refreshed incrementally: we only
+        look for new events with IDs above the highest one seen so far, so
+        re-running a study against updated data only processes the new
+        events. Note that this assumes existing events are never modified.
+        Slices are named after a hash of the codes (and database) they cover,
+        so changing a codelist results in a new slice being built from
+        scratch.
+        """
+        codes_by_table = collections.defaultdict(set)
+        systems_by_table = {}
+
+        def add_codes(table, codelist):
+            if codelist.has_categories:
+                codes = {code for (code, category) in codelist}
+            else:
+                codes = set(codelist)
+            codes_by_table[table].update(codes)
+            systems_by_table[table] = codelist.system
+
+        for query_type, query_args in covariate_definitions.values():
+            ignored_codelist = query_args.get("ignore_days_where_these_codes_occur")
+            if ignored_codelist is not None:
+                add_codes("CodedEvent", ignored_codelist)
+            # Episode counts query the event tables directly so don't need
+            # their codes in the slice
+            if query_args.get("returning") == "number_of_episodes":
+                continue
+            if query_type == "with_these_clinical_events":
+                table, _ = coded_event_table_column(query_args["codelist"])
+                add_codes(table, query_args["codelist"])
+            elif query_type == "with_these_medications":
+                add_codes("MedicationIssue", query_args["codelist"])
+
+        # Used to label the codelist tables
+        self._current_column_name = "event_slice"
+        queries = []
+        for table, codes in codes_by_table.items():
+            (
+                code_column,
+                id_column,
+                additional_join,
+                value_columns,
+            ) = EVENT_SLICE_SOURCES[table]
+            codes = sorted(codes)
+            slice_hash = self.get_query_hash([table] + codes)
+            slice_table = f"{self.temporary_database}..EventSlice_{slice_hash}"
+            codelist_table, codelist_queries = self.create_codelist_table(
+                make_codelist(codes, systems_by_table[table]),
+                case_sensitive=table != "MedicationIssue",
+            )
+            columns = ", ".join(
+                [
+                    f"{table}.Patient_ID",
+                    code_column,
+                    f"{table}.ConsultationDate",
+                    *(f"{table}.{column}" for column in value_columns),
+                    f"{table}.{id_column}",
+                ]
+            )
+            queries.extend(codelist_queries)
+            queries.extend(
+                [
+                    f"""
+                    -- Creating event slice of '{table}' in '{slice_table}'
+                    IF OBJECT_ID('{slice_table}') IS NULL
+                    BEGIN
+                      SELECT TOP 0 {columns}
+                      INTO {slice_table}
+                      FROM {table}{additional_join}
+                      CREATE CLUSTERED INDEX ix
+                      ON {slice_table} (Patient_ID, {code_column}, ConsultationDate)
+                    END
+                    """,
+                    # If the event IDs have gone backwards then the underlying
+                    # data has been rebuilt and we need to start again
+                    f"""
+                    IF (SELECT MAX({id_column}) FROM {slice_table})
+                      > (SELECT MAX({id_column}) FROM {table})
+                    TRUNCATE TABLE {slice_table}
+                    """,
+                    f"""
+                    -- Adding new events to '{slice_table}'
+                    INSERT INTO {slice_table}
+                    SELECT {columns}
+                    FROM {table}{additional_join}
+                    INNER JOIN {codelist_table}
+                    ON {code_column} = {codelist_table}.code
+                    WHERE {table}.{id_column} > (
+                      SELECT ISNULL(MAX({id_column}), -1) FROM {slice_table}
+                    )
+                    """,
+                ]
+            )
+            self.event_slices[table] = slice_table
+        self._current_column_name = None
+        return queries
+
+    def get_event_source(self, table, additional_join):
+        """
+        Return the FROM clause and additional join to use when querying events
+        from `table`, substituting its event slice if we have one. The slice is
+        aliased to the name of the original table so that the rest of the
+        query is unchanged, and it already holds the looked-up code so needs
+        no join.
+        """
+        slice_table = self.event_slices.get(table)
+        if slice_table is None:
+            return table, additional_join
+        return f"{slice_table} AS {table}", ""
+
+    def get_join_query(
+        self, output_columns, joined_tables, primary_table, patient_id_expr
+    ):
         # Insert `patient_id` as the first column
         output_columns = dict(patient_id=patient_id_expr, **output_columns)
         output_columns_str = ",\n          ".join(
@@ -265,12 +1050,11 @@ class TPPBackend:
             if not expr.is_hidden and name != "population"
         )
         joins = [
-            f"LEFT JOIN #{name} ON #{name}.patient_id = {patient_id_expr}"
-            for name in table_queries
-            if name != "population"
+            f"LEFT JOIN {table} ON {table}.patient_id = {patient_id_expr}"
+            for table in joined_tables
         ]
         joins_str = "\n          ".join(joins)
-        joined_output_query = f"""
+        return f"""
         -- Join all columns for final output
         SELECT
           {output_columns_str}
@@ -279,11 +1063,133 @@ class TPPBackend:
           {joins_str}
         WHERE {output_columns["population"]} = 1
         """
-        all_queries = []
-        for sql_list in table_queries.values():
-            all_queries.extend(sql_list)
-        all_queries.append(joined_output_query)
-        return all_queries
+
+    def get_population_table_queries(
+        self, output_columns, primary_table, patient_id_expr
+    ):
+        """
+        Return the name of a table which will hold the IDs of all patients in
+        the population, together with the queries which create it
+        """
+        population_table = self.get_temp_table_name("join_population")
+        population_joins = [
+            f"LEFT JOIN {table} ON {table}.patient_id = {patient_id_expr}"
+            for table in sorted(output_columns["population"].source_tables)
+            if table != primary_table
+        ]
+        population_joins_str = "\n              ".join(population_joins)
+        queries = [
+            f"""
+            -- Finding patients in population
+            SELECT {patient_id_expr} AS patient_id
+            INTO {population_table}
+            FROM
+              {primary_table}
+              {population_joins_str}
+            WHERE {output_columns["population"]} = 1
+            """,
+            f"CREATE CLUSTERED INDEX ix ON {population_table} (patient_id)",
+        ]
+        return population_table, queries
+
+    @staticmethod
+    def get_output_expressions(output_columns):
+        """
+        Return a dict mapping the name of each column which appears in the
+        output to its SQL expression
+        """
+        return {
+            name: str(expr)
+            for (name, expr) in output_columns.items()
+            if not expr.is_hidden and name != "population"
+        }
+
+    def get_staged_join_queries(
+        self, output_columns, joined_tables, primary_table, patient_id_expr
+    ):
+        """
+        Joining very many tables in a single query gives the optimizer a hard
+        time and can hit compile-time and memory-grant limits. Instead we:
+
+          1. write the IDs of all patients in the population to a table;
+          2. join the column tables onto this in groups of `join_group_size`,
+             writing each group out to a table clustered on patient_id;
+          3. join the group tables together to produce the final output.
+
+        The columns in the group tables are just the raw values referenced by
+        the output column expressions, which are then rewritten to refer to
+        these group tables rather than to the original column tables.
+        """
+        population_table, queries = self.get_population_table_queries(
+            output_columns, primary_table, patient_id_expr
+        )
+        output_exprs = self.get_output_expressions(output_columns)
+        # Find every column of every table referenced in the output
+        references = {}
+        for expr in output_exprs.values():
+            for table, column in TEMP_TABLE_COLUMN_RE.findall(expr):
+                references.setdefault(table, []).append(column)
+        # Tables which are only used in determining the population don't need
+        # to be joined again
+        joined_tables = [table for table in joined_tables if table in references]
+        renamed_columns = {}
+        group_tables = []
+        for i in range(0, len(joined_tables), self.join_group_size):
+            group = joined_tables[i : i + self.join_group_size]
+            group_table = self.get_temp_table_name("join_group")
+            group_tables.append(group_table)
+            columns = [f"{population_table}.patient_id"]
+            for table in group:
+                for column in dict.fromkeys(references[table]):
+                    alias = f"{table[1:]}__{column}"
+                    columns.append(f"{table}.{column} AS {alias}")
+                    renamed_columns[f"{table}.{column}"] = f"{group_table}.{alias}"
+            columns_str = ",\n              ".join(columns)
+            joins_str = "\n              ".join(
+                f"LEFT JOIN {table} ON {table}.patient_id = {population_table}.patient_id"
+                for table in group
+            )
+            group_query = f"""
+            -- Joining column group {len(group_tables)}
+            SELECT
+              {columns_str}
+            INTO {group_table}
+            FROM
+              {population_table}
+              {joins_str}
+            """
+            queries.extend(
+                [
+                    group_query,
+                    f"CREATE CLUSTERED INDEX ix ON {group_table} (patient_id)",
+                ]
+            )
+
+        def rename_column(match):
+            return renamed_columns.get(match.group(0), match.group(0))
+
+        output_columns_str = ",\n              ".join(
+            [f"{population_table}.patient_id AS patient_id"]
+            + [
+                f"{TEMP_TABLE_COLUMN_RE.sub(rename_column, expr)} AS {name}"
+                for (name, expr) in output_exprs.items()
+            ]
+        )
+        joins_str = "\n              ".join(
+            f"LEFT JOIN {table} ON {table}.patient_id = {population_table}.patient_id"
+            for table in group_tables
+        )
+        queries.append(
+            f"""
+            -- Join all column groups for final output
+            SELECT
+              {output_columns_str}
+            FROM
+              {population_table}
+              {joins_str}
+            """
+        )
+        return queries
 
     def get_column_expression(self, column_type, source, returning, date_format=None):
         default_value = self.get_default_value_for_type(column_type)
@@ -409,15 +1315,70 @@ class TPPBackend:
             date_format=other_columns[column_names[0]].date_format,
         )
 
-    def execute_queries(self, queries):
+    def execute_queries(self, queries, keep_tables=()):
+        """
+        Run each query in turn and return the cursor, which holds the results
+        of the final query
+
+        Each temporary table is dropped as soon as the last query which uses it
+        has run, so that large studies don't fill up tempdb. Tables used by the
+        final query (whose results the caller may still need) and those named
+        in `keep_tables` are left in place.
+        """
         cursor = self.get_db_connection().cursor()
-        for query in queries:
+        lifetimes = get_temp_table_lifetimes(queries)
+        final_index = len(queries) - 1
+        tables_to_drop = collections.defaultdict(list)
+        for table, (produced_by, last_used_by) in lifetimes.items():
+            if last_used_by < final_index and table not in keep_tables:
+                tables_to_drop[last_used_by].append(table)
+        for index, query in enumerate(queries):
             comment_match = re.match(r"^\s*\-\-\s*(.+)\n", query)
             if comment_match:
                 logger.info(f"Running: {comment_match.group(1)}")
+            if index == final_index and index > 0:
+                self.record_tempdb_usage(cursor)
             cursor.execute(query)
+            if tables_to_drop[index]:
+                # Usage only ever goes down when we drop tables so this is the
+                # point at which to check for a new peak
+                self.record_tempdb_usage(cursor)
+                for table in tables_to_drop[index]:
+                    cursor.execute(f"DROP TABLE {table}")
+        if self.peak_tempdb_usage is not None and final_index > 0:
+            logger.info(f"Peak tempdb usage: {self.peak_tempdb_usage // 1024} MB")
         return cursor
 
+    def record_tempdb_usage(self, cursor):
+        """
+        Update `peak_tempdb_usage` (in KB) with the space currently allocated
+        to temporary tables in this session
+        """
+        if not self._tempdb_usage_available:
+            return
+        try:
+            cursor.execute(
+                """
+                SELECT SUM(user_objects_alloc_page_count - user_objects_dealloc_page_count)
+                FROM sys.dm_db_session_space_usage
+                WHERE session_id = @@SPID
+                """
+            )
+            pages = cursor.fetchall()[0][0] or 0
+        # Because we don't want to depend on a specific database driver we
+        # can't catch a specific exception class here
+        except Exception as e:
+            if "permission" in str(e).lower() or "Invalid object name" in str(e):
+                logger.info("Unable to record tempdb usage (insufficient permissions)")
+                self._tempdb_usage_available = False
+                return
+            else:
+                raise
+        # Pages are 8KB
+        usage = pages * 8
+        if self.peak_tempdb_usage is None or usage > self.peak_tempdb_usage:
+            self.peak_tempdb_usage = usage
+
     def get_queries_for_column(
         self, column_name, query_type, query_args, output_columns
     ):
@@ -910,6 +1871,9 @@ class TPPBackend:
         codelist_table, codelist_queries = self.create_codelist_table(
             codelist, codes_are_case_sensitive
         )
+        from_clause, additional_join = self.get_event_source(
+            from_table, additional_join
+        )
         date_condition, date_joins = self.get_date_condition(
             from_table, "ConsultationDate", between
         )
@@ -967,7 +1931,7 @@ class TPPBackend:
                 PARTITION BY {from_table}.Patient_ID
                 ORDER BY ConsultationDate {ordering}, {from_table_id_col}
               ) AS rownum
-              FROM {from_table}{additional_join}
+              FROM {from_clause}{additional_join}
               INNER JOIN {codelist_table}
               ON {code_column} = {codelist_table}.code
               {date_joins}
@@ -981,7 +1945,7 @@ class TPPBackend:
               {from_table}.Patient_ID AS patient_id,
               {column_definition} AS {column_name},
               {date_aggregate}(ConsultationDate) AS date
-            FROM {from_table}{additional_join}
+            FROM {from_clause}{additional_join}
             INNER JOIN {codelist_table}
             ON {code_column} = {codelist_table}.code
             {date_joins}
@@ -1124,28 +2088,41 @@ class TPPBackend:
         if codelist is None:
             return "0 = 1", []
         assert codelist.system == "ctv3"
-        codelist_table, queries = self.create_codelist_table(
-            codelist, case_sensitive=True
-        )
-        same_day_table = self.get_temp_table_name("same_day_events")
         coded_event_table, coded_event_column = coded_event_table_column(codelist)
         date_condition, date_joins = self.get_date_condition(
             coded_event_table, "ConsultationDate", between
         )
-        queries += [
-            f"""
-            SELECT Patient_ID, CAST(ConsultationDate AS date) AS day
-            INTO {same_day_table}
-            FROM {coded_event_table}
-            INNER JOIN {codelist_table}
-            ON {coded_event_column} = {codelist_table}.code
-            {date_joins}
-            WHERE {date_condition}
-            """,
-            f"""
-            CREATE CLUSTERED INDEX ix ON {same_day_table} (Patient_ID, day)
-            """,
-        ]
+        # Studies often apply the same exclusion codelist over the same period
+        # to many different columns, so we build each distinct table just once
+        # and share it between all the columns which need it
+        cache_key = (codelist_hash(codelist), date_condition, date_joins)
+        queries = []
+        if cache_key not in self.same_day_tables:
+            codelist_table, queries = self.create_codelist_table(
+                codelist, case_sensitive=True
+            )
+            same_day_table = self.get_temp_table_name("same_day_events")
+            from_clause, _ = self.get_event_source(coded_event_table, "")
+            queries += [
+                f"""
+                SELECT Patient_ID, CAST(ConsultationDate AS date) AS day
+                INTO {same_day_table}
+                FROM {from_clause}
+                INNER JOIN {codelist_table}
+                ON {coded_event_column} = {codelist_table}.code
+                {date_joins}
+                WHERE {date_condition}
+                """,
+                f"""
+                CREATE CLUSTERED INDEX ix ON {same_day_table} (Patient_ID, day)
+                """,
+            ]
+            self.same_day_tables[cache_key] = same_day_table
+            self.same_day_table_users[same_day_table] = []
+        same_day_table = self.same_day_tables[cache_key]
+        users = self.same_day_table_users[same_day_table]
+        if self._current_column_name not in users:
+            users.append(self._current_column_name)
         condition = f"""
         EXISTS (
           SELECT 1 FROM {same_day_table}
@@ -2012,6 +2989,39 @@ def codelist_to_sql(codelist):
     return ",".join(codelist_to_sql_list(codelist))
 
 
+def get_temp_table_lifetimes(queries):
+    """
+    Given a list of queries, return a dict mapping the name of each temporary
+    table they use to a pair of indices: the query which first refers to the
+    table (i.e. the one which creates it) and the last query which uses it.
+
+    Tables which the queries explicitly drop themselves are excluded.
+    """
+    lifetimes = {}
+    dropped = set()
+    for index, query in enumerate(queries):
+        dropped.update(DROP_TABLE_RE.findall(query))
+        for table in TEMP_TABLE_RE.findall(query):
+            produced_by = lifetimes.get(table, (index, index))[0]
+            lifetimes[table] = (produced_by, index)
+    return {
+        table: lifetime for table, lifetime in lifetimes.items() if table not in dropped
+    }
+
+
+def codelist_hash(codelist):
+    """
+    Return a hash which identifies the set of codes (and their coding system)
+    in the supplied codelist, regardless of order or categorisation
+    """
+    if getattr(codelist, "has_categories", False):
+        codes = sorted({code for (code, category) in codelist})
+    else:
+        codes = sorted(set(codelist))
+    hash_input = "\n".join([str(codelist.system)] + codes)
+    return hashlib.sha1(hash_input.encode("utf8")).hexdigest()
+
+
 def to_list(value):
     if value is None:
         return []
@@ -2079,6 +3089,20 @@ def coded_event_table_column(codelist):
         assert False, codelist.system
 
 
+def feed_sinks(sinks, headers, input_file, output_file):
+    """
+    Copy the CSV rows in `input_file` to `output_file`, passing each one (and
+    the header line `headers`) to each of `sinks` as we go
+    """
+    for sink in sinks:
+        sink.start(next(csv.reader([headers])))
+    writer = csv.writer(output_file)
+    for row in csv.reader(input_file):
+        writer.writerow(row)
+        for sink in sinks:
+            sink.add_row(row)
+
+
 class UniqueCheck:
     def __init__(self):
         self.count = 0
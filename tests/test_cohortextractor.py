@@ -1,11 +1,25 @@
+import subprocess
+import sys
 import tempfile
 from contextlib import contextmanager
 from pathlib import Path
 from unittest.mock import patch
 
+import numpy as np
+import pandas as pd
 import pytest
 
-from cohortextractor.cohortextractor import list_study_definitions
+from cohortextractor import Measure
+from cohortextractor.cohortextractor import (
+    _calculate_measure_dfs,
+    _combine_descriptives,
+    _describe,
+    _get_column_charts,
+    _load_input_for_measures,
+    _summarise_chunks,
+    list_study_definitions,
+)
+from cohortextractor.measure import MeasureAggregator
 
 
 @contextmanager
@@ -32,3 +46,274 @@ def test_list_study_definition(relative_dir):
         relative_dir.return_value = dummy_repo
         definitions = list_study_definitions()
         assert definitions == [("study_definition_test", "_test")]
+
+
+def test_calculate_measure_dfs_matches_pandas_groupby():
+    rng = np.random.default_rng(1)
+    size = 1000
+    patient_df = pd.DataFrame(
+        {
+            "practice": pd.Series(rng.integers(0, 50, size).astype(str)).astype(
+                "category"
+            ),
+            # One category never occurs
+            "sex": pd.Categorical(rng.choice(["F", "M"], size), ["F", "M", "U"]),
+            "age": rng.integers(0, 100, size),
+            "died": rng.integers(0, 2, size).astype("float64"),
+            "admitted": rng.choice([0.0, 1.0, np.nan], size),
+            "population": 1,
+        }
+    )
+    measures = [
+        Measure("deaths", numerator="died", denominator="population"),
+        Measure(
+            "deaths_by_practice",
+            numerator="died",
+            denominator="population",
+            group_by="practice",
+        ),
+        Measure(
+            "admissions_by_practice",
+            numerator="admitted",
+            denominator="died",
+            group_by="practice",
+        ),
+        Measure(
+            "deaths_by_practice_and_sex",
+            numerator="died",
+            denominator="population",
+            group_by=["practice", "sex"],
+        ),
+        Measure(
+            "deaths_by_sex_and_age",
+            numerator="died",
+            denominator="population",
+            group_by=["sex", "age"],
+        ),
+    ]
+    measure_dfs = _calculate_measure_dfs(patient_df, measures)
+    for measure in measures:
+        expected = patient_df[[measure.numerator, measure.denominator]]
+        if measure.group_by:
+            expected = patient_df[
+                [measure.numerator, measure.denominator, *measure.group_by]
+            ]
+            expected = expected.groupby(measure.group_by).sum().reset_index()
+        expected["value"] = expected[measure.numerator] / expected[measure.denominator]
+        actual = measure_dfs[measure.id]
+        assert actual.to_csv(index=False) == expected.to_csv(index=False), measure.id
+
+
+def test_measure_aggregator_matches_generate_measures(tmp_path):
+    rng = np.random.default_rng(1)
+    size = 1000
+    rows = list(
+        zip(
+            range(1, size + 1),
+            rng.choice(["", "E123", "E456"], size),
+            rng.choice(["F", "M"], size),
+            rng.integers(0, 2, size),
+            rng.choice([0, 1, 2.5], size),
+        )
+    )
+    headers = ["patient_id", "practice", "sex", "died", "admissions"]
+    patient_file = tmp_path / "input.csv"
+    pd.DataFrame(rows, columns=headers).to_csv(patient_file, index=False)
+    measures = [
+        Measure("deaths", numerator="died", denominator="population"),
+        Measure(
+            "deaths_by_practice",
+            numerator="died",
+            denominator="population",
+            group_by="practice",
+        ),
+        Measure(
+            "admissions_by_practice_and_sex",
+            numerator="admissions",
+            denominator="died",
+            group_by=["practice", "sex"],
+        ),
+    ]
+    aggregators = [MeasureAggregator(measure) for measure in measures]
+    for aggregator in aggregators:
+        aggregator.start(headers)
+    # Add rows out of order, as they may be when downloaded in parallel
+    for row in reversed(rows):
+        for aggregator in aggregators:
+            aggregator.add_row(row)
+    measure_dfs = _calculate_measure_dfs(
+        _load_input_for_measures(patient_file, measures), measures
+    )
+    for measure, aggregator in zip(measures, aggregators):
+        expected = measure_dfs[measure.id].to_csv(index=False)
+        assert aggregator.get_df().to_csv(index=False) == expected, measure.id
+
+
+def test_measure_aggregator_totals_match_generate_measures(tmp_path):
+    headers = ["patient_id", "practice", "sex", "died", "admitted"]
+    rows = [
+        (1, "E123", "F", 1, 1),
+        (2, "E123", "F", 0, 1),
+        # E456 only has men, so there's no (E456, F) group, and none of them
+        # died so the deaths denominator for E456 is zero
+        (3, "E456", "M", 0, 1),
+        (4, "", "M", 1, 0),
+    ]
+    patient_file = tmp_path / "input.csv"
+    pd.DataFrame(rows, columns=headers).to_csv(patient_file, index=False)
+    measures = [
+        Measure(
+            "admissions_by_practice_and_sex",
+            numerator="admitted",
+            denominator="population",
+            group_by=["practice", "sex"],
+        ),
+        Measure(
+            "admissions_per_death_by_practice",
+            numerator="admitted",
+            denominator="died",
+            group_by="practice",
+        ),
+    ]
+    measure_dfs = _calculate_measure_dfs(
+        _load_input_for_measures(patient_file, measures), measures
+    )
+    patient_df = pd.DataFrame(rows, columns=headers)
+    patient_df["population"] = 1
+    for measure in measures:
+        # Totals as the database returns them from a GROUP BY: only for the
+        # combinations which occur, with counts as integers
+        totals = patient_df.groupby(measure.group_by)[
+            [measure.numerator, measure.denominator]
+        ].sum()
+        aggregator = MeasureAggregator(measure)
+        for key, (numerator, denominator) in totals.iterrows():
+            key = key if isinstance(key, tuple) else (key,)
+            aggregator.add_totals(key, int(numerator), int(denominator))
+        expected = measure_dfs[measure.id].to_csv(index=False)
+        assert aggregator.get_df().to_csv(index=False) == expected, measure.id
+
+
+def test_measure_grouping_sets_match_separate_measures():
+    rng = np.random.default_rng(1)
+    size = 1000
+    patient_df = pd.DataFrame(
+        {
+            "practice": pd.Series(rng.integers(0, 50, size).astype(str)).astype(
+                "category"
+            ),
+            "sex": pd.Categorical(rng.choice(["F", "M"], size), ["F", "M", "U"]),
+            "age": rng.integers(0, 100, size),
+            "region": rng.choice(["East", "West"], size),
+            "died": rng.integers(0, 2, size).astype("float64"),
+            "admitted": rng.choice([0.0, 1.0, np.nan], size),
+            "population": 1,
+        }
+    )
+    measure = Measure(
+        "admissions",
+        numerator="admitted",
+        denominator="died",
+        grouping_sets=[
+            ["practice", "sex", "age"],
+            ["practice", "sex"],
+            ["sex", "age"],
+            ["age", "region"],
+            "practice",
+            "age",
+            "region",
+            "population",
+        ],
+    )
+    measures = measure.expand()
+    assert [m.id for m in measures][:2] == [
+        "admissions_by_practice_and_sex_and_age",
+        "admissions_by_practice_and_sex",
+    ]
+    measure_dfs = _calculate_measure_dfs(patient_df, measures)
+    for measure in measures:
+        expected = _calculate_measure_dfs(patient_df, [measure])[measure.id]
+        actual = measure_dfs[measure.id]
+        assert actual.to_csv(index=False) == expected.to_csv(index=False), measure.id
+
+
+def test_measure_grouping_sets_cannot_be_combined_with_group_by():
+    with pytest.raises(ValueError):
+        Measure(
+            "deaths",
+            numerator="died",
+            denominator="population",
+            group_by="sex",
+            grouping_sets=["sex", "age"],
+        )
+
+
+def test_describe_matches_pandas_describe():
+    df = pd.DataFrame(
+        {
+            "age": [30, 40, 50, 60, 70],
+            "bmi": [20.5, 25.0, np.nan, 30.5, 22.0],
+            "sex": pd.Categorical(["M", "F", "F", "M", "F"]),
+            "has_asthma": [True, False, False, True, True],
+            "date": pd.to_datetime(
+                ["2020-01-01", "2020-02-01", None, "2020-03-01", "2020-01-01"]
+            ),
+        }
+    )
+    expected = df.describe(include="all")
+    actual = _describe(df)
+    assert list(actual.index) == list(expected.index)
+    assert list(actual.columns) == list(expected.columns)
+    for name in ["age", "bmi"]:
+        assert np.allclose(
+            actual[name].astype(float), expected[name].astype(float), equal_nan=True
+        )
+
+
+def test_summarise_chunks_matches_describe_and_charts():
+    rng = np.random.default_rng(1)
+    size = 1000
+    df = pd.DataFrame(
+        {
+            "patient_id": np.arange(size),
+            "age": pd.array(rng.integers(0, 100, size), dtype="Int64"),
+            "bmi": np.where(rng.random(size) < 0.2, np.nan, rng.normal(25, 5, size)),
+            "sex": pd.Categorical(rng.choice(["M", "F"], size)),
+            "has_asthma": rng.random(size) < 0.1,
+            "date": pd.to_datetime("2020-01-01")
+            + pd.to_timedelta(rng.integers(0, 365, size), unit="D"),
+        }
+    )
+    df.loc[::3, "date"] = pd.NaT
+    chunks = [df.iloc[start : start + 300] for start in range(0, size, 300)]
+    summaries = _summarise_chunks(iter(chunks))
+
+    expected = _describe(df)
+    actual = _combine_descriptives(
+        [summary.describe() for summary in summaries.values()],
+        pd.Index(summaries.keys()),
+    )
+    assert actual.astype(str).equals(expected.astype(str))
+    for name in df.columns:
+        if name == "patient_id":
+            continue
+        expected_charts = _get_column_charts(name, df[name])
+        actual_charts = summaries[name].get_charts()
+        assert actual_charts.keys() == expected_charts.keys()
+        for row, chart in expected_charts.items():
+            for key, value in chart.items():
+                assert np.array_equal(actual_charts[row][key], value), (name, row, key)
+
+
+def test_emis_backend_not_imported_by_cli():
+    # The EMIS backend imports `readline`, which isn't available on Windows,
+    # so only the command which needs it should import it
+    result = subprocess.check_output(
+        [
+            sys.executable,
+            "-c",
+            "import sys, cohortextractor.cohortextractor; "
+            "print('cohortextractor.emis_backend' in sys.modules)",
+        ]
+    )
+    assert result.strip() == b"False"
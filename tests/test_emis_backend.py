@@ -1,11 +1,16 @@
 import csv
+import datetime
 import os
 import tempfile
 
 import pytest
 
-from cohortextractor import StudyDefinition, codelist, patients
-from cohortextractor.emis_backend import quote
+from cohortextractor import StudyDefinition, codelist, emis_backend, patients
+from cohortextractor.emis_backend import (
+    cleanup_temp_tables,
+    get_query_dependencies,
+    quote,
+)
 from tests.emis_backend_setup import (
     CPNS,
     ICNARC,
@@ -415,6 +420,48 @@ def test_clinical_event_with_category():
     assert [x["code_category_date"] for x in results] == ["", "2020", "2019"]
 
 
+def test_large_codelists_are_uploaded_in_chunks(monkeypatch):
+    monkeypatch.setattr(emis_backend, "CODELIST_CHUNK_SIZE", 2)
+    session = make_session()
+    session.add_all(
+        [
+            Patient(),
+            Patient(
+                observations=[
+                    Observation(
+                        snomed_concept_id="10000001", effective_date="2018-01-01"
+                    ),
+                    Observation(
+                        snomed_concept_id="10000005", effective_date="2020-01-01"
+                    ),
+                ]
+            ),
+            Patient(
+                observations=[
+                    Observation(
+                        snomed_concept_id="10000003", effective_date="2019-01-01"
+                    )
+                ]
+            ),
+        ]
+    )
+    session.commit()
+    codes = codelist(
+        [(f"1000000{n}", category) for n, category in zip(range(1, 6), "ABCDE")],
+        "snomedct",
+    )
+    study = StudyDefinition(
+        population=patients.all(),
+        code_category=patients.with_these_clinical_events(
+            codes, returning="category", find_last_match_in_period=True
+        ),
+    )
+    # Three chunk tables plus the table which combines them
+    assert len(study.backend.codelist_tables) == 4
+    results = study.to_dicts()
+    assert [x["code_category"] for x in results] == ["", "E", "C"]
+
+
 def test_patient_registered_as_of():
     session = make_session()
 
@@ -786,6 +833,42 @@ def test_mean_recorded_value():
     assert results == [("96.0", "2020-02-10"), ("0.0", ""), ("0.0", "")]
 
 
+def test_mean_recorded_value_with_chunked_codelist_table(monkeypatch):
+    monkeypatch.setattr(emis_backend, "CODELIST_CHUNK_SIZE", 2)
+    codes = ["10000001", "10000002", "10000003"]
+    session = make_session()
+    patient = Patient()
+    values = [
+        ("2020-02-10", "10000001", 90),
+        ("2020-02-10", "10000003", 100),
+        # Not in the codelist so ignored, even though it's on the same day
+        ("2020-02-10", "10000009", 1000),
+        ("2020-01-01", "10000002", 50),
+    ]
+    for date, code, value in values:
+        patient.observations.append(
+            Observation(snomed_concept_id=code, value_pq_1=value, effective_date=date)
+        )
+    session.add_all([patient, Patient()])
+    session.commit()
+    study = StudyDefinition(
+        population=patients.all(),
+        bp_systolic=patients.mean_recorded_value(
+            codelist(codes, system="snomedct"),
+            on_most_recent_day_of_measurement=True,
+            between=["2018-01-01", "2020-03-01"],
+        ),
+        bp_systolic_date_measured=patients.date_of(
+            "bp_systolic", date_format="YYYY-MM-DD"
+        ),
+    )
+    # Presto rejects subqueries in an outer join's condition
+    assert "IN (SELECT" not in study.to_sql()
+    results = study.to_dicts()
+    results = [(i["bp_systolic"], i["bp_systolic_date_measured"]) for i in results]
+    assert results == [("95.0", "2020-02-10"), ("0.0", "")]
+
+
 def test_patients_satisfying():
     condition_code = "195967001"
     session = make_session()
@@ -1782,3 +1865,152 @@ def test_patients_aggregate_value_of():
     results = study_with_hidden_columns.to_dicts()
     assert [x["max_value"] for x in results] == ["23.0", "18.0", "10.0", "8.0", "0.0"]
     assert "abc_value" not in results[0].keys()
+
+
+def test_query_dependencies():
+    study = StudyDefinition(
+        population=patients.all(),
+        has_event=patients.with_these_clinical_events(
+            codelist([123], system="snomedct")
+        ),
+        sex=patients.sex(),
+    )
+    backend = study.backend
+    queries = [
+        (f"codelist {n}", sql)
+        for (n, sql) in enumerate(backend.codelist_tables, start=1)
+    ] + backend.queries[:-1]
+    assert get_query_dependencies(queries) == {
+        "codelist 1": set(),
+        "has_event": {"codelist 1"},
+        "sex": set(),
+        "population": set(),
+    }
+
+
+def test_concurrent_queries(monkeypatch):
+    monkeypatch.setenv("PRESTO_CONCURRENT_QUERIES", "3")
+    session = make_session()
+    session.add_all(
+        [
+            Patient(
+                date_of_birth="1950-01-01",
+                gender=1,
+                observations=[
+                    Observation(snomed_concept_id=123, effective_date="2010-01-01")
+                ],
+            ),
+            Patient(date_of_birth="1960-01-01", gender=2),
+        ]
+    )
+    session.commit()
+    study = StudyDefinition(
+        population=patients.all(),
+        has_event=patients.with_these_clinical_events(
+            codelist([123], system="snomedct")
+        ),
+        has_other_event=patients.with_these_clinical_events(
+            codelist([456], system="snomedct")
+        ),
+        sex=patients.sex(),
+    )
+    results = study.to_dicts()
+    assert [x["has_event"] for x in results] == ["1", "0"]
+    assert [x["has_other_event"] for x in results] == ["0", "0"]
+    assert [x["sex"] for x in results] == ["M", "F"]
+
+
+def test_temp_table_names_depend_on_query_content(monkeypatch):
+    monkeypatch.setenv("EMIS_DATA_VERSION", "20200101")
+
+    def get_table_names(codes):
+        study = StudyDefinition(
+            population=patients.all(),
+            has_event=patients.with_these_clinical_events(
+                codelist(codes, system="snomedct")
+            ),
+            sex=patients.sex(),
+        )
+        return {
+            name: study.backend.make_temp_table_name(name)
+            for name in ["population", "has_event", "sex"]
+        }
+
+    table_names = get_table_names([123])
+    assert all(name.startswith("_20200101_") for name in table_names.values())
+    assert get_table_names([123]) == table_names
+    changed_table_names = get_table_names([456])
+    assert changed_table_names["has_event"] != table_names["has_event"]
+    assert changed_table_names["sex"] == table_names["sex"]
+
+
+def test_output_table_name_uses_same_data_version_as_temp_tables(monkeypatch):
+    monkeypatch.setenv("EMIS_DATA_VERSION", "20200101")
+    study = StudyDefinition(population=patients.all(), sex=patients.sex())
+    # As if the date had changed part way through the run
+    monkeypatch.setenv("EMIS_DATA_VERSION", "20200102")
+    assert study.backend.make_temp_table_name("sex").startswith("_20200101_")
+    output_table = study.backend.get_output_table_name("temp")
+    assert output_table.startswith("temp..Output_20200101_")
+
+
+def test_cleanup_temp_tables():
+    today = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%d")
+    session = make_session()
+    with session.bind.connect() as conn:
+        conn.execute("CREATE TABLE _20000101_abc (foo INT)")
+        conn.execute(f"CREATE TABLE _{today}_abc (foo INT)")
+    dropped = cleanup_temp_tables(os.environ["EMIS_DATABASE_URL"], max_age_days=30)
+    assert dropped == ["_20000101_abc"]
+    with session.bind.connect() as conn:
+        sql = r"SELECT NAME FROM sys.tables WHERE NAME LIKE '\_%' ESCAPE '\'"
+        assert [row[0] for row in conn.execute(sql)] == [f"_{today}_abc"]
+
+
+def test_cleanup_temp_tables_in_temporary_database():
+    today = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%d")
+    session = make_session()
+    with session.bind.connect() as conn:
+        conn.execute("CREATE SCHEMA cleanup_test")
+        conn.execute("CREATE TABLE cleanup_test.Output_20000101_abc (foo INT)")
+        conn.execute(f"CREATE TABLE cleanup_test.Output_{today}_abc (foo INT)")
+    try:
+        dropped = cleanup_temp_tables(
+            os.environ["EMIS_DATABASE_URL"],
+            temporary_database="cleanup_test",
+            max_age_days=30,
+        )
+        assert [name.lower() for name in dropped] == [
+            "cleanup_test.output_20000101_abc"
+        ]
+    finally:
+        with session.bind.connect() as conn:
+            conn.execute(f"DROP TABLE IF EXISTS cleanup_test.Output_{today}_abc")
+            conn.execute("DROP TABLE IF EXISTS cleanup_test.Output_20000101_abc")
+            conn.execute("DROP SCHEMA cleanup_test")
+
+
+def test_query_stats_report(tmp_path, monkeypatch):
+    report_file = tmp_path / "query_stats.csv"
+    monkeypatch.setenv("QUERY_STATS_REPORT", str(report_file))
+    session = make_session()
+    session.add(Patient(date_of_birth="1950-01-01", gender=1))
+    session.commit()
+    study = StudyDefinition(
+        population=patients.all(),
+        sex=patients.sex(),
+        has_event=patients.with_these_clinical_events(
+            codelist([123], system="snomedct")
+        ),
+    )
+    study.to_dicts()
+    with open(report_file) as f:
+        rows = list(csv.DictReader(f))
+    assert {row["column"] for row in rows} == {
+        "codelist 1",
+        "sex",
+        "has_event",
+        "population",
+        "final_output",
+    }
+    assert all(row["wall_time_ms"] for row in rows)
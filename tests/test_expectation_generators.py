@@ -5,7 +5,11 @@ import pandas as pd
 import pytest
 
 from cohortextractor import StudyDefinition, codelist, patients
-from cohortextractor.expectation_generators import generate
+from cohortextractor.expectation_generators import (
+    generate,
+    generate_dates,
+    get_date_probability,
+)
 
 
 @pytest.fixture(autouse=True)
@@ -257,6 +261,23 @@ def test_data_generator_date_uniform():
         assert isclose(count, expected, rel_tol=0.1)
 
 
+@pytest.mark.parametrize("rate", ["exponential_increase", "uniform"])
+def test_date_probability_matches_generated_dates(rate):
+    dates = generate_dates(100000, "2018-01-01", "2020-12-31", rate, rng=1)["date"]
+    for start, end in [
+        ("2018-01-01", "2019-01-01"),
+        ("2020-06-01", "2020-07-01"),
+        ("2020-12-31", "2021-01-01"),
+    ]:
+        actual = dates.between(start, end, inclusive="left").mean()
+        expected = get_date_probability("2018-01-01", "2020-12-31", rate, start, end)
+        assert isclose(actual, expected, abs_tol=0.005)
+    unsupported = get_date_probability(
+        "2018-01-01", "2020-12-31", "weekly", "2018-01-01", "2019-01-01"
+    )
+    assert unsupported is None
+
+
 def test_data_generator_category_and_date():
     population_size = 10000
     incidence = 0.2
@@ -333,6 +354,18 @@ def test_data_generator_universal_category():
     )
 
 
+def test_data_generator_category_allows_rounded_ratios():
+    return_expectations = {
+        "rate": "universal",
+        "category": {"ratios": {"a": 0.3333333, "b": 0.3333333, "c": 0.3333324}},
+    }
+    result = generate(100, **return_expectations)
+    assert set(result.category) == {"a", "b", "c"}
+    return_expectations["category"]["ratios"]["c"] = 0.3
+    with pytest.raises(ValueError, match="sum of provided probabilities"):
+        generate(100, **return_expectations)
+
+
 def test_data_generator_age():
     population_size = 10000
     return_expectations = {
@@ -344,6 +377,24 @@ def test_data_generator_age():
     assert result.int.min() < 5 and result.int.max() > 95
 
 
+def test_data_generator_is_reproducible_with_seed():
+    return_expectations = {
+        "rate": "exponential_increase",
+        "incidence": 0.5,
+        "date": {"earliest": "1900-01-01", "latest": "2020-01-01"},
+        "category": {"ratios": {"A": 0.3, "B": 0.7}},
+        "int": {"distribution": "population_ages"},
+    }
+    result = generate(1000, rng=123, **return_expectations)
+    assert result.equals(generate(1000, rng=123, **return_expectations))
+    assert not result.equals(generate(1000, rng=456, **return_expectations))
+    # Empty rows are blanked consistently across all columns
+    empty = pd.isnull(result["date"])
+    assert empty.sum() == 500
+    assert (result.loc[empty, "category"] == "").all()
+    assert (result.loc[empty, "int"] == 0).all()
+
+
 def test_make_df_from_expectations_with_categories():
     categorised_codelist = codelist([("1", "A"), ("2", "B")], system="ctv3")
     categorised_codelist.has_categories = True
@@ -411,6 +462,47 @@ def test_make_df_from_expectations_with_categories_expression():
     assert value_counts["A"] < value_counts["B"]
 
 
+def test_make_df_from_expectations_derives_categories_from_other_columns():
+    study = StudyDefinition(
+        default_expectations={
+            "date": {"earliest": "1900-01-01", "latest": "today"},
+            "rate": "exponential_increase",
+            "incidence": 0.5,
+        },
+        population=patients.all(),
+        sex=patients.sex(
+            return_expectations={
+                "rate": "universal",
+                "category": {"ratios": {"M": 0.5, "F": 0.5}},
+            }
+        ),
+        age=patients.age_as_of(
+            "2020-01-01",
+            return_expectations={
+                "rate": "universal",
+                "int": {"distribution": "population_ages"},
+            },
+        ),
+        asthma=patients.with_these_clinical_events(
+            codelist(["X"], system="ctv3"), return_expectations={"incidence": 0.5}
+        ),
+        group=patients.categorised_as(
+            {"A": "sex = 'F' AND age >= 50", "B": "asthma", "C": "DEFAULT"},
+            return_expectations={"category": {"ratios": {"A": 0.3, "B": 0.7}}},
+        ),
+        old_with_asthma=patients.satisfying("age > 70 AND asthma"),
+    )
+    result = study.make_df_from_expectations(1000)
+    is_a = (result.sex == "F") & (result.age >= 50)
+    is_b = ~is_a & (result.asthma == 1)
+    assert (result.group == "A").equals(is_a)
+    assert (result.group == "B").equals(is_b)
+    assert (result.group == "C").equals(~is_a & ~is_b)
+    assert result.old_with_asthma.equals(
+        ((result.age > 70) & (result.asthma == 1)).astype(int)
+    )
+
+
 def test_make_df_from_expectations_with_categories_expression_validation():
     study = StudyDefinition(
         population=patients.all(),
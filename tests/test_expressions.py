@@ -1,6 +1,11 @@
+import numpy as np
 import pytest
 
-from cohortextractor.expressions import InvalidExpressionError, format_expression
+from cohortextractor.expressions import (
+    InvalidExpressionError,
+    compile_expression,
+    format_expression,
+)
 
 
 def test_basic_expression_rewritting():
@@ -38,3 +43,30 @@ def test_validate_string():
         format_expression('"all_ok_characters_but_just_a_bit_too_long"', **kwargs)
     assert format_expression('"quoted"', **kwargs)[0] == "'quoted'"
     assert format_expression('""', **kwargs)[0] == "''"
+
+
+def test_compiled_expression_evaluation():
+    columns = {
+        "age": np.array([30, 60, 70, 80]),
+        "sex": np.array(["F", "F", "M", "M"], dtype=object),
+        "died": np.array(["", "2020-01-01", "2019-01-01", ""], dtype=object),
+    }
+    empty_value_map = {"age": 0, "sex": "", "died": ""}
+
+    def evaluate(expression):
+        function, names = compile_expression(expression, empty_value_map)
+        return list(function(columns)), names
+
+    assert evaluate("age > 50 AND sex = 'F'") == (
+        [False, True, False, False],
+        {"age", "sex"},
+    )
+    # Implicit comparisons, and AND binding more tightly than OR
+    assert evaluate("sex = 'M' OR age < 70 AND died")[0] == [False, True, True, True]
+    assert evaluate("NOT (age - 10) * 2 > 100")[0] == [True, True, False, False]
+    assert evaluate("age / 2 + -1 = 29")[0] == [False, True, False, False]
+
+
+def test_compiled_expression_validation():
+    with pytest.raises(InvalidExpressionError):
+        compile_expression("a AND AND b", {"a": 0, "b": 0})
@@ -0,0 +1,25 @@
+from cohortextractor.join_utils import LeftJoinSortedRows
+
+
+def test_left_join_sorted_rows_with_single_right_iterator():
+    left = [{"id": "1", "a": 1}, {"id": "3", "a": 3}, {"id": "10", "a": 10}]
+    right = [{"id": "2", "b": 2}, {"id": "3", "b": 3}, {"id": "11", "b": 11}]
+    assert list(LeftJoinSortedRows(left, right)) == [
+        ({"id": "1", "a": 1}, None),
+        ({"id": "3", "a": 3}, {"id": "3", "b": 3}),
+        # Keys are compared as integers, not strings
+        ({"id": "10", "a": 10}, None),
+    ]
+
+
+def test_left_join_sorted_rows_with_multiple_right_iterators():
+    left = [(1,), (2,), (3,), (4,)]
+    right_1 = [(1, "a"), (4, "d")]
+    right_2 = [(2, "b"), (3, "c"), (4, "dd")]
+    right_3 = []
+    assert list(LeftJoinSortedRows(left, right_1, right_2, right_3, on=0)) == [
+        ((1,), (1, "a"), None, None),
+        ((2,), None, (2, "b"), None),
+        ((3,), None, (3, "c"), None),
+        ((4,), (4, "d"), (4, "dd"), None),
+    ]
@@ -1,4 +1,16 @@
-from cohortextractor.presto_utils import presto_connection_params_from_url
+import csv
+import os
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from cohortextractor.presto_utils import (
+    CursorProxy,
+    presto_connection_params_from_url,
+    presto_table_to_csv,
+)
 
 
 def test_presto_connection_params_from_url_with_auth():
@@ -41,3 +53,271 @@ def test_presto_connection_params_from_url_with_no_port():
         "catalog": "catalog",
         "schema": "schema",
     }
+
+
+class FakeCursor:
+    def __init__(self, batches, error=None):
+        self.batches = list(batches)
+        self.error = error
+
+    def execute(self, sql):
+        pass
+
+    def fetchmany(self, size=None):
+        if self.batches:
+            return self.batches.pop(0)
+        if self.error:
+            raise self.error
+        return []
+
+
+@pytest.mark.parametrize("prefetch_batches", [0, 1, 3])
+def test_cursor_proxy_iterates_over_all_batches(prefetch_batches):
+    batches = [[(1,), (2,)], [(3,)], [(4,), (5,)]]
+    cursor = CursorProxy(FakeCursor(batches), prefetch_batches=prefetch_batches)
+    cursor.execute("SELECT 1")
+    assert list(cursor) == [(1,), (2,), (3,), (4,), (5,)]
+
+
+def test_cursor_proxy_raises_errors_from_prefetch():
+    batches = [[(1,)], [(2,)]]
+    cursor = CursorProxy(FakeCursor(batches, error=ValueError("deliberate error")))
+    cursor.execute("SELECT 1")
+    rows = []
+    with pytest.raises(ValueError, match="deliberate error"):
+        for row in cursor:
+            rows.append(row)
+    assert rows == [(1,), (2,)]
+
+
+class SlowCursor(FakeCursor):
+    """Records whether `execute` is ever called while a fetch is in progress"""
+
+    def __init__(self, batches):
+        super().__init__(batches)
+        self.fetching = threading.Event()
+        self.overlapped = False
+
+    def execute(self, sql):
+        self.overlapped = self.overlapped or self.fetching.is_set()
+
+    def fetchmany(self, size=None):
+        self.fetching.set()
+        time.sleep(0.1)
+        self.fetching.clear()
+        return super().fetchmany(size)
+
+
+def test_cursor_proxy_stops_prefetching_before_next_execute():
+    cursor = CursorProxy(SlowCursor([[(1,)], [(2,)], [(3,)]]))
+    cursor.execute("SELECT 1")
+    for row in cursor:
+        # Abandon iteration while the next batch is being fetched
+        cursor.cursor.fetching.wait()
+        break
+    cursor.execute("SELECT 2")
+    assert not cursor.cursor.overlapped
+
+
+class FlakyConnection:
+    """Wraps a connection so that queries fail after the first `max_queries`"""
+
+    def __init__(self, connection, max_queries):
+        self.connection = connection
+        self.max_queries = max_queries
+
+    def cursor(self):
+        self.max_queries -= 1
+        if self.max_queries < 0:
+            raise ConnectionError("deliberate error")
+        return self.connection.cursor()
+
+
+@pytest.fixture
+def sqlite_connection():
+    connection = sqlite3.connect(":memory:")
+    connection.execute("CREATE TABLE output (patient_id INT, value TEXT)")
+    connection.executemany(
+        "INSERT INTO output VALUES (?, ?)", [(n, f"value_{n}") for n in range(1, 11)]
+    )
+    return connection
+
+
+def test_presto_table_to_csv(tmp_path, sqlite_connection):
+    filename = tmp_path / "output.csv"
+    presto_table_to_csv(
+        filename, sqlite_connection, "output", "patient_id", batch_size=3
+    )
+    with open(filename) as f:
+        rows = list(csv.DictReader(f))
+    assert [row["patient_id"] for row in rows] == [str(n) for n in range(1, 11)]
+    assert rows[0]["value"] == "value_1"
+
+
+def test_presto_table_to_csv_with_key_range(tmp_path, sqlite_connection):
+    filename = tmp_path / "output.csv"
+    presto_table_to_csv(
+        filename,
+        sqlite_connection,
+        "output",
+        "patient_id",
+        batch_size=3,
+        min_key=2,
+        max_key=7,
+    )
+    with open(filename) as f:
+        rows = list(csv.DictReader(f))
+    assert [row["patient_id"] for row in rows] == ["3", "4", "5", "6", "7"]
+
+
+def test_presto_table_to_csv_resumes_after_failure(tmp_path, sqlite_connection):
+    filename = tmp_path / "output.csv"
+    with pytest.raises(ConnectionError):
+        presto_table_to_csv(
+            filename,
+            FlakyConnection(sqlite_connection, max_queries=2),
+            "output",
+            "patient_id",
+            batch_size=3,
+            retries=0,
+        )
+    assert os.path.exists(f"{filename}.checkpoint")
+    downloaded = []
+    connection = FlakyConnection(sqlite_connection, max_queries=10)
+    presto_table_to_csv(
+        filename,
+        connection,
+        "output",
+        "patient_id",
+        batch_size=3,
+        row_callback=lambda row: downloaded.append(row[0]),
+    )
+    # Only the pages after the last checkpoint are fetched again (one query
+    # for their boundaries and then three pages) ...
+    assert connection.max_queries == 6
+    # ... but rows from before the failure are read back from the file, so
+    # the callback still sees every row
+    assert downloaded == list(range(1, 11))
+    with open(filename) as f:
+        rows = list(csv.DictReader(f))
+    assert [row["patient_id"] for row in rows] == [str(n) for n in range(1, 11)]
+    assert not os.path.exists(f"{filename}.checkpoint")
+
+
+class RecordingConnection:
+    """Wraps a connection, recording the queries run against it"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.queries = []
+
+    def cursor(self):
+        cursor = self.connection.cursor()
+        execute = cursor.execute
+
+        def record_and_execute(sql):
+            self.queries.append(sql)
+            return execute(sql)
+
+        return RecordingCursor(cursor, record_and_execute)
+
+
+class RecordingCursor:
+    def __init__(self, cursor, execute):
+        self.cursor = cursor
+        self.execute = execute
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+
+def test_presto_table_to_csv_pages_by_key_range(tmp_path, sqlite_connection):
+    filename = tmp_path / "output.csv"
+    connection = RecordingConnection(sqlite_connection)
+    presto_table_to_csv(filename, connection, "output", "patient_id", batch_size=4)
+    boundaries_query, *page_queries = connection.queries
+    assert "COUNT(*)" in boundaries_query
+    # Each page selects just its own range of keys rather than sorting the
+    # rest of the table
+    assert [query.split("WHERE ")[1] for query in page_queries] == [
+        "patient_id > 0 AND patient_id <= 4 ORDER BY patient_id",
+        "patient_id > 4 AND patient_id <= 8 ORDER BY patient_id",
+        "patient_id > 8 AND patient_id <= 10 ORDER BY patient_id",
+    ]
+    with open(filename) as f:
+        rows = list(csv.DictReader(f))
+    assert [row["patient_id"] for row in rows] == [str(n) for n in range(1, 11)]
+
+
+def test_presto_table_to_csv_with_empty_table(tmp_path, sqlite_connection):
+    sqlite_connection.execute("DELETE FROM output")
+    filename = tmp_path / "output.csv"
+    presto_table_to_csv(filename, sqlite_connection, "output", "patient_id")
+    with open(filename) as f:
+        assert f.read().splitlines() == ["patient_id,value"]
+
+
+class RecordingSink:
+    def __init__(self):
+        self.headers = None
+        self.rows = []
+
+    def start(self, headers):
+        self.headers = list(headers)
+
+    def add_row(self, row):
+        self.rows.append(row)
+
+
+def test_presto_table_to_csv_passes_all_rows_to_sinks_after_resuming(
+    tmp_path, sqlite_connection
+):
+    filename = tmp_path / "output.csv"
+    with pytest.raises(ConnectionError):
+        presto_table_to_csv(
+            filename,
+            FlakyConnection(sqlite_connection, max_queries=2),
+            "output",
+            "patient_id",
+            batch_size=3,
+            retries=0,
+        )
+    sink = RecordingSink()
+    presto_table_to_csv(
+        filename,
+        sqlite_connection,
+        "output",
+        "patient_id",
+        batch_size=3,
+        sinks=[sink],
+    )
+    # Rows from before the failure are read back from the file
+    assert sink.headers == ["patient_id", "value"]
+    assert [row[0] for row in sink.rows] == list(range(1, 11))
+    with open(filename) as f:
+        rows = list(csv.DictReader(f))
+    assert [row["patient_id"] for row in rows] == [str(n) for n in range(1, 11)]
+
+
+def test_cursor_proxy_records_query_stats():
+    fake_cursor = FakeCursor([[(1,)]])
+    fake_cursor.stats = {
+        "state": "FINISHED",
+        "wallTimeMillis": 10,
+        "cpuTimeMillis": 5,
+        "processedRows": 100,
+        "processedBytes": 2000,
+        "peakMemoryBytes": 300,
+    }
+    cursor = CursorProxy(fake_cursor)
+    cursor.execute("SELECT 1")
+    assert cursor.query_stats == {
+        "wall_time_ms": 10,
+        "cpu_time_ms": 5,
+        "processed_rows": 100,
+        "processed_bytes": 2000,
+        "peak_memory_bytes": 300,
+    }
@@ -4,6 +4,7 @@ This relies on the contents of `tests/fixtures/smoketest` being as expected.
 """
 import csv
 import os
+import re
 import subprocess
 import sys
 
@@ -63,6 +64,159 @@ def test_smoketest(tmp_path):
     ]
 
 
+def test_smoketest_parallel_measures(tmp_path):
+    _cohortextractor(
+        "generate_cohort",
+        "--expectations-population",
+        "100",
+        "--expectations-seed",
+        "1",
+        "--index-date-range",
+        "2020-01-01 to 2020-04-01 by month",
+        "--output-dir",
+        tmp_path,
+    )
+    _cohortextractor("generate_measures", "--output-dir", tmp_path)
+    serial_output = (tmp_path / "measure_liver_disease_by_stp.csv").read_text()
+    _cohortextractor(
+        "generate_measures",
+        "--output-dir",
+        tmp_path,
+        "--processes",
+        "2",
+        "--max-memory-gb",
+        "0.001",
+    )
+    parallel_output = (tmp_path / "measure_liver_disease_by_stp.csv").read_text()
+    assert parallel_output == serial_output
+
+
+def test_smoketest_measures_only(tmp_path):
+    _cohortextractor(
+        "generate_cohort",
+        "--expectations-population",
+        "100",
+        "--index-date-range",
+        "2020-01-01 to 2020-04-01 by month",
+        "--measures-only",
+        "--output-dir",
+        tmp_path,
+    )
+    assert not list(tmp_path.glob("input*.csv"))
+    with open(tmp_path / "measure_liver_disease_by_stp.csv") as f:
+        contents = list(csv.reader(f))
+    assert contents[0] == [
+        "stp",
+        "has_chronic_liver_disease",
+        "population",
+        "value",
+        "date",
+    ]
+    assert len(contents) == 1 + (2 * 4)  # Header row + 2 STPs * 4 dates
+
+
+def test_smoketest_with_measures(tmp_path):
+    _cohortextractor(
+        "generate_cohort",
+        "--expectations-population",
+        "100",
+        "--index-date-range",
+        "2020-01-01 to 2020-04-01 by month",
+        "--with-measures",
+        "--output-dir",
+        tmp_path,
+    )
+    assert len(list(tmp_path.glob("input*.csv"))) == 4
+    output = (tmp_path / "measure_liver_disease_by_stp.csv").read_text()
+    _cohortextractor("generate_measures", "--output-dir", tmp_path)
+    assert (tmp_path / "measure_liver_disease_by_stp.csv").read_text() == output
+
+
+def test_smoketest_parquet_output(tmp_path):
+    outputs = {}
+    for output_format in ["csv", "parquet"]:
+        output_dir = tmp_path / output_format
+        _cohortextractor(
+            "generate_cohort",
+            "--expectations-population",
+            "100",
+            "--expectations-seed",
+            "1",
+            "--index-date-range",
+            "2020-01-01 to 2020-04-01 by month",
+            "--output-format",
+            output_format,
+            "--output-dir",
+            output_dir,
+        )
+        _cohortextractor("generate_measures", "--output-dir", output_dir)
+        outputs[output_format] = (
+            output_dir / "measure_liver_disease_by_stp.csv"
+        ).read_text()
+    partitions = sorted((tmp_path / "parquet" / "input.parquet").iterdir())
+    assert [partition.name for partition in partitions] == [
+        "index_date=2020-01-01",
+        "index_date=2020-02-01",
+        "index_date=2020-03-01",
+        "index_date=2020-04-01",
+    ]
+    for partition in partitions:
+        assert [file.name for file in partition.iterdir()] == ["data.parquet"]
+    assert not list((tmp_path / "parquet").glob("*input*.csv"))
+    assert outputs["parquet"] == outputs["csv"]
+
+
+def test_smoketest_cohort_report(tmp_path):
+    _cohortextractor(
+        "generate_cohort",
+        "--expectations-population",
+        "100",
+        "--output-dir",
+        tmp_path,
+    )
+    _cohortextractor(
+        "cohort_report",
+        "--input-dir",
+        tmp_path,
+        "--output-dir",
+        tmp_path,
+        "--processes",
+        "2",
+    )
+    report = (tmp_path / "descriptives.html").read_text()
+    assert "data:image/png;base64," in report
+
+
+def test_smoketest_cohort_report_in_chunks(tmp_path):
+    _cohortextractor(
+        "generate_cohort",
+        "--expectations-population",
+        "100",
+        "--output-dir",
+        tmp_path,
+    )
+    (tmp_path / "chunked").mkdir()
+    _cohortextractor("cohort_report", "--input-dir", tmp_path, "--output-dir", tmp_path)
+    _cohortextractor(
+        "cohort_report",
+        "--input-dir",
+        tmp_path,
+        "--output-dir",
+        tmp_path / "chunked",
+        "--chunk-size",
+        "30",
+    )
+    # With so few rows every chart is exact, so they are identical (though
+    # values which tie for most common may be reported differently)
+    assert _get_images(tmp_path / "chunked" / "descriptives.html") == _get_images(
+        tmp_path / "descriptives.html"
+    )
+
+
+def _get_images(path):
+    return re.findall(r'src="data:image/png;base64,([^"]*)"', path.read_text())
+
+
 def _cohortextractor(*args):
     fixture_path = os.path.join(os.path.dirname(__file__), "fixtures/smoketest")
     cohortextractor_path = os.path.dirname(os.path.dirname(cohortextractor.__file__))
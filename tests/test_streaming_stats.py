@@ -0,0 +1,80 @@
+import numpy as np
+
+from cohortextractor.streaming_stats import QuantileSketch, RunningMoments, TopKCounter
+
+
+def sketch_in_chunks(values, chunks=10, **kwargs):
+    sketch = QuantileSketch(**kwargs)
+    for chunk in np.array_split(values, chunks):
+        sketch.update(chunk)
+    return sketch
+
+
+def test_quantile_sketch_is_exact_with_few_distinct_values():
+    values = np.random.default_rng(1).integers(0, 110, size=10000).astype(float)
+    values[::7] = np.nan
+    sketch = sketch_in_chunks(values)
+    present = values[~np.isnan(values)]
+    assert sketch.exact
+    assert sketch.count == len(present)
+    assert sketch.min == present.min()
+    assert sketch.max == present.max()
+    q = [0, 0.05, 0.25, 0.5, 0.75, 0.95, 1]
+    assert np.array_equal(
+        sketch.quantile(q), np.percentile(present, np.multiply(q, 100))
+    )
+    edges = np.histogram_bin_edges(present, bins=13)
+    assert np.array_equal(sketch.histogram(edges), np.histogram(present, edges)[0])
+
+
+def test_quantile_sketch_approximates_many_distinct_values():
+    values = np.random.default_rng(1).normal(50, 10, size=200000)
+    sketch = sketch_in_chunks(values, compression=1000, max_centroids=5000)
+    assert not sketch.exact
+    assert len(sketch.means) <= 5000
+    assert sketch.count == len(values)
+    assert sketch.min == values.min()
+    assert sketch.max == values.max()
+    q = [0.01, 0.25, 0.5, 0.75, 0.99]
+    assert np.allclose(
+        sketch.quantile(q), np.percentile(values, np.multiply(q, 100)), atol=0.05
+    )
+    edges = np.histogram_bin_edges(values, bins=20)
+    counts = sketch.histogram(edges)
+    assert counts.sum() == len(values)
+    assert np.allclose(counts, np.histogram(values, edges)[0], atol=len(values) / 1000)
+
+
+def test_quantile_sketch_keeps_common_values_exact():
+    rng = np.random.default_rng(1)
+    values = np.where(rng.random(100000) < 0.3, 0, rng.normal(120, 15, size=100000))
+    sketch = sketch_in_chunks(values, compression=1000, max_centroids=5000)
+    assert not sketch.exact
+    assert np.array_equal(sketch.quantile([0, 0.25, 0.29]), [0, 0, 0])
+    positive = sketch.where(sketch.means > 0)
+    assert positive.count == (values > 0).sum()
+    assert positive.min == values[values > 0].min()
+    # Zero is the lower edge of the first bin, so all the zeros fall into it
+    counts = sketch.histogram([0, 1, 200])
+    assert counts[0] == (values == 0).sum()
+
+
+def test_running_moments_match_numpy():
+    values = np.random.default_rng(1).exponential(5, size=10000)
+    moments = RunningMoments()
+    for chunk in np.array_split(values, 7):
+        moments.update(chunk)
+    moments.update([np.nan])
+    assert moments.count == len(values)
+    assert np.isclose(moments.mean, values.mean())
+    assert np.isclose(moments.std, values.std(ddof=1))
+
+
+def test_top_k_counter():
+    counter = TopKCounter(max_values=2)
+    counter.update({"a": 3, "b": 1})
+    assert counter.exact
+    counter.update({"b": 3, "c": 1, "d": 0})
+    assert not counter.exact
+    assert counter.most_common() == [("b", 4), ("a", 3)]
+    assert counter.total == 8
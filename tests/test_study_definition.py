@@ -4,9 +4,10 @@ import subprocess
 import sys
 import textwrap
 
+import pandas as pd
 import pytest
 
-from cohortextractor import StudyDefinition, patients
+from cohortextractor import StudyDefinition, codelist, patients
 
 
 def test_create_dummy_data_works_without_database_url(tmp_path, monkeypatch):
@@ -39,6 +40,93 @@ def test_create_dummy_data_works_without_database_url(tmp_path, monkeypatch):
     assert "age" in columns
 
 
+def test_dummy_data_is_reproducible_with_seed(tmp_path, monkeypatch):
+    monkeypatch.delenv("DATABASE_URL", raising=False)
+    study = StudyDefinition(
+        population=patients.all(),
+        age=patients.age_as_of(
+            "2020-01-01",
+            return_expectations={
+                "rate": "universal",
+                "date": {"earliest": "1900-01-01", "latest": "2020-01-01"},
+                "int": {"distribution": "population_ages"},
+            },
+        ),
+    )
+    outputs = []
+    for seed in [1, 1, 2]:
+        filename = tmp_path / f"dummy_data_{len(outputs)}.csv"
+        study.to_csv(filename, expectations_population=100, expectations_seed=seed)
+        outputs.append(filename.read_text())
+    assert outputs[0] == outputs[1]
+    assert outputs[0] != outputs[2]
+
+
+def test_dummy_data_is_generated_in_chunks(tmp_path, monkeypatch):
+    monkeypatch.delenv("DATABASE_URL", raising=False)
+    monkeypatch.setenv("EXPECTATIONS_CHUNK_SIZE", "8")
+    study = StudyDefinition(
+        default_expectations={
+            "date": {"earliest": "1900-01-01", "latest": "2020-01-01"},
+            "rate": "uniform",
+            "incidence": 0.5,
+        },
+        population=patients.all(),
+        asthma=patients.with_these_clinical_events(
+            codelist(["X"], system="ctv3"), returning="date", date_format="YYYY-MM-DD"
+        ),
+        asthma_count=patients.with_these_clinical_events(
+            codelist(["X"], system="ctv3"),
+            returning="number_of_matches_in_period",
+            return_expectations={
+                "int": {"distribution": "normal", "mean": 3, "stddev": 1}
+            },
+        ),
+    )
+    filename = tmp_path / "dummy_data.csv"
+    study.to_csv(filename, expectations_population=20)
+    with open(filename) as f:
+        results = list(csv.DictReader(f))
+    assert len(results) == 20
+    assert len({row["patient_id"] for row in results}) == 20
+    # Incidence holds within each chunk of 8 (and the final chunk of 4)
+    for chunk in [results[0:8], results[8:16], results[16:20]]:
+        assert sum(1 for row in chunk if row["asthma"]) == len(chunk) // 2
+    # An empty population still gets a header row
+    study.expectations_to_csv(filename, 0)
+    with open(filename) as f:
+        assert f.read().splitlines() == ["asthma,asthma_count,patient_id"]
+
+
+def test_csv_to_df(tmp_path):
+    study = StudyDefinition(
+        population=patients.all(),
+        died=patients.died_from_any_cause(),
+        died_date=patients.died_from_any_cause(
+            returning="date_of_death", date_format="YYYY-MM"
+        ),
+        age=patients.age_as_of("2020-01-01"),
+        sex=patients.sex(),
+    )
+    filename = tmp_path / "input.csv"
+    filename.write_text(
+        "patient_id,died,died_date,age,sex\n"
+        "1,0,,40,M\n"
+        "2,1,2020-02,,F\n"
+        "3,,,65,\n"
+    )
+    df = study.csv_to_df(filename)
+    assert list(df.died) == [False, True, False]
+    assert str(df.died_date.dtype) == "datetime64[ns]"
+    assert df.died_date[1] == pd.Timestamp("2020-02-01")
+    assert df.died_date.isnull().tolist() == [True, False, True]
+    assert str(df.age.dtype) == "Int64"
+    assert df.age.tolist()[::2] == [40, 65]
+    assert df.age.isnull().tolist() == [False, True, False]
+    assert list(df.sex.cat.categories) == ["F", "M"]
+    assert df.sex.isnull().tolist() == [False, False, True]
+
+
 def test_export_data_without_database_url_raises_error(tmp_path, monkeypatch):
     monkeypatch.delenv("DATABASE_URL", raising=False)
     study = StudyDefinition(
@@ -139,3 +227,80 @@ def test_syntax_errors_in_expressions_are_raised():
                 age=patients.age_as_of("2010-01-01"),
             ),
         )
+
+
+def test_compare_profile_with_expectations(monkeypatch):
+    monkeypatch.delenv("DATABASE_URL", raising=False)
+    study = StudyDefinition(
+        default_expectations={
+            "date": {"earliest": "2020-01-01", "latest": "2020-03-31"},
+            "rate": "uniform",
+            "incidence": 0.5,
+        },
+        population=patients.all(),
+        sex=patients.sex(
+            return_expectations={
+                "rate": "universal",
+                "category": {"ratios": {"M": 0.5, "F": 0.5}},
+            }
+        ),
+        bmi=patients.most_recent_bmi(
+            return_expectations={
+                "float": {"distribution": "normal", "mean": 28, "stddev": 8},
+            }
+        ),
+        event_date=patients.with_these_clinical_events(
+            codelist(["X"], "ctv3"),
+            returning="date",
+            date_format="YYYY-MM-DD",
+        ),
+    )
+    assert study.get_profile_column_kinds() == {
+        "sex": "category",
+        "bmi": "float",
+        "event_date": "date",
+    }
+    rows = [
+        {"value": "F", "total": 3, "min_value": "F", "max_value": "F"},
+        {"value": "M", "total": 1, "min_value": "M", "max_value": "M"},
+    ]
+    assert study.compare_profile_with_expectations("sex", "category", rows) == [
+        ("incidence", 1.0, 1.0),
+        ("ratio[F]", 0.5, 0.75),
+        ("ratio[M]", 0.5, 0.25),
+    ]
+    rows = [
+        {
+            "total": 4,
+            "present": 2,
+            "mean": 30.0,
+            "stddev": 2.0,
+            "min_value": 28.0,
+            "max_value": 32.0,
+        }
+    ]
+    assert study.compare_profile_with_expectations("bmi", "float", rows) == [
+        ("incidence", 0.5, 0.5),
+        ("mean", 28, 30.0),
+        ("stddev", 8, 2.0),
+        ("min", None, 28.0),
+        ("max", None, 32.0),
+    ]
+    rows = [
+        {"value": "", "total": 2, "min_value": "", "max_value": ""},
+        {
+            "value": "2020-02",
+            "total": 2,
+            "min_value": "2020-02-03",
+            "max_value": "2020-02-10",
+        },
+    ]
+    comparison = study.compare_profile_with_expectations("event_date", "date", rows)
+    assert comparison[:3] == [
+        ("incidence", 0.5, 0.5),
+        ("earliest", "2020-01-01", "2020-02-03"),
+        ("latest", "2020-03-31", "2020-02-10"),
+    ]
+    statistic, expected, actual = comparison[3]
+    assert (statistic, actual) == ("ratio[2020-02]", 1.0)
+    assert expected == pytest.approx(29 / 90)
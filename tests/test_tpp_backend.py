@@ -6,8 +6,13 @@ from unittest.mock import patch
 
 import pytest
 
-from cohortextractor import StudyDefinition, codelist, patients
+from cohortextractor import Measure, StudyDefinition, codelist, patients
+from cohortextractor.cohortextractor import (
+    _calculate_measure_dfs,
+    _load_input_for_measures,
+)
 from cohortextractor.date_expressions import InvalidExpressionError
+from cohortextractor.measure import MeasureAggregator
 from cohortextractor.mssql_utils import mssql_connection_params_from_url
 from cohortextractor.tpp_backend import AppointmentStatus, quote
 from tests.helpers import assert_results
@@ -118,6 +123,208 @@ def test_correct_driver_used():
     assert module == "ctds"
 
 
+def test_measures_calculated_in_database(tmp_path):
+    session = make_session()
+    session.add_all(
+        [
+            Patient(
+                Sex="M",
+                CodedEvents=[
+                    CodedEvent(CTV3Code="foo1", ConsultationDate="2020-01-01")
+                ],
+            ),
+            Patient(Sex="M"),
+            Patient(
+                Sex="F",
+                CodedEvents=[
+                    CodedEvent(CTV3Code="foo1", ConsultationDate="2020-01-01")
+                ],
+            ),
+        ]
+    )
+    session.commit()
+    study = StudyDefinition(
+        population=patients.all(),
+        sex=patients.sex(),
+        has_event=patients.with_these_clinical_events(codelist(["foo1"], "ctv3")),
+    )
+    measures = [
+        Measure(
+            id="event_by_sex",
+            numerator="has_event",
+            denominator="population",
+            group_by="sex",
+        ),
+        Measure(id="event_by_patient", numerator="has_event", denominator="population"),
+    ]
+    filenames = {
+        "event_by_sex": tmp_path / "event_by_sex.csv",
+        "event_by_patient": tmp_path / "event_by_patient.csv",
+    }
+    study.to_measure_csvs(measures, filenames)
+    with open(filenames["event_by_sex"]) as f:
+        results = list(csv.DictReader(f))
+    assert results == [
+        {"sex": "F", "has_event": "1.0", "population": "1", "value": "1.0"},
+        {"sex": "M", "has_event": "1.0", "population": "2", "value": "0.5"},
+    ]
+    with open(filenames["event_by_patient"]) as f:
+        results = list(csv.DictReader(f))
+    assert [x["value"] for x in results] == ["1.0", "0.0", "1.0"]
+
+
+def test_column_profiles_calculated_in_database(tmp_path):
+    session = make_session()
+    session.add_all(
+        [
+            Patient(
+                Sex="M",
+                CodedEvents=[
+                    CodedEvent(CTV3Code="foo1", ConsultationDate="2020-01-15")
+                ],
+            ),
+            Patient(Sex="M"),
+            Patient(
+                Sex="F",
+                CodedEvents=[
+                    CodedEvent(CTV3Code="foo1", ConsultationDate="2020-02-01")
+                ],
+            ),
+        ]
+    )
+    session.commit()
+    study = StudyDefinition(
+        default_expectations={
+            "date": {"earliest": "2020-01-01", "latest": "2020-12-31"},
+            "rate": "uniform",
+            "incidence": 0.5,
+        },
+        population=patients.all(),
+        sex=patients.sex(
+            return_expectations={
+                "rate": "universal",
+                "category": {"ratios": {"M": 0.5, "F": 0.5}},
+            }
+        ),
+        has_event=patients.with_these_clinical_events(codelist(["foo1"], "ctv3")),
+        event_date=patients.with_these_clinical_events(
+            codelist(["foo1"], "ctv3"), returning="date", date_format="YYYY-MM-DD"
+        ),
+    )
+    filename = tmp_path / "profile.csv"
+    study.to_profile_csv(filename)
+    with open(filename) as f:
+        results = {
+            (row["column"], row["statistic"]): row["actual"]
+            for row in csv.DictReader(f)
+        }
+    assert results[("sex", "incidence")] == "1.0"
+    assert float(results[("sex", "ratio[M]")]) == pytest.approx(2 / 3)
+    assert float(results[("has_event", "incidence")]) == pytest.approx(2 / 3)
+    assert results[("event_date", "earliest")] == "2020-01-15"
+    assert results[("event_date", "latest")] == "2020-02-01"
+    assert results[("event_date", "ratio[2020-01]")] == "0.5"
+    assert results[("event_date", "ratio[2020-02]")] == "0.5"
+
+
+def test_measures_calculated_in_database_match_generate_measures(tmp_path):
+    session = make_session()
+    organisations = {
+        "London": Organisation(Region="London", Organisation_ID=1),
+        "Midlands": Organisation(Region="Midlands", Organisation_ID=2),
+    }
+    for sex, region, event_code in [
+        ("M", "London", "foo1"),
+        ("M", "London", None),
+        ("F", "London", "foo1"),
+        # There are no women in the Midlands, and nobody there has the event
+        ("M", "Midlands", None),
+    ]:
+        patient = Patient(Sex=sex)
+        patient.RegistrationHistory.append(
+            RegistrationHistory(
+                StartDate="2000-01-01",
+                EndDate="9999-12-31",
+                Organisation=organisations[region],
+            )
+        )
+        if event_code:
+            patient.CodedEvents.append(
+                CodedEvent(CTV3Code=event_code, ConsultationDate="2020-01-01")
+            )
+        session.add(patient)
+    session.commit()
+    study = StudyDefinition(
+        population=patients.all(),
+        sex=patients.sex(),
+        region=patients.registered_practice_as_of(
+            "2020-01-01", returning="nuts1_region_name"
+        ),
+        has_event=patients.with_these_clinical_events(codelist(["foo1"], "ctv3")),
+    )
+    measures = [
+        Measure(
+            id="event_by_sex_and_region",
+            numerator="has_event",
+            denominator="population",
+            group_by=["sex", "region"],
+        ),
+        Measure(
+            id="population_per_event_by_region",
+            numerator="population",
+            denominator="has_event",
+            group_by="region",
+        ),
+        Measure(id="event_by_patient", numerator="has_event", denominator="population"),
+    ]
+    filenames = {measure.id: tmp_path / f"{measure.id}.csv" for measure in measures}
+    study.to_measure_csvs(measures, filenames)
+    study.to_csv(tmp_path / "input.csv")
+    measure_dfs = _calculate_measure_dfs(
+        _load_input_for_measures(tmp_path / "input.csv", measures), measures
+    )
+    for measure in measures:
+        expected = measure_dfs[measure.id].to_csv(index=False)
+        assert filenames[measure.id].read_text() == expected, measure.id
+    # Including the (F, Midlands) group which never occurs ...
+    assert "F,Midlands,0.0,0," in filenames["event_by_sex_and_region"].read_text()
+    # ... and the result of dividing by zero
+    results = filenames["population_per_event_by_region"].read_text()
+    assert "Midlands,1,0.0,inf" in results
+
+
+@pytest.mark.parametrize("env", [{}, {"CLIENT_SIDE_JOIN": "1"}, {"SHARDS": "2"}])
+def test_measures_calculated_during_download(tmp_path, monkeypatch, env):
+    for key, value in env.items():
+        monkeypatch.setenv(key, value)
+    session = make_session()
+    for sex, event_code in [("M", "foo1"), ("M", None), ("F", "foo1")]:
+        patient = Patient(Sex=sex)
+        if event_code:
+            patient.CodedEvents.append(
+                CodedEvent(CTV3Code=event_code, ConsultationDate="2020-01-01")
+            )
+        session.add(patient)
+    session.commit()
+    study = StudyDefinition(
+        population=patients.all(),
+        sex=patients.sex(),
+        has_event=patients.with_these_clinical_events(codelist(["foo1"], "ctv3")),
+    )
+    measure = Measure(
+        id="event_by_sex",
+        numerator="has_event",
+        denominator="population",
+        group_by="sex",
+    )
+    aggregator = MeasureAggregator(measure)
+    study.to_csv(tmp_path / "test.csv", sinks=[aggregator])
+    assert aggregator.get_df().to_dict("records") == [
+        {"sex": "F", "has_event": 1.0, "population": 1, "value": 1.0},
+        {"sex": "M", "has_event": 1.0, "population": 2, "value": 0.5},
+    ]
+
+
 def test_meds():
     session = make_session()
 
@@ -1821,6 +2028,382 @@ def test_medications_returning_code_with_ignored_days():
     assert [i["most_recent_drug_date"] for i in results] == ["2010-01-03"]
 
 
+def test_same_day_events_table_is_shared_between_columns():
+    session = make_session()
+    session.add_all(
+        [
+            Patient(
+                CodedEvents=[
+                    CodedEvent(CTV3Code="foo1", ConsultationDate="2010-01-01"),
+                    # This shouldn't count because there's an "ignore" event on
+                    # the same day
+                    CodedEvent(CTV3Code="foo1", ConsultationDate="2012-01-01T10:45:00"),
+                    CodedEvent(CTV3Code="bar1", ConsultationDate="2012-01-01T16:10:00"),
+                ]
+            ),
+        ]
+    )
+    session.commit()
+    foo_codes = codelist(["foo1"], "ctv3")
+    study = StudyDefinition(
+        population=patients.all(),
+        event_count=patients.with_these_clinical_events(
+            foo_codes,
+            on_or_before="2020-01-01",
+            ignore_days_where_these_codes_occur=codelist(["bar1", "bar2"], "ctv3"),
+            returning="number_of_matches_in_period",
+        ),
+        # Same codes in a different order should still share the table
+        episode_count=patients.with_these_clinical_events(
+            foo_codes,
+            on_or_before="2020-01-01",
+            ignore_days_where_these_codes_occur=codelist(["bar2", "bar1"], "ctv3"),
+            returning="number_of_episodes",
+        ),
+        # A different period needs its own table
+        earlier_event_count=patients.with_these_clinical_events(
+            foo_codes,
+            on_or_before="2011-01-01",
+            ignore_days_where_these_codes_occur=codelist(["bar1", "bar2"], "ctv3"),
+            returning="number_of_matches_in_period",
+        ),
+    )
+    sql = study.to_sql()
+    # One table for each distinct combination of codes and period
+    assert sql.count("_same_day_events (Patient_ID, day)") == 2
+    assert "episode_count_same_day_events" not in sql
+    assert sql.count("DROP TABLE #tmp3_event_count_same_day_events") == 1
+    results = study.to_dicts()
+    assert [i["event_count"] for i in results] == ["1"]
+    assert [i["episode_count"] for i in results] == ["1"]
+    assert [i["earlier_event_count"] for i in results] == ["1"]
+
+
+def test_temporary_tables_dropped_after_last_use():
+    session = make_session()
+    session.add(Patient(CodedEvents=[CodedEvent(CTV3Code="foo1")]))
+    session.commit()
+    study = StudyDefinition(
+        population=patients.all(),
+        has_event=patients.with_these_clinical_events(codelist(["foo1"], "ctv3")),
+    )
+    results = study.to_dicts()
+    assert [i["has_event"] for i in results] == ["1"]
+    # The codelist table is only needed by the query for `has_event`, but the
+    # column tables are needed by the final query so they're kept
+    assert not study.backend.table_exists("#tmp1_has_event_codelist")
+    assert study.backend.table_exists("#has_event")
+    assert study.backend.table_exists("#population")
+
+
+def test_staged_join_for_wide_studies(monkeypatch):
+    monkeypatch.setenv("JOIN_GROUP_SIZE", "2")
+    session = make_session()
+    session.add_all(
+        [
+            Patient(
+                DateOfBirth="1950-01-01",
+                Sex="M",
+                CodedEvents=[
+                    CodedEvent(CTV3Code="foo1", ConsultationDate="2010-01-01"),
+                    CodedEvent(CTV3Code="bar1", ConsultationDate="2012-01-01"),
+                ],
+            ),
+            Patient(
+                DateOfBirth="1960-01-01",
+                Sex="F",
+                CodedEvents=[
+                    CodedEvent(CTV3Code="bar1", ConsultationDate="2011-01-01")
+                ],
+            ),
+            # Excluded from the population
+            Patient(DateOfBirth="1970-01-01", Sex="F"),
+        ]
+    )
+    session.commit()
+    study = StudyDefinition(
+        population=patients.satisfying(
+            "has_foo OR has_bar",
+            has_foo=patients.with_these_clinical_events(codelist(["foo1"], "ctv3")),
+        ),
+        has_bar=patients.with_these_clinical_events(codelist(["bar1"], "ctv3")),
+        bar_date=patients.date_of("has_bar", date_format="YYYY-MM-DD"),
+        sex=patients.sex(),
+        age=patients.age_as_of("2020-01-01"),
+        old_man=patients.categorised_as(
+            {"Y": "age > 65 AND sex = 'M'", "N": "DEFAULT"}
+        ),
+    )
+    assert "-- Join all column groups for final output" in study.to_sql()
+    results = study.to_dicts()
+    assert_results(
+        results,
+        has_bar=["1", "1"],
+        bar_date=["2012-01-01", "2011-01-01"],
+        sex=["M", "F"],
+        age=["70", "60"],
+        old_man=["Y", "N"],
+    )
+
+
+@pytest.mark.parametrize("use_temporary_database", [False, True])
+def test_client_side_join(tmp_path, monkeypatch, use_temporary_database):
+    monkeypatch.setenv("CLIENT_SIDE_JOIN", "1")
+    if use_temporary_database:
+        temporary_database = os.environ["TPP_TEMP_DATABASE_NAME"]
+        monkeypatch.setenv("TEMP_DATABASE_NAME", temporary_database)
+    session = make_session()
+    session.add_all(
+        [
+            Patient(
+                DateOfBirth="1950-01-01",
+                Sex="M",
+                CodedEvents=[
+                    CodedEvent(CTV3Code="foo1", ConsultationDate="2010-01-01"),
+                ],
+            ),
+            Patient(
+                DateOfBirth="1960-01-01",
+                Sex="F",
+                CodedEvents=[
+                    CodedEvent(CTV3Code="bar1", ConsultationDate="2011-01-01")
+                ],
+            ),
+            Patient(DateOfBirth="1970-01-01", Sex="F"),
+            # Excluded from the population
+            Patient(DateOfBirth="2010-01-01", Sex="M"),
+        ]
+    )
+    session.commit()
+    study = StudyDefinition(
+        population=patients.satisfying(
+            "age > 18", age=patients.age_as_of("2020-01-01")
+        ),
+        has_bar=patients.with_these_clinical_events(codelist(["bar1"], "ctv3")),
+        bar_date=patients.date_of("has_bar", date_format="YYYY-MM-DD"),
+        foo_count=patients.with_these_clinical_events(
+            codelist(["foo1"], "ctv3"), returning="number_of_matches_in_period"
+        ),
+        sex=patients.sex(),
+        bar_or_man=patients.categorised_as(
+            {"Y": "has_bar OR sex = 'M'", "N": "DEFAULT"}
+        ),
+    )
+    if use_temporary_database:
+        initial_temporary_tables = _list_table_in_db(session, temporary_database)
+    study.to_csv(tmp_path / "test.csv")
+    with open(tmp_path / "test.csv") as f:
+        results = list(csv.DictReader(f))
+    assert list(results[0].keys()) == [
+        "patient_id",
+        "has_bar",
+        "bar_date",
+        "foo_count",
+        "sex",
+        "bar_or_man",
+    ]
+    assert_results(
+        results,
+        has_bar=["0", "1", "0"],
+        bar_date=["", "2011-01-01", ""],
+        foo_count=["1", "0", "0"],
+        sex=["M", "F", "F"],
+        bar_or_man=["Y", "Y", "N"],
+    )
+    if use_temporary_database:
+        final_temporary_tables = _list_table_in_db(session, temporary_database)
+        assert final_temporary_tables == initial_temporary_tables
+
+
+def test_client_side_join_keeps_column_order(tmp_path, monkeypatch):
+    session = make_session()
+    session.add_all(
+        [
+            Patient(
+                Sex="M",
+                CodedEvents=[
+                    CodedEvent(CTV3Code="bar1", ConsultationDate="2011-01-01")
+                ],
+            ),
+            Patient(Sex="F"),
+        ]
+    )
+    session.commit()
+    study_args = dict(
+        population=patients.all(),
+        # Depends on several column tables so is downloaded separately from
+        # the columns either side of it
+        bar_or_man=patients.categorised_as(
+            {"Y": "has_bar OR sex = 'M'", "N": "DEFAULT"}
+        ),
+        has_bar=patients.with_these_clinical_events(codelist(["bar1"], "ctv3")),
+        sex=patients.sex(),
+    )
+    StudyDefinition(**study_args).to_csv(tmp_path / "server_side.csv")
+    monkeypatch.setenv("CLIENT_SIDE_JOIN", "1")
+    StudyDefinition(**study_args).to_csv(tmp_path / "client_side.csv")
+    with open(tmp_path / "server_side.csv") as f:
+        server_side = f.read()
+    with open(tmp_path / "client_side.csv") as f:
+        client_side = f.read()
+    assert server_side.splitlines()[0] == "patient_id,bar_or_man,has_bar,sex"
+    assert client_side == server_side
+
+
+def test_event_slice_is_refreshed_incrementally(tmp_path, monkeypatch):
+    temporary_database = os.environ["TPP_TEMP_DATABASE_NAME"]
+    monkeypatch.setenv("TEMP_DATABASE_NAME", temporary_database)
+    monkeypatch.setenv("EVENT_SLICE", "1")
+    session = make_session()
+    patient = Patient(
+        CodedEvents=[
+            CodedEvent(CTV3Code="foo1", ConsultationDate="2010-01-01"),
+            CodedEvent(CTV3Code="bar1", ConsultationDate="2010-01-01"),
+            CodedEvent(CTV3Code="baz1", ConsultationDate="2011-01-01"),
+        ],
+        MedicationIssues=[
+            MedicationIssue(
+                MedicationDictionary=MedicationDictionary(
+                    FullName="Foo Tablets", DMD_ID="0010", MultilexDrug_ID="10"
+                ),
+                ConsultationDate="2012-01-01",
+            ),
+        ],
+    )
+    session.add(patient)
+    session.commit()
+    study_args = dict(
+        population=patients.all(),
+        foo_count=patients.with_these_clinical_events(
+            codelist(["foo1"], "ctv3"), returning="number_of_matches_in_period"
+        ),
+        bar_date=patients.with_these_clinical_events(
+            codelist(["bar1", "baz1"], "ctv3"),
+            returning="date",
+            find_last_match_in_period=True,
+            date_format="YYYY-MM-DD",
+            ignore_days_where_these_codes_occur=codelist(["foo1"], "ctv3"),
+        ),
+        med_date=patients.with_these_medications(
+            codelist(["0010"], "snomed"),
+            returning="date",
+            date_format="YYYY-MM-DD",
+        ),
+    )
+    study = StudyDefinition(**study_args)
+    slice_tables = list(study.backend.event_slices.values())
+    study.to_csv(tmp_path / "first.csv")
+    with open(tmp_path / "first.csv") as f:
+        results = list(csv.DictReader(f))
+    assert_results(
+        results, foo_count=["1"], bar_date=["2011-01-01"], med_date=["2012-01-01"]
+    )
+    try:
+        # Only events matching the study's codelists should be in the slice
+        coded_event_slice = study.backend.event_slices["CodedEvent"]
+        session.add(
+            CodedEvent(Patient=patient, CTV3Code="xyz", ConsultationDate="2013-01-01")
+        )
+        session.add(
+            CodedEvent(Patient=patient, CTV3Code="foo1", ConsultationDate="2014-01-01")
+        )
+        session.add(
+            CodedEvent(Patient=patient, CTV3Code="baz1", ConsultationDate="2015-01-01")
+        )
+        session.commit()
+        study = StudyDefinition(**study_args)
+        assert study.backend.event_slices["CodedEvent"] == coded_event_slice
+        study.to_csv(tmp_path / "second.csv")
+        with open(tmp_path / "second.csv") as f:
+            results = list(csv.DictReader(f))
+        assert_results(
+            results, foo_count=["2"], bar_date=["2015-01-01"], med_date=["2012-01-01"]
+        )
+        rows = list(session.execute(f"SELECT CTV3Code FROM {coded_event_slice}"))
+        assert sorted(row[0] for row in rows) == [
+            "bar1",
+            "baz1",
+            "baz1",
+            "foo1",
+            "foo1",
+        ]
+    finally:
+        for table in slice_tables:
+            session.execute(f"DROP TABLE {table}")
+        session.commit()
+
+
+@pytest.mark.parametrize("shard_threads", ["1", "2"])
+def test_sharded_extraction(tmp_path, monkeypatch, shard_threads):
+    monkeypatch.setenv("SHARDS", "3")
+    monkeypatch.setenv("SHARD_THREADS", shard_threads)
+    session = make_session()
+    for sex, event_code in [("M", "foo1"), ("F", None), ("F", "foo1"), ("M", None)]:
+        patient = Patient(DateOfBirth="1950-01-01", Sex=sex)
+        if event_code:
+            patient.CodedEvents.append(
+                CodedEvent(CTV3Code=event_code, ConsultationDate="2010-01-01")
+            )
+        session.add(patient)
+    # Excluded from the population
+    session.add(Patient(DateOfBirth="1950-01-01", Sex="F"))
+    session.commit()
+    study = StudyDefinition(
+        population=patients.satisfying(
+            "sex = 'M' OR has_event",
+            has_event=patients.with_these_clinical_events(codelist(["foo1"], "ctv3")),
+        ),
+        sex=patients.sex(),
+        event_count=patients.with_these_clinical_events(
+            codelist(["foo1"], "ctv3"), returning="number_of_matches_in_period"
+        ),
+    )
+    study.to_csv(tmp_path / "test.csv")
+    with open(tmp_path / "test.csv") as f:
+        results = list(csv.DictReader(f))
+    assert_results(results, sex=["M", "F", "M"], event_count=["1", "1", "0"])
+    # Check that the per-shard files have been cleaned up
+    assert os.listdir(tmp_path) == ["test.csv"]
+
+
+def test_sharded_extraction_refreshes_event_slices_once(tmp_path, monkeypatch):
+    temporary_database = os.environ["TPP_TEMP_DATABASE_NAME"]
+    monkeypatch.setenv("TEMP_DATABASE_NAME", temporary_database)
+    monkeypatch.setenv("EVENT_SLICE", "1")
+    monkeypatch.setenv("SHARDS", "2")
+    monkeypatch.setenv("SHARD_THREADS", "2")
+    session = make_session()
+    for event_code in ["foo1", None, "foo1", "foo1"]:
+        patient = Patient()
+        if event_code:
+            patient.CodedEvents.append(
+                CodedEvent(CTV3Code=event_code, ConsultationDate="2010-01-01")
+            )
+        session.add(patient)
+    session.commit()
+    study = StudyDefinition(
+        population=patients.all(),
+        event_count=patients.with_these_clinical_events(
+            codelist(["foo1"], "ctv3"), returning="number_of_matches_in_period"
+        ),
+    )
+    shard_backends = []
+    get_shard_backend = study.backend.get_shard_backend
+
+    def record_shard_backend(patient_id_range):
+        shard_backends.append(get_shard_backend(patient_id_range))
+        return shard_backends[-1]
+
+    with patch.object(study.backend, "get_shard_backend", record_shard_backend):
+        study.to_csv(tmp_path / "test.csv")
+    assert len(shard_backends) == 2
+    for backend in shard_backends:
+        assert not any("Adding new events" in query for query in backend.queries)
+    with open(tmp_path / "test.csv") as f:
+        results = list(csv.DictReader(f))
+    assert_results(results, event_count=["1", "0", "1", "1"])
+
+
 def test_patients_with_tpp_vaccination_record():
     session = make_session()
     vaccines = [